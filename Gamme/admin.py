@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import GammeControle, MissionControle, OperationControle, PhotoOperation, Profile, User
+from .models import GammeControle, MissionControle, OperationControle, PhotoOperation, Profile, User, PdfRenderJob
 
 admin.site.register(GammeControle)
 admin.site.register(MissionControle)
@@ -7,6 +7,7 @@ admin.site.register(OperationControle)
 admin.site.register(PhotoOperation)
 admin.site.register(Profile)
 admin.site.register(User)
+admin.site.register(PdfRenderJob)
 
 
 
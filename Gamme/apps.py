@@ -4,5 +4,6 @@ from django.apps import AppConfig
 class GammeConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'Gamme'
-def ready(self):
-    import Gamme.signals 
\ No newline at end of file
+
+    def ready(self):
+        import Gamme.signals  # noqa: F401
@@ -0,0 +1,208 @@
+"""
+Resumable chunked photo uploads.
+
+Protocol (see the chunked_upload_* views):
+
+1. POST gamme/uploads/ with kind, filename, size and the target gamme or
+   operation: returns a token and the offset to send from (0).
+2. PUT gamme/uploads/<token>/ with a chunk as raw body and
+   `Content-Range: bytes <start>-<end>/<size>`. The chunk must start at the
+   current offset; the new offset is returned. A dropped connection keeps
+   whatever bytes arrived, and GET gamme/uploads/<token>/ tells where to resume.
+3. POST gamme/uploads/<token>/complete/ once offset == size: the file goes
+   through the regular ingestion (validation, orientation, derivatives) and
+   is linked to its gamme or operation.
+
+Chunks are written straight into a temporary file under
+GAMME_CHUNKED_UPLOAD_DIR; abandoned uploads are removed by the
+`expire_chunked_uploads` command.
+"""
+import hashlib
+import os
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files import File
+from django.utils import timezone
+
+from .ingest import ingest_images
+from .models import ChunkedUpload, PhotoDefaut, Photolimiteacceptable, PhotoOperation
+
+COPY_BUFFER = 64 * 1024
+
+
+class UploadConflict(Exception):
+    """The chunk does not start at the current offset of the upload."""
+
+    def __init__(self, offset):
+        super().__init__(f'Expected offset {offset}')
+        self.offset = offset
+
+
+class UploadIncomplete(Exception):
+    """Completion requested before every byte was received."""
+
+
+def _upload_dir():
+    return getattr(settings, 'GAMME_CHUNKED_UPLOAD_DIR', os.path.join(settings.BASE_DIR, 'cache', 'uploads'))
+
+
+def part_path(upload):
+    return os.path.join(_upload_dir(), f'{upload.token}.part')
+
+
+def start_upload(user, kind, filename, size, gamme=None, operation=None, description='', sha256=''):
+    """Create the upload record and its empty temporary file."""
+    upload = ChunkedUpload.objects.create(
+        kind=kind,
+        gamme=gamme,
+        operation=operation,
+        filename=os.path.basename(filename),
+        description=description,
+        size=size,
+        sha256=sha256.lower(),
+        created_by=user,
+    )
+    os.makedirs(_upload_dir(), exist_ok=True)
+    open(part_path(upload), 'wb').close()
+    return upload
+
+
+def write_chunk(upload, offset, stream, length):
+    """
+    Append up to `length` bytes read from stream at `offset` and return the new offset.
+
+    Bytes received before a read error are kept, so the client can resume
+    from the returned offset. Raises UploadConflict if offset is not the
+    current offset of the upload.
+    """
+    if upload.status != ChunkedUpload.STATUS_UPLOADING or offset != upload.offset:
+        raise UploadConflict(upload.offset)
+    if offset + length > upload.size:
+        raise ValueError('Chunk goes past the declared size')
+
+    received = 0
+    with open(part_path(upload), 'r+b') as f:
+        f.seek(offset)
+        try:
+            while received < length:
+                data = stream.read(min(COPY_BUFFER, length - received))
+                if not data:
+                    break
+                f.write(data)
+                received += len(data)
+        except OSError:
+            # Client went away mid-chunk: keep what arrived
+            pass
+        f.truncate(offset + received)
+        f.flush()
+        os.fsync(f.fileno())
+
+    # Conditional on the offset, so that two clients sending the same chunk cannot both advance it
+    updated = ChunkedUpload.objects.filter(pk=upload.pk, offset=offset).update(
+        offset=offset + received,
+        date_mise_a_jour=timezone.now(),
+    )
+    if not updated:
+        upload.refresh_from_db(fields=['offset'])
+        raise UploadConflict(upload.offset)
+    upload.offset = offset + received
+    return upload.offset
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(COPY_BUFFER), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _target(upload):
+    """(model, unsaved photo instance, stored filename) for the upload kind."""
+    if upload.kind == ChunkedUpload.KIND_OPERATION:
+        photo = PhotoOperation(operation=upload.operation, description=upload.description, created_by=upload.created_by)
+        return PhotoOperation, photo, upload.filename
+    if upload.kind == ChunkedUpload.KIND_ACCEPTABLE:
+        photo = Photolimiteacceptable(gamme=upload.gamme, description=upload.description, created_by=upload.created_by)
+        # Same naming as upload_photo_acceptable
+        extension = os.path.splitext(upload.filename)[1].lower()
+        return Photolimiteacceptable, photo, f'acceptable_{upload.gamme_id}_{int(timezone.now().timestamp())}{extension}'
+    photo = PhotoDefaut(gamme=upload.gamme, description=upload.description, created_by=upload.created_by)
+    return PhotoDefaut, photo, upload.filename
+
+
+def complete_upload(upload):
+    """
+    Turn a fully received upload into its photo row and return the ingestion result.
+
+    Idempotent: completing an upload twice returns the photo created the
+    first time. Raises UploadIncomplete if bytes are missing and ValueError
+    when the checksum does not match (the upload then restarts from 0).
+    """
+    if upload.status == ChunkedUpload.STATUS_COMPLETE:
+        return None
+    if upload.offset != upload.size:
+        raise UploadIncomplete(f'{upload.offset} of {upload.size} bytes received')
+
+    path = part_path(upload)
+    if upload.sha256 and _file_sha256(path) != upload.sha256:
+        open(path, 'wb').close()
+        ChunkedUpload.objects.filter(pk=upload.pk).update(offset=0)
+        upload.offset = 0
+        raise ValueError('Checksum mismatch, upload restarted')
+
+    # Claimed first so that a repeated request cannot create the photo twice
+    claimed = ChunkedUpload.objects.filter(pk=upload.pk, status=ChunkedUpload.STATUS_UPLOADING).update(
+        status=ChunkedUpload.STATUS_COMPLETE
+    )
+    if not claimed:
+        upload.refresh_from_db()
+        return None
+
+    model, photo, filename = _target(upload)
+    try:
+        with open(path, 'rb') as f:
+            result = ingest_images(model, 'image', [(photo, File(f, name=upload.filename), filename)])[0]
+    except Exception:
+        ChunkedUpload.objects.filter(pk=upload.pk).update(status=ChunkedUpload.STATUS_UPLOADING)
+        raise
+    if result['error'] is not None:
+        ChunkedUpload.objects.filter(pk=upload.pk).update(status=ChunkedUpload.STATUS_UPLOADING)
+        return result
+
+    upload.status = ChunkedUpload.STATUS_COMPLETE
+    upload.photo_id = result['instance'].id
+    upload.save(update_fields=['status', 'photo_id', 'date_mise_a_jour'])
+    os.remove(path)
+    return result
+
+
+def expire_uploads(max_age, dry_run=False):
+    """
+    Delete uploads not touched for max_age seconds with their temporary
+    files, plus temporary files left without a record. Returns the number
+    of uploads and stray files removed.
+    """
+    cutoff = timezone.now() - timedelta(seconds=max_age)
+    stale = ChunkedUpload.objects.filter(date_mise_a_jour__lt=cutoff)
+    uploads = 0
+    for upload in stale.iterator():
+        uploads += 1
+        if not dry_run:
+            if os.path.exists(part_path(upload)):
+                os.remove(part_path(upload))
+            upload.delete()
+
+    strays = 0
+    directory = _upload_dir()
+    if os.path.isdir(directory):
+        known = {f'{token}.part' for token in ChunkedUpload.objects.values_list('token', flat=True)}
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if name in known or os.path.getmtime(path) >= cutoff.timestamp():
+                continue
+            strays += 1
+            if not dry_run:
+                os.remove(path)
+    return uploads, strays
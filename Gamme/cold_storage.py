@@ -0,0 +1,255 @@
+"""
+Cold tier for the photos of superseded gamme versions.
+
+The `tier_cold_media` command packs blobs referenced only by inactive gamme
+versions (statut=False) not modified for GAMME_MEDIA_COLD_AFTER_DAYS into
+zip archives under GAMME_MEDIA_ARCHIVE_DIR, outside MEDIA_ROOT, and removes
+the hot files. MediaBlob.archive tells which archive holds a blob.
+
+Reads stay transparent: BlobStorage, serve_media and the PDF renderer fall
+back to `cold_path`, which extracts the blob into a local cache bounded to
+GAMME_MEDIA_COLD_CACHE_MAX_BYTES (least recently read files go first).
+Web derivatives are small and stay hot, so pages listing an archived
+version do not touch the archives.
+"""
+import logging
+import os
+import shutil
+import time
+import uuid
+import zipfile
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+COPY_BUFFER = 64 * 1024
+
+
+def archive_dir():
+    return getattr(settings, 'GAMME_MEDIA_ARCHIVE_DIR', os.path.join(settings.BASE_DIR, 'media_archive'))
+
+
+def cache_dir():
+    return getattr(settings, 'GAMME_MEDIA_COLD_CACHE_DIR', os.path.join(settings.BASE_DIR, 'cache', 'media_cold'))
+
+
+def _extract(archive, name, target):
+    """Write member `name` of `archive` to target atomically."""
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    temporary = f'{target}.{uuid.uuid4().hex}.tmp'
+    try:
+        with zipfile.ZipFile(os.path.join(archive_dir(), archive)) as zf, \
+                zf.open(name) as src, open(temporary, 'wb') as dest:
+            shutil.copyfileobj(src, dest, COPY_BUFFER)
+        os.replace(temporary, target)
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+
+def archived_names(names):
+    """The blob names of `names` that live in an archive."""
+    from .models import MediaBlob
+
+    return set(MediaBlob.objects.filter(name__in=names).exclude(archive='').values_list('name', flat=True))
+
+
+def archived_size(name):
+    """Size of an archived blob, or None when `name` is not archived."""
+    from .models import MediaBlob
+
+    return MediaBlob.objects.filter(name=name).exclude(archive='').values_list('size', flat=True).first()
+
+
+def cold_path(name):
+    """
+    Local path of an archived blob, extracted into the cache on first read.
+    Returns None when `name` is not archived.
+    """
+    from .models import MediaBlob
+
+    path = os.path.join(cache_dir(), name)
+    if os.path.exists(path):
+        # Keeps recently read files out of trim_cache's way
+        os.utime(path)
+        return path
+    archive = MediaBlob.objects.filter(name=name).exclude(archive='').values_list('archive', flat=True).first()
+    if archive is None:
+        return None
+    try:
+        _extract(archive, name, path)
+    except (OSError, KeyError, zipfile.BadZipFile) as e:
+        logger.error(f'Could not extract {name} from {archive}: {str(e)}')
+        return None
+    trim_cache(keep=path)
+    return path
+
+
+def media_path(name):
+    """Path of a media file: MEDIA_ROOT, else the cold cache for archived blobs."""
+    path = os.path.join(settings.MEDIA_ROOT, name)
+    if os.path.exists(path):
+        return path
+    return cold_path(name) or path
+
+
+def trim_cache(keep=None):
+    """Delete the least recently read cache files until the cache fits its size limit."""
+    limit = getattr(settings, 'GAMME_MEDIA_COLD_CACHE_MAX_BYTES', 512 * 1024 * 1024)
+    files = []
+    for directory, _, names in os.walk(cache_dir()):
+        for file_name in names:
+            path = os.path.join(directory, file_name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= limit:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def _references(days):
+    """
+    (cold, hot) sets of image names: referenced by inactive gamme versions not
+    modified for `days` days, and referenced by anything else. Photos of EPIs
+    and measuring means are shared by every version and are always hot.
+    """
+    from .models import GammeControle
+    from .signals import IMAGE_FIELDS
+
+    cutoff = timezone.now() - timedelta(days=days)
+    cold_gammes = GammeControle.objects.filter(statut=False, date_mise_a_jour__lt=cutoff)
+    cold_filters = {
+        'PhotoOperation': {'operation__gamme__in': cold_gammes},
+        'PhotoDefaut': {'gamme__in': cold_gammes},
+        'Photolimiteacceptable': {'gamme__in': cold_gammes},
+        'GammeControle': {'pk__in': cold_gammes},
+    }
+
+    cold, hot = set(), set()
+    for model, field in IMAGE_FIELDS.items():
+        rows = model.objects.exclude(**{field: ''}).exclude(**{f'{field}__isnull': True})
+        cold_filter = cold_filters.get(model.__name__)
+        if cold_filter is not None:
+            cold.update(rows.filter(**cold_filter).values_list(field, flat=True).iterator())
+            rows = rows.exclude(**cold_filter)
+        hot.update(rows.values_list(field, flat=True).iterator())
+    return cold - hot, hot
+
+
+def tiering_candidates(days):
+    """
+    (blobs to archive, blobs to restore): hot blobs only cold versions refer
+    to, and archived blobs a version still in use (or reactivated) refers to.
+    """
+    from .models import MediaBlob
+
+    cold, hot = _references(days)
+    to_archive, to_restore = [], []
+    for name, archive in MediaBlob.objects.values_list('name', 'archive').iterator():
+        if not archive and name in cold:
+            to_archive.append(name)
+        elif archive and name in hot:
+            to_restore.append(name)
+    return sorted(to_archive), sorted(to_restore)
+
+
+def archive_blobs(names):
+    """
+    Pack the hot blobs `names` into a new archive and delete their hot files
+    once the rows point at it. Returns (archive name, blobs archived, bytes).
+    """
+    from .media_blobs import blob_storage
+    from .models import MediaBlob
+
+    os.makedirs(archive_dir(), exist_ok=True)
+    archive = f'{timezone.now():%Y%m%d-%H%M%S}-{uuid.uuid4().hex[:8]}.zip'
+    path = os.path.join(archive_dir(), archive)
+    packed = []
+    with zipfile.ZipFile(f'{path}.tmp', 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        for name in names:
+            try:
+                zf.write(blob_storage.path(name), name)
+            except FileNotFoundError:
+                continue
+            packed.append(name)
+    with zipfile.ZipFile(f'{path}.tmp') as zf:
+        # Every member is read back and checked before a hot file is removed
+        broken = zf.testzip()
+    if broken is not None or not packed:
+        os.remove(f'{path}.tmp')
+        if broken is not None:
+            raise zipfile.BadZipFile(f'{broken} is corrupt in {archive}')
+        return None, 0, 0
+    os.replace(f'{path}.tmp', path)
+
+    with transaction.atomic():
+        MediaBlob.objects.filter(name__in=packed, archive='').update(archive=archive)
+        archived = list(MediaBlob.objects.filter(name__in=packed, archive=archive).values_list('name', 'size'))
+        transaction.on_commit(lambda: _delete_hot([name for name, _ in archived]))
+    return archive, len(archived), sum(size for _, size in archived)
+
+
+def _delete_hot(names):
+    from .media_blobs import blob_storage
+
+    for name in names:
+        try:
+            os.remove(blob_storage.path(name))
+        except FileNotFoundError:
+            pass
+
+
+def restore_blob(name):
+    """Bring an archived blob back to hot storage. Returns False when it is not archived."""
+    from .media_blobs import blob_storage, link_or_copy
+    from .models import MediaBlob
+
+    archive = MediaBlob.objects.filter(name=name).exclude(archive='').values_list('archive', flat=True).first()
+    if archive is None:
+        return False
+    # File first, then the row: readers never see a blob in neither place
+    cached = os.path.join(cache_dir(), name)
+    if os.path.exists(cached):
+        link_or_copy(cached, blob_storage.path(name))
+    else:
+        _extract(archive, name, blob_storage.path(name))
+    MediaBlob.objects.filter(name=name, archive=archive).update(archive='')
+    return True
+
+
+def prune_archives(min_age=3600):
+    """
+    Delete archives no MediaBlob row points at any more (all their blobs were
+    deleted or restored). Archives younger than min_age seconds are left to
+    the run that is writing them. Returns (archives deleted, bytes freed).
+    """
+    from .models import MediaBlob
+
+    directory = archive_dir()
+    if not os.path.isdir(directory):
+        return 0, 0
+    used = set(MediaBlob.objects.exclude(archive='').values_list('archive', flat=True).distinct())
+    deleted = freed = 0
+    for file_name in os.listdir(directory):
+        path = os.path.join(directory, file_name)
+        if file_name in used or os.path.getmtime(path) > time.time() - min_age:
+            continue
+        freed += os.path.getsize(path)
+        os.remove(path)
+        deleted += 1
+    return deleted, freed
@@ -0,0 +1,159 @@
+"""
+File delivery.
+
+Views decide *whether* a file may be sent; the bytes themselves are handed to
+the front web server when one is configured (FILE_DELIVERY_BACKEND):
+
+- 'nginx': X-Accel-Redirect to an internal location, mapped from the
+  filesystem roots in FILE_DELIVERY_ROOTS
+- 'sendfile': X-Sendfile with the absolute path (Apache mod_xsendfile, lighttpd)
+- 'django' (default): streamed by Django, with Range and conditional GET support
+"""
+import mimetypes
+import os
+import re
+from stat import S_ISREG
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import content_disposition_header, http_date, parse_http_date_safe
+
+CHUNK_SIZE = 64 * 1024
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def _backend():
+    return getattr(settings, 'FILE_DELIVERY_BACKEND', 'django')
+
+
+def _accel_uri(path):
+    """Internal nginx URI for path, or None if it is outside every mapped root."""
+    roots = {os.path.join(os.path.abspath(root), ''): location
+             for root, location in getattr(settings, 'FILE_DELIVERY_ROOTS', {}).items()}
+    # Most specific root first: a root may lie inside another one
+    for root in sorted(roots, key=len, reverse=True):
+        if path.startswith(root):
+            return roots[root].rstrip('/') + '/' + quote(os.path.relpath(path, root).replace(os.sep, '/'))
+    return None
+
+
+def file_etag(stat):
+    return '"%x-%x"' % (stat.st_mtime_ns, stat.st_size)
+
+
+def _parse_range(header, size):
+    """
+    Return (start, end) for a single satisfiable byte range, 'unsatisfiable',
+    or None when the header should be ignored (absent, malformed, multi-range).
+    """
+    match = RANGE_RE.match(header.strip())
+    if not match or size == 0:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            return 'unsatisfiable'
+        return max(0, size - length), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        return 'unsatisfiable'
+    return start, end
+
+
+def _read_range(path, start, length):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def serve_file(request, path, content_type=None, as_attachment=False, filename=None, etag=None):
+    """
+    Return a response delivering the file at path.
+
+    Conditional requests (If-None-Match / If-Modified-Since) get a 304 before
+    any delivery header is set. `etag` overrides the default mtime/size tag.
+    """
+    path = os.path.abspath(path)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        raise Http404('Fichier introuvable')
+    if not S_ISREG(stat.st_mode):
+        # Directories, devices, FIFOs: open() would fail or block
+        raise Http404('Fichier introuvable')
+
+    etag = etag or file_etag(stat)
+    last_modified = int(stat.st_mtime)
+    not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if not_modified is not None:
+        not_modified['ETag'] = etag
+        return not_modified
+
+    if content_type is None:
+        content_type, encoding = mimetypes.guess_type(path)
+        content_type = content_type or 'application/octet-stream'
+
+    backend = _backend()
+    accel_uri = _accel_uri(path) if backend == 'nginx' else None
+    if accel_uri:
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = accel_uri
+    elif backend == 'sendfile':
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = path
+    else:
+        response = _stream(request, path, stat, etag, content_type)
+
+    if response.status_code != 416:
+        response['Content-Disposition'] = content_disposition_header(as_attachment, filename or os.path.basename(path))
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def _if_range_matches(request, etag, last_modified):
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return if_range == etag
+    date = parse_http_date_safe(if_range)
+    return date is not None and date >= last_modified
+
+
+def _stream(request, path, stat, etag, content_type):
+    size = stat.st_size
+    byte_range = None
+    if request.method in ('GET', 'HEAD') and _if_range_matches(request, etag, int(stat.st_mtime)):
+        byte_range = _parse_range(request.META.get('HTTP_RANGE', ''), size)
+
+    if byte_range == 'unsatisfiable':
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        return response
+
+    if byte_range is None:
+        response = FileResponse(open(path, 'rb'), content_type=content_type)
+        response['Content-Length'] = str(size)
+        return response
+
+    start, end = byte_range
+    length = end - start + 1
+    response = StreamingHttpResponse(_read_range(path, start, length), status=206, content_type=content_type)
+    response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    response['Content-Length'] = str(length)
+    return response
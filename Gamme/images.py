@@ -0,0 +1,258 @@
+"""
+Image derivatives.
+
+The PDF template shows photos in small fixed boxes; handing xhtml2pdf the
+original camera JPEGs makes it decode and embed megabytes per image. The
+helpers below produce (and cache on disk) downscaled copies sized for each
+slot of the template.
+
+Uploaded images also get web derivatives (thumb, card and print sizes, in
+WebP and JPEG) stored next to the media and recorded as ImageDerivative rows,
+for the `responsive_img` template tag.
+"""
+import hashlib
+import logging
+import os
+import tempfile
+from collections import Counter
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+
+logger = logging.getLogger(__name__)
+
+# Box of each image slot in gamme_pdf_template.html, in CSS pixels (width, height)
+PDF_IMAGE_SLOTS = {
+    'operation': (150, 100),
+    'moyen': (50, 50),
+    'legende': (35, 25),
+    'epi': (60, 50),
+    'non_conforme': (400, 200),
+    'defaut': (240, 60),
+}
+
+
+# Bounding boxes of the web derivatives, largest first
+DERIVATIVE_SIZES = {
+    'print': (1600, 1600),
+    'card': (480, 480),
+    'thumb': (160, 160),
+}
+
+DERIVATIVE_FORMATS = {
+    'webp': ('WEBP', 'webp', {'quality': 78, 'method': 4}),
+    'jpeg': ('JPEG', 'jpg', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+
+def has_alpha(img):
+    return img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info)
+
+
+def _derivatives_dir():
+    return getattr(settings, 'GAMME_PDF_IMAGES_DIR', os.path.join(settings.BASE_DIR, 'cache', 'pdf_images'))
+
+
+def resize_image(source_path, dest_path, box, quality=80):
+    """
+    Write a copy of source_path that fits in box (width, height) to dest_path.
+
+    EXIF orientation is applied, images with transparency stay PNG and the
+    rest is re-encoded as progressive JPEG. The file is written atomically.
+    Returns the (width, height) of the written image.
+    """
+    from PIL import Image, ImageOps
+
+    with Image.open(source_path) as img:
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail(box, Image.LANCZOS)
+        if has_alpha(img):
+            img = img.convert('RGBA')
+            fmt, options = 'PNG', {'optimize': True}
+        else:
+            img = img.convert('RGB')
+            fmt, options = 'JPEG', {'quality': quality, 'optimize': True, 'progressive': True}
+
+        directory = os.path.dirname(dest_path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                img.save(tmp, fmt, **options)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, dest_path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        return img.size
+
+
+def pdf_image_path(source_path, slot, metadata=None):
+    """
+    Return the path of the print-resolution derivative of source_path for the
+    given PDF slot, creating it on first use. Falls back to the original file
+    for unknown slots, unreadable images or images already small enough.
+
+    `metadata` is the stored (width, height, file_size, sha256) of the image:
+    with it, a cached derivative is found without touching the source file.
+    """
+    box = PDF_IMAGE_SLOTS.get(slot)
+    if box is None:
+        return source_path
+
+    scale = getattr(settings, 'GAMME_PDF_IMAGE_SCALE', 2)
+    box = (box[0] * scale, box[1] * scale)
+    if metadata is not None:
+        width, height, size, sha256 = metadata
+        if width <= box[0] and height <= box[1] and size < 100 * 1024:
+            return source_path
+        # Keyed on the content hash: a replaced file has another hash
+        key = hashlib.sha1(f'{sha256}|{box}'.encode('utf-8')).hexdigest()
+    else:
+        try:
+            stat = os.stat(source_path)
+        except OSError:
+            return source_path
+        # Keyed on the source mtime/size so that a replaced file gets a new derivative
+        key = hashlib.sha1(f'{source_path}|{stat.st_mtime_ns}|{stat.st_size}|{box}'.encode('utf-8')).hexdigest()
+    for ext in ('.jpg', '.png'):
+        cached = os.path.join(_derivatives_dir(), slot, key[:2], key + ext)
+        if os.path.exists(cached):
+            return cached
+
+    try:
+        from PIL import Image
+        with Image.open(source_path) as img:
+            width, height = img.size
+            alpha = has_alpha(img)
+        if metadata is None and width <= box[0] and height <= box[1] and stat.st_size < 100 * 1024:
+            return source_path
+        dest = os.path.join(_derivatives_dir(), slot, key[:2], key + ('.png' if alpha else '.jpg'))
+        resize_image(source_path, dest, box)
+        return dest
+    except Exception as e:
+        logger.warning(f'Could not build PDF derivative of {source_path}: {str(e)}')
+        return source_path
+
+
+def derivative_name(source, size, fmt):
+    """Storage name of a web derivative: derivatives/<size>/<source name>.<ext>"""
+    # The source extension stays in the name: photo.png and photo.jpg are different images
+    return f'derivatives/{size}/{source}.{DERIVATIVE_FORMATS[fmt][1]}'
+
+
+def _encode(img, fmt):
+    pil_format, _, options = DERIVATIVE_FORMATS[fmt]
+    if pil_format == 'JPEG' and img.mode == 'RGBA':
+        # No alpha channel in JPEG: flatten on white like the pages they are shown on
+        from PIL import Image
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel('A'))
+        img = background
+    buffer = BytesIO()
+    img.save(buffer, pil_format, **options)
+    return buffer.getvalue()
+
+
+def _replace_file(path, data):
+    """Write data to path through a temporary file renamed over it."""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            tmp.write(data)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def render_derivatives(img, source, storage=None):
+    """
+    Write every size and format of the web derivatives of a decoded image
+    (already in display orientation) and return unsaved ImageDerivative rows.
+
+    Touches storage only, so it can run in worker threads. Each size is
+    reduced from the previous one.
+    """
+    from PIL import Image
+
+    from .models import ImageDerivative
+
+    storage = storage or default_storage
+    img = img.convert('RGBA' if has_alpha(img) else 'RGB')
+    derivatives = []
+    for size, box in DERIVATIVE_SIZES.items():
+        img.thumbnail(box, Image.LANCZOS)
+        for fmt in DERIVATIVE_FORMATS:
+            name = derivative_name(source, size, fmt)
+            # Deterministic names: a new file replaces the old one in a single rename,
+            # so rows pointing at it never see it missing
+            _replace_file(storage.path(name), _encode(img, fmt))
+            derivatives.append(ImageDerivative(
+                source=source, size=size, format=fmt, file=name, width=img.width, height=img.height
+            ))
+    return derivatives
+
+
+def build_derivatives(source, storage=None):
+    """
+    Generate the web derivatives of the image stored as `source` and record
+    them as ImageDerivative rows. Returns the rows.
+    """
+    from PIL import Image, ImageOps
+
+    from .models import ImageDerivative
+
+    storage = storage or default_storage
+    with storage.open(source, 'rb') as f, Image.open(f) as original:
+        img = ImageOps.exif_transpose(original)
+        img.load()
+
+    rows = []
+    for derivative in render_derivatives(img, source, storage):
+        row, _ = ImageDerivative.objects.update_or_create(
+            source=source, size=derivative.size, format=derivative.format,
+            defaults={'file': derivative.file.name, 'width': derivative.width, 'height': derivative.height},
+        )
+        rows.append(row)
+    return rows
+
+
+def has_derivatives(sources):
+    """The images of `sources` whose web derivatives are all recorded."""
+    from .models import ImageDerivative
+
+    expected = len(DERIVATIVE_SIZES) * len(DERIVATIVE_FORMATS)
+    counts = Counter(ImageDerivative.objects.filter(source__in=sources, size__in=DERIVATIVE_SIZES)
+                     .values_list('source', flat=True))
+    return {source for source, count in counts.items() if count >= expected}
+
+
+def ensure_derivatives(source):
+    """Build the derivatives of source unless they all exist. Never raises."""
+    if has_derivatives([source]):
+        return
+    try:
+        build_derivatives(source)
+    except Exception as e:
+        logger.warning(f'Could not build derivatives of {source}: {str(e)}')
+
+
+def derivatives_for(sources):
+    """
+    Load the derivatives of several images in one query.
+
+    Returns {source: {(size, format): ImageDerivative}}, with an entry (maybe
+    empty) for every source.
+    """
+    from .models import ImageDerivative
+
+    sources = {source for source in sources if source}
+    result = {source: {} for source in sources}
+    for derivative in ImageDerivative.objects.filter(source__in=sources):
+        result[derivative.source][(derivative.size, derivative.format)] = derivative
+    return result
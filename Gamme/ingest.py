@@ -0,0 +1,291 @@
+"""
+Batched ingestion of uploaded photos.
+
+Each file of a multi-file upload is validated, decoded, normalized (upright,
+size-capped, stripped of metadata, see `normalize_image`) and written to
+storage with its web derivatives in a thread pool. The rows are then inserted with one bulk_create. The result
+lists the outcome of every file, so that one bad photo does not fail the
+whole batch.
+"""
+import logging
+import mimetypes
+import os
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.validators import validate_image_file_extension
+from django.db import transaction
+
+from .images import has_alpha, has_derivatives, render_derivatives
+from .media_blobs import blob_sha256, content_sha256, discard, incref
+from .models import GammeControle, ImageDerivative
+
+logger = logging.getLogger(__name__)
+
+# EXIF orientation tag
+ORIENTATION = 0x0112
+
+# Image.info keys carrying metadata (camera, GPS, editing history) dropped at ingest
+METADATA_KEYS = ('exif', 'xmp', 'XML:com.adobe.xmp', 'comment', 'photoshop')
+
+try:
+    from pillow_heif import register_heif_opener
+except ImportError:
+    # Without pillow-heif, HEIC photos are rejected as invalid images
+    register_heif_opener = None
+else:
+    register_heif_opener()
+
+
+def _max_bytes():
+    return getattr(settings, 'GAMME_UPLOAD_MAX_BYTES', 25 * 1024 * 1024)
+
+
+def needs_normalizing(img):
+    """True when a decoded image is rotated, too large, carries metadata or is not JPEG/PNG."""
+    if not getattr(settings, 'GAMME_IMAGE_NORMALIZE', True):
+        return False
+    max_side = getattr(settings, 'GAMME_IMAGE_MAX_SIDE', 2560)
+    return (
+        img.getexif().get(ORIENTATION, 1) not in (None, 1)
+        or max(img.size) > max_side
+        or img.format not in ('JPEG', 'PNG')
+        or any(img.info.get(key) for key in METADATA_KEYS)
+    )
+
+
+def normalize_image(img, filename):
+    """
+    Return (content, image in display orientation, filename) for a decoded image.
+
+    Unless GAMME_IMAGE_NORMALIZE is off, images that need it are rotated
+    according to their EXIF orientation, reduced to GAMME_IMAGE_MAX_SIDE and
+    re-encoded without metadata (JPEG at GAMME_IMAGE_QUALITY, or PNG when they
+    have transparency); filename then gets the matching extension. content is
+    None for images kept byte for byte.
+    """
+    from PIL import Image, ImageOps
+
+    upright = ImageOps.exif_transpose(img)
+    upright.load()
+    if not needs_normalizing(img):
+        return None, upright, filename
+
+    max_side = getattr(settings, 'GAMME_IMAGE_MAX_SIDE', 2560)
+    upright.thumbnail((max_side, max_side), Image.LANCZOS)
+    # The ICC profile is colour data, not metadata: keep it
+    options = {'icc_profile': img.info['icc_profile']} if img.info.get('icc_profile') else {}
+    if has_alpha(upright):
+        upright = upright.convert('RGBA')
+        fmt, extension = 'PNG', '.png'
+        options['optimize'] = True
+    else:
+        upright = upright.convert('RGB')
+        fmt, extension = 'JPEG', '.jpg'
+        options.update(quality=getattr(settings, 'GAMME_IMAGE_QUALITY', 85), optimize=True, progressive=True)
+    buffer = BytesIO()
+    upright.save(buffer, fmt, **options)
+    return ContentFile(buffer.getvalue()), upright, os.path.splitext(filename)[0] + extension
+
+
+# Columns of the photo models filled by image_metadata()
+IMAGE_METADATA_FIELDS = ('width', 'height', 'file_size', 'mime_type', 'sha256')
+
+# Models whose metadata columns are prefixed, the image not being the row itself
+IMAGE_METADATA_PREFIXES = {GammeControle: 'photo_non_conforme_'}
+
+
+def image_metadata_columns(model):
+    """{image_metadata() key: column} of the model, empty when it has no such columns."""
+    prefix = IMAGE_METADATA_PREFIXES.get(model, '')
+    fields = {field.name for field in model._meta.concrete_fields}
+    return {key: prefix + key for key in IMAGE_METADATA_FIELDS if prefix + key in fields}
+
+
+def image_metadata(upright, content, name, original_format):
+    """Dimensions, byte size, MIME type and SHA-256 of a stored image, for the photo model columns."""
+    from PIL import Image
+
+    return {
+        'width': upright.width,
+        'height': upright.height,
+        'file_size': content.size,
+        'mime_type': mimetypes.guess_type(name)[0] or Image.MIME.get(original_format, ''),
+        # Blob names already are the content hash
+        'sha256': blob_sha256(name) or content_sha256(content),
+    }
+
+
+def stored_image_metadata(name, storage=None):
+    """image_metadata() of an already stored image, read from its header only."""
+    from PIL import Image
+
+    storage = storage or default_storage
+    with storage.open(name, 'rb') as f, Image.open(f) as img:
+        width, height = img.size
+        if img.getexif().get(ORIENTATION, 1) in (5, 6, 7, 8):
+            # Shown rotated by a quarter turn
+            width, height = height, width
+        return {
+            'width': width,
+            'height': height,
+            'file_size': storage.size(name),
+            'mime_type': mimetypes.guess_type(name)[0] or Image.MIME.get(img.format, ''),
+            'sha256': blob_sha256(name) or content_sha256(File(f)),
+        }
+
+
+def set_image_metadata(instance, metadata):
+    """Copy image_metadata() onto the model instance, for models that have these columns."""
+    columns = image_metadata_columns(type(instance))
+    for key, value in metadata.items():
+        if key in columns:
+            setattr(instance, columns[key], value)
+
+
+def original_name(source, filename):
+    """Storage name of the camera original kept next to a normalized image."""
+    return f'originals/{source}{os.path.splitext(filename)[1].lower()}'
+
+
+def keep_original(source, upload, filename):
+    """
+    Store the upload as it arrived, when GAMME_IMAGE_KEEP_ORIGINAL is on, and
+    return its unsaved ImageDerivative row (size 'original'), else None.
+    """
+    if not getattr(settings, 'GAMME_IMAGE_KEEP_ORIGINAL', False):
+        return None
+    if ImageDerivative.objects.filter(source=source, size='original').exists():
+        # Same normalized image uploaded before: its original is already kept
+        return None
+    upload.seek(0)
+    name = default_storage.save(original_name(source, filename), upload)
+    return ImageDerivative(source=source, size='original', format='original', file=name, width=0, height=0)
+
+
+def _ingest_one(instance, field_name, upload, filename):
+    """Validate, normalize and store one upload. Runs in a worker thread."""
+    from PIL import Image, UnidentifiedImageError
+
+    try:
+        validate_image_file_extension(upload)
+        if upload.size > _max_bytes():
+            raise ValidationError(f'File larger than {_max_bytes() // (1024 * 1024)} MB')
+        try:
+            img = Image.open(upload)
+            img.load()
+        except (UnidentifiedImageError, OSError, Image.DecompressionBombError) as e:
+            raise ValidationError(f'Invalid image: {str(e)}')
+
+        content, upright, filename = normalize_image(img, filename)
+        if content is None:
+            upload.seek(0)
+            content = upload
+        field = getattr(instance, field_name)
+        name = field.storage.save(field.field.generate_filename(instance, filename), content)
+        field.name = name
+        set_image_metadata(instance, image_metadata(upright, content, name, img.format))
+        derivatives = []
+        if content is not upload:
+            original = keep_original(name, upload, upload.name)
+            if original is not None:
+                derivatives.append(original)
+        return {'instance': instance, 'derivatives': derivatives, 'upright': upright, 'error': None}
+    except ValidationError as e:
+        return {'instance': instance, 'derivatives': [], 'error': ' '.join(e.messages)}
+    except Exception as e:
+        logger.error(f'Error ingesting {upload.name}: {str(e)}', exc_info=True)
+        return {'instance': instance, 'derivatives': [], 'error': str(e)}
+
+
+def _render_derivatives(name, upright):
+    """render_derivatives() of a stored upload. Runs in a worker thread."""
+    try:
+        return render_derivatives(upright, name)
+    except Exception as e:
+        # The photo is usable without derivatives (build_image_derivatives can redo them)
+        logger.warning(f'Could not build derivatives of {name}: {str(e)}')
+        return []
+
+
+def ingest_images(model, field_name, items):
+    """
+    Store a batch of uploaded images and insert their rows in bulk.
+
+    `items` is a list of (unsaved instance, uploaded file, target filename).
+    Returns one dict per item, in order: {'instance', 'upload', 'error'},
+    where instance has a primary key when error is None.
+    """
+    workers = max(1, min(getattr(settings, 'GAMME_INGEST_WORKERS', 4), len(items)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(lambda item: _ingest_one(item[0], field_name, item[1], item[2]), items))
+        stored = [r for r in results if r['error'] is None]
+
+        # Derivatives once per image: a blob uploaded before, or twice in the batch, has its own
+        firsts = {}
+        for r in stored:
+            firsts.setdefault(getattr(r['instance'], field_name).name, r)
+        existing = has_derivatives(list(firsts))
+        pending = [(name, r) for name, r in firsts.items() if name not in existing]
+        rendered = pool.map(lambda item: _render_derivatives(item[0], item[1]['upright']), pending)
+        for (name, r), derivatives in zip(pending, rendered):
+            r['derivatives'].extend(derivatives)
+    for r in stored:
+        del r['upright']
+    for result, (_, upload, _) in zip(results, items):
+        result['upload'] = upload
+
+    try:
+        with transaction.atomic():
+            model.objects.bulk_create([r['instance'] for r in stored])
+            # bulk_create sends no post_save: count the blob references here
+            incref([getattr(r['instance'], field_name).name for r in stored])
+            ImageDerivative.objects.bulk_create(
+                [d for r in stored for d in r['derivatives']], ignore_conflicts=True
+            )
+    except Exception:
+        # No new row points at the files written above (identical blobs may be in use elsewhere)
+        for r in stored:
+            try:
+                if discard(getattr(r['instance'], field_name).name):
+                    for d in r['derivatives']:
+                        default_storage.delete(d.file.name)
+            except Exception:
+                pass
+        raise
+    return results
+
+
+def store_image(instance, field_name, upload):
+    """
+    Validate, normalize and store one upload for an unsaved row, ahead of the
+    transaction that saves it: the instance gets the stored name and the
+    metadata columns. Returns the file's result as ingest_images() does; the
+    caller saves its 'derivatives' rows with the row, or discards the file
+    when the row is not saved. Web derivatives follow the row's commit (see
+    signals.build_image_derivatives).
+    """
+    result = _ingest_one(instance, field_name, upload, upload.name)
+    result.pop('upright', None)
+    result['upload'] = upload
+    return result
+
+
+def upload_result(result, field_name):
+    """JSON-friendly per-file outcome of ingest_images."""
+    if result['error'] is not None:
+        return {'name': result['upload'].name, 'success': False, 'error': result['error']}
+    instance = result['instance']
+    return {
+        'name': result['upload'].name,
+        'success': True,
+        'id': instance.id,
+        'url': getattr(instance, field_name).url,
+        'width': getattr(instance, 'width', None),
+        'height': getattr(instance, 'height', None),
+    }
@@ -0,0 +1,55 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from Gamme.ingest import image_metadata_columns, stored_image_metadata
+from Gamme.signals import IMAGE_FIELDS
+
+
+class Command(BaseCommand):
+    help = (
+        'Fill the width, height, file_size, mime_type and sha256 columns of photos, '
+        'EPI and moyen de contrôle pictures and non-conformity photos uploaded '
+        'before they were recorded at upload time.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=8,
+                            help='Image headers read in parallel')
+        parser.add_argument('--force', action='store_true',
+                            help='Recompute the metadata of every photo')
+
+    def handle(self, *args, **options):
+        # {model: (image field, {metadata key: column})}
+        models = {model: (field, image_metadata_columns(model)) for model, field in IMAGE_FIELDS.items()}
+        names = set()
+        for model, (field, columns) in models.items():
+            rows = model.objects.exclude(**{field: ''}).exclude(**{f'{field}__isnull': True})
+            if not options['force']:
+                rows = rows.filter(Q(**{f'{columns["width"]}__isnull': True}) | Q(**{columns['sha256']: ''}))
+            names.update(rows.values_list(field, flat=True).distinct().iterator())
+
+        def work(name):
+            try:
+                return name, stored_image_metadata(name), None
+            except Exception as e:
+                return name, None, e
+
+        updated = failed = 0
+        with ThreadPoolExecutor(max_workers=max(1, options['workers'])) as pool:
+            for name, metadata, error in pool.map(work, sorted(names)):
+                if error is not None:
+                    failed += 1
+                    self.stderr.write(self.style.ERROR(f'{name}: {str(error)}'))
+                    continue
+                for model, (field, columns) in models.items():
+                    updated += model.objects.filter(**{field: name}).update(
+                        **{columns[key]: value for key, value in metadata.items()}
+                    )
+                if options['verbosity'] > 1:
+                    self.stdout.write(f'{name}: {metadata["width"]}x{metadata["height"]}, {metadata["file_size"]} bytes')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'{len(names)} image(s) read, {updated} row(s) updated, {failed} failed'
+        ))
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand
+
+from Gamme.images import DERIVATIVE_FORMATS, DERIVATIVE_SIZES, build_derivatives
+from Gamme.models import ImageDerivative
+from Gamme.signals import IMAGE_FIELDS
+
+
+class Command(BaseCommand):
+    help = (
+        'Generate the thumb/card/print WebP and JPEG derivatives of images uploaded '
+        'before the derivative pipeline existed (new uploads get them automatically).'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true',
+                            help='Rebuild derivatives that already exist')
+
+    def handle(self, *args, **options):
+        expected = len(DERIVATIVE_SIZES) * len(DERIVATIVE_FORMATS)
+        complete = set()
+        if not options['force']:
+            counts = {}
+            for source in ImageDerivative.objects.filter(size__in=DERIVATIVE_SIZES).values_list('source', flat=True):
+                counts[source] = counts.get(source, 0) + 1
+            complete = {source for source, count in counts.items() if count >= expected}
+
+        built = failed = 0
+        seen = set()
+        for model, field in IMAGE_FIELDS.items():
+            names = model.objects.exclude(**{field: ''}).exclude(**{f'{field}__isnull': True}) \
+                .values_list(field, flat=True).distinct()
+            for name in names.iterator():
+                if name in seen or name in complete:
+                    continue
+                seen.add(name)
+                try:
+                    build_derivatives(name)
+                except Exception as e:
+                    failed += 1
+                    self.stderr.write(self.style.ERROR(f'{name}: {str(e)}'))
+                    continue
+                built += 1
+                if options['verbosity'] > 1:
+                    self.stdout.write(f'Built derivatives of {name}')
+
+        self.stdout.write(self.style.SUCCESS(f'{built} image(s) processed, {failed} failed'))
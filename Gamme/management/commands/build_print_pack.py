@@ -0,0 +1,52 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from Gamme.print_pack import PACK_FORMATS, build_print_pack, pack_missions
+
+
+class Command(BaseCommand):
+    help = (
+        'Write the gammes of several missions to one merged PDF or a ZIP. '
+        'Out of date mission PDFs are re-rendered in parallel, the others are reused.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help='Path of the file to write')
+        parser.add_argument('--mission', type=int, action='append', dest='missions',
+                            help='Mission id to include (repeatable)')
+        parser.add_argument('--client', help='Only missions of this client')
+        parser.add_argument('--section', help='Only missions of this section')
+        parser.add_argument('--format', choices=PACK_FORMATS,
+                            help='Pack format (default: from the output extension, else pdf)')
+        parser.add_argument('--processes', type=int, default=os.cpu_count() or 1,
+                            help='Number of worker processes')
+
+    def handle(self, *args, **options):
+        if not (options['missions'] or options['client'] or options['section']):
+            raise CommandError('Select missions with --mission, --client or --section')
+
+        output = options['output']
+        fmt = options['format'] or ('zip' if output.lower().endswith('.zip') else 'pdf')
+        missions = pack_missions(options['missions'], options['client'], options['section'])
+        total = missions.count()
+        if not total:
+            raise CommandError('No mission with a gamme matches')
+
+        self.stdout.write(f'Building a {fmt} pack of {total} mission(s)...')
+        tmp_output = output + '.part'
+        try:
+            with open(tmp_output, 'wb') as out:
+                packed, failures = build_print_pack(missions, out, fmt, options['processes'])
+        except BaseException:
+            if os.path.exists(tmp_output):
+                os.remove(tmp_output)
+            raise
+
+        for mission, error in failures:
+            self.stderr.write(self.style.ERROR(f'Mission {mission.code}: {error}'))
+        if not packed:
+            os.remove(tmp_output)
+            raise CommandError('No PDF could be generated')
+        os.replace(tmp_output, output)
+        self.stdout.write(self.style.SUCCESS(f'{len(packed)} mission(s) written to {output}'))
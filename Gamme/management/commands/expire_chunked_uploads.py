@@ -0,0 +1,25 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from Gamme.chunked_upload import expire_uploads
+
+
+class Command(BaseCommand):
+    help = (
+        'Delete resumable uploads that were abandoned (not completed and not touched '
+        'for --max-age-hours) together with their temporary files.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-age-hours', type=float,
+                            default=getattr(settings, 'GAMME_CHUNKED_UPLOAD_MAX_AGE', 24 * 3600) / 3600,
+                            help='Expire uploads idle for longer than this')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Report what would be deleted without deleting it')
+
+    def handle(self, *args, **options):
+        uploads, strays = expire_uploads(options['max_age_hours'] * 3600, dry_run=options['dry_run'])
+        prefix = 'Would delete' if options['dry_run'] else 'Deleted'
+        self.stdout.write(self.style.SUCCESS(
+            f'{prefix} {uploads} expired upload(s) and {strays} stray temporary file(s)'
+        ))
@@ -0,0 +1,108 @@
+from datetime import timedelta
+from itertools import islice
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from Gamme.models import MissionControle
+from Gamme.pdf_store import blob_name, file_sha256, is_blob_name, iter_stored_pdfs, store_pdf
+
+
+def _batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+class Command(BaseCommand):
+    help = (
+        'Reclaim space in media/gammes_pdf. Referenced legacy PDFs are moved to the '
+        'content-addressed layout (duplicates collapse to one blob), and files no mission '
+        'points at are deleted once older than the grace period.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Report what would be done without touching files or rows')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of files checked per database query')
+        parser.add_argument('--grace-hours', type=float, default=24,
+                            help='Keep unreferenced files younger than this (renders in progress)')
+
+    def _referenced(self, names):
+        return set(MissionControle.objects.filter(pdf_file__in=names).values_list('pdf_file', flat=True))
+
+    def _size(self, name):
+        try:
+            return default_storage.size(name)
+        except OSError:
+            return 0
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        cutoff = timezone.now() - timedelta(hours=options['grace_hours'])
+        counts = {'kept': 0, 'migrated': 0, 'duplicates': 0, 'deleted': 0, 'recent': 0}
+        reclaimed = 0
+        blobs, moved = set(), set()
+
+        # Listing first: the loop below adds blobs under the same directory
+        names = list(iter_stored_pdfs())
+        for batch in _batches(names, max(1, options['batch_size'])):
+            referenced = self._referenced(batch)
+            deletable = []
+            for name in batch:
+                if name in referenced:
+                    if is_blob_name(name):
+                        counts['kept'] += 1
+                        continue
+                    # Legacy name: point its missions at the content-addressed blob
+                    with default_storage.open(name, 'rb') as f:
+                        blob = blob_name(file_sha256(f))
+                        if blob in blobs or default_storage.exists(blob):
+                            counts['duplicates'] += 1
+                        else:
+                            # Its bytes live on in the new blob
+                            moved.add(name)
+                            if not dry_run:
+                                store_pdf(f)
+                    blobs.add(blob)
+                    if dry_run:
+                        self.stdout.write(f'Would migrate {name} -> {blob}')
+                    else:
+                        MissionControle.objects.filter(pdf_file=name).update(pdf_file=blob)
+                        if options['verbosity'] > 1:
+                            self.stdout.write(f'Migrated {name} -> {blob}')
+                    counts['migrated'] += 1
+                    deletable.append(name)
+                elif default_storage.get_modified_time(name) > cutoff:
+                    counts['recent'] += 1
+                else:
+                    deletable.append(name)
+
+            # Checked again right before deleting: a mission may have been saved meanwhile
+            if not dry_run:
+                still_referenced = self._referenced(deletable)
+                deletable = [name for name in deletable if name not in still_referenced]
+            for name in deletable:
+                size = self._size(name)
+                if dry_run:
+                    self.stdout.write(f'Would delete {name} ({size} bytes)')
+                else:
+                    default_storage.delete(name)
+                    if options['verbosity'] > 1:
+                        self.stdout.write(f'Deleted {name}')
+                counts['deleted'] += 1
+                if name not in moved:
+                    reclaimed += size
+
+        prefix = 'Dry run: ' if dry_run else ''
+        self.stdout.write(self.style.SUCCESS(
+            f'{prefix}{len(names)} file(s) checked: {counts["kept"]} kept, '
+            f'{counts["migrated"]} migrated ({counts["duplicates"]} duplicates), '
+            f'{counts["deleted"]} deleted ({reclaimed / 1024 / 1024:.1f} MB), '
+            f'{counts["recent"]} unreferenced but recent'
+        ))
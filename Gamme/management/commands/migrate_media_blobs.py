@@ -0,0 +1,160 @@
+import re
+from collections import Counter
+from itertools import islice
+
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from Gamme.media_blobs import blob_name, blob_name_for, blob_sha256, blob_storage, incref, is_blob_name, link_or_copy
+from Gamme.models import ImageDerivative, MediaBlob
+from Gamme.signals import IMAGE_FIELDS
+
+# Blobs of the first, single-level layout: blobs/<sha[:2]>/<sha256><ext>
+FLAT_BLOB_NAME_RE = re.compile(r'^blobs/([0-9a-f]{2})/([0-9a-f]{64})(\.[a-z0-9]{1,10})?$')
+
+
+def _batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+class Command(BaseCommand):
+    help = (
+        'Move images stored outside the current blob layout (legacy uploads and blobs '
+        'of the single-level layout) into blobs/<sha[:2]>/<sha[2:4]>/, duplicates '
+        'collapsing to one file, then recount the references of every blob. Works in '
+        'batches, each rewritten in one transaction, so an interrupted run is resumed '
+        'by running it again. Also repairs reference counts after queryset updates.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Report what would be done without touching files or rows')
+        parser.add_argument('--batch-size', type=int, default=200,
+                            help='Number of files moved per transaction')
+
+    def _names(self, model, field):
+        return model.objects.exclude(**{field: ''}).exclude(**{f'{field}__isnull': True}) \
+            .values_list(field, flat=True)
+
+    def _store(self, name, dry_run, seen):
+        """
+        Put the content of `name` at its blob name, leaving `name` in place.
+        Returns (blob name, bytes saved by deduplication).
+        """
+        size = default_storage.size(name)
+        match = FLAT_BLOB_NAME_RE.match(name)
+        if match:
+            # Already content-addressed: no need to read it
+            blob = blob_name(match.group(2), match.group(3) or '')
+        else:
+            with default_storage.open(name, 'rb') as f:
+                blob = blob_name_for(File(f, name))
+        duplicate = size if blob in seen or blob_storage.exists(blob) else 0
+        seen.add(blob)
+        if dry_run or duplicate:
+            return blob, duplicate
+
+        # Same filesystem: the move costs no copy
+        link_or_copy(default_storage.path(name), blob_storage.path(blob))
+        return blob, duplicate
+
+    def _repoint(self, moves):
+        """Point every row, blob count and derivative at the new names in one transaction."""
+        stale = []
+        with transaction.atomic():
+            for old, new in moves.items():
+                rows = 0
+                for model, field in IMAGE_FIELDS.items():
+                    # Queryset update: the reference moves in bulk below
+                    rows += model.objects.filter(**{field: old}).update(**{field: new})
+                # Same sha256 as the new name: dropped before the new row is counted
+                MediaBlob.objects.filter(name=old).delete()
+                # Counts stay right between batches, should the run be interrupted
+                incref([new] * rows)
+                derivatives = ImageDerivative.objects.filter(source=old)
+                if ImageDerivative.objects.filter(source=new).exists():
+                    stale += list(derivatives.values_list('file', flat=True))
+                    derivatives.delete()
+                else:
+                    derivatives.update(source=new)
+        # Only once committed: a failed batch leaves every old file in place
+        for name in stale + list(moves):
+            default_storage.delete(name)
+
+    def _recount(self, dry_run):
+        counts = Counter()
+        for model, field in IMAGE_FIELDS.items():
+            for name in self._names(model, field).iterator():
+                if is_blob_name(name):
+                    counts[name] += 1
+
+        fixed = released = 0
+        blobs = {blob.name: blob for blob in MediaBlob.objects.all()}
+        for name, count in counts.items():
+            blob = blobs.pop(name, None)
+            if blob is not None and blob.refcount == count:
+                continue
+            fixed += 1
+            if dry_run:
+                continue
+            if blob is None:
+                try:
+                    size = blob_storage.size(name)
+                except OSError:
+                    size = 0
+                MediaBlob.objects.create(name=name, sha256=blob_sha256(name), size=size, refcount=count)
+            else:
+                MediaBlob.objects.filter(pk=blob.pk).update(refcount=count)
+
+        # Blobs no row points at any more
+        for name, blob in blobs.items():
+            released += 1
+            if dry_run:
+                continue
+            derivatives = ImageDerivative.objects.filter(source=name)
+            for path in list(derivatives.values_list('file', flat=True)) + [name]:
+                default_storage.delete(path)
+            derivatives.delete()
+            blob.delete()
+        return fixed, released
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        legacy = set()
+        for model, field in IMAGE_FIELDS.items():
+            legacy.update(name for name in self._names(model, field).distinct().iterator() if not is_blob_name(name))
+
+        migrated = missing = saved = 0
+        seen = set()
+        for batch in _batches(sorted(legacy), max(1, options['batch_size'])):
+            moves = {}
+            for name in batch:
+                try:
+                    blob, duplicate = self._store(name, dry_run, seen)
+                except FileNotFoundError:
+                    missing += 1
+                    if options['verbosity'] > 1:
+                        self.stderr.write(f'Missing file: {name}')
+                    continue
+                moves[name] = blob
+                saved += duplicate
+                if options['verbosity'] > 1:
+                    self.stdout.write(f'{name} -> {blob}')
+            if not dry_run:
+                self._repoint(moves)
+            migrated += len(moves)
+
+        fixed, released = self._recount(dry_run)
+        prefix = 'Would migrate' if dry_run else 'Migrated'
+        self.stdout.write(self.style.SUCCESS(
+            f'{prefix} {migrated} legacy image(s) ({missing} missing file(s), '
+            f'{saved / (1024 * 1024):.1f} MB of duplicates); '
+            f'{fixed} reference count(s) corrected, {released} unreferenced blob(s) deleted'
+        ))
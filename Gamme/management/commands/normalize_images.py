@@ -0,0 +1,115 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from Gamme.images import render_derivatives
+from Gamme.ingest import image_metadata, image_metadata_columns, keep_original, normalize_image
+from Gamme.media_blobs import blob_storage, decref, incref, is_blob_name
+from Gamme.models import ImageDerivative
+from Gamme.signals import IMAGE_FIELDS
+
+
+def _normalize(name, dry_run):
+    """
+    Normalize one stored image. Runs in a worker thread and touches storage
+    only. Returns None when the image is already normalized, else
+    (new name, bytes before, bytes after, unsaved ImageDerivative rows, metadata).
+    """
+    from PIL import Image
+
+    with default_storage.open(name, 'rb') as f:
+        size = default_storage.size(name)
+        with Image.open(f) as img:
+            img.load()
+            content, upright, filename = normalize_image(img, name)
+        if content is None:
+            return None
+        if dry_run:
+            return name, size, content.size, [], {}
+        new_name = blob_storage.save(filename, content)
+        metadata = image_metadata(upright, content, new_name, img.format)
+        derivatives = render_derivatives(upright, new_name)
+        original = keep_original(new_name, f, name)
+        if original is not None:
+            derivatives.append(original)
+    return new_name, size, content.size, derivatives, metadata
+
+
+class Command(BaseCommand):
+    help = (
+        'Normalize images stored before ingest-time normalization: apply EXIF '
+        'orientation, cap the longest side, strip metadata and re-encode, following '
+        'the GAMME_IMAGE_* settings. Rows are pointed at the new files.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4,
+                            help='Images decoded and re-encoded in parallel')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Report the savings without writing anything')
+
+    def _names(self):
+        names = set()
+        for model, field in IMAGE_FIELDS.items():
+            names.update(
+                model.objects.exclude(**{field: ''}).exclude(**{f'{field}__isnull': True})
+                .values_list(field, flat=True).distinct().iterator()
+            )
+        return sorted(names)
+
+    def _repoint(self, old, new, derivatives, metadata):
+        with transaction.atomic():
+            rows = 0
+            for model, field in IMAGE_FIELDS.items():
+                # Queryset update: the references move in bulk below
+                values = {field: new}
+                columns = image_metadata_columns(model)
+                values.update({columns[key]: value for key, value in metadata.items()})
+                rows += model.objects.filter(**{field: old}).update(**values)
+            incref([new] * rows)
+            ImageDerivative.objects.bulk_create(derivatives, ignore_conflicts=True)
+            # Releases the old blob (and its derivatives) once the last row moved
+            decref([old] * rows)
+        if not is_blob_name(old):
+            # Files from before the blob layout have no reference count
+            stale = ImageDerivative.objects.filter(source=old)
+            for path in list(stale.values_list('file', flat=True)) + [old]:
+                default_storage.delete(path)
+            stale.delete()
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        names = self._names()
+        converted = failed = 0
+        before = after = 0
+
+        def work(name):
+            try:
+                return name, _normalize(name, dry_run), None
+            except Exception as e:
+                return name, None, e
+
+        with ThreadPoolExecutor(max_workers=max(1, options['workers'])) as pool:
+            for name, result, error in pool.map(work, names):
+                if error is not None:
+                    failed += 1
+                    self.stderr.write(self.style.ERROR(f'{name}: {str(error)}'))
+                    continue
+                if result is None:
+                    continue
+                new_name, size, new_size, derivatives, metadata = result
+                converted += 1
+                before += size
+                after += new_size
+                if not dry_run and new_name != name:
+                    self._repoint(name, new_name, derivatives, metadata)
+                if options['verbosity'] > 1:
+                    self.stdout.write(f'{name} -> {new_name} ({size} -> {new_size} bytes)')
+
+        prefix = 'Would normalize' if dry_run else 'Normalized'
+        self.stdout.write(self.style.SUCCESS(
+            f'{prefix} {converted} of {len(names)} image(s), {failed} failed: '
+            f'{before / 1024 / 1024:.1f} MB -> {after / 1024 / 1024:.1f} MB'
+        ))
@@ -0,0 +1,181 @@
+import os
+import shutil
+import time
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import islice
+
+from django.apps import apps
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import models
+
+from Gamme.models import MediaBlob
+
+
+def _batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _file_fields():
+    """(model, field name) of every FileField / ImageField of the project."""
+    for model in apps.get_models():
+        for field in model._meta.concrete_fields:
+            if isinstance(field, models.FileField):
+                yield model, field.attname
+
+
+def _scan_directory(root, relative):
+    """List one directory: (files as (name, size, mtime), subdirectories)."""
+    files, directories = [], []
+    with os.scandir(os.path.join(root, relative)) as entries:
+        for entry in entries:
+            name = f'{relative}/{entry.name}' if relative else entry.name
+            if entry.is_dir(follow_symlinks=False):
+                directories.append(name)
+            elif entry.is_file(follow_symlinks=False):
+                stat = entry.stat(follow_symlinks=False)
+                files.append((name, stat.st_size, stat.st_mtime))
+    return files, directories
+
+
+def scan_media(root, workers):
+    """
+    Yield (name, size, mtime) of every file under root, names relative to root
+    with '/' separators. Directories are listed in parallel, each worker
+    queueing the subdirectories it finds.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {pool.submit(_scan_directory, root, '')}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, directories = future.result()
+                for directory in directories:
+                    pending.add(pool.submit(_scan_directory, root, directory))
+                yield from files
+
+
+class Command(BaseCommand):
+    help = (
+        'Find files under MEDIA_ROOT that no FileField/ImageField of any model '
+        'references (leftovers of deleted rows and of old upload_to bugs) and report '
+        'them, or move them to the quarantine directory with --apply.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--apply', action='store_true',
+                            help='Move orphans to the quarantine directory (default: report only)')
+        parser.add_argument('--older-than', type=float, default=24,
+                            help='Only treat files not modified for this many hours as orphans')
+        parser.add_argument('--quarantine', default=getattr(settings, 'GAMME_MEDIA_QUARANTINE_DIR', None),
+                            help='Where orphans are moved, keeping their relative path')
+        parser.add_argument('--workers', type=int, default=8,
+                            help='Threads listing directories')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of orphans re-checked per database query before moving')
+
+    def _referenced(self):
+        referenced = set()
+        for model, field in _file_fields():
+            names = model._default_manager.exclude(**{field: ''}).exclude(**{f'{field}__isnull': True}) \
+                .values_list(field, flat=True)
+            referenced.update(names.iterator())
+        referenced.update(MediaBlob.objects.values_list('name', flat=True).iterator())
+        return referenced
+
+    def _still_referenced(self, names):
+        referenced = set()
+        for model, field in _file_fields():
+            referenced.update(model._default_manager.filter(**{f'{field}__in': names}).values_list(field, flat=True))
+        referenced.update(MediaBlob.objects.filter(name__in=names).values_list('name', flat=True))
+        return referenced
+
+    def _move(self, root, quarantine, name):
+        target = os.path.join(quarantine, name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # shutil.move falls back to copy + delete across filesystems
+        shutil.move(os.path.join(root, name), target)
+
+    def _prune_empty_directories(self, root, directories):
+        removed = 0
+        # Deepest first, so that parents emptied by their children go too
+        for directory in sorted(directories, key=lambda d: d.count('/'), reverse=True):
+            path = os.path.join(root, directory)
+            try:
+                os.rmdir(path)
+                removed += 1
+            except OSError:
+                pass
+        return removed
+
+    def handle(self, *args, **options):
+        root = os.path.abspath(settings.MEDIA_ROOT)
+        quarantine = options['quarantine'] or os.path.join(settings.BASE_DIR, 'media_quarantine')
+        quarantine = os.path.abspath(quarantine)
+        cutoff = time.time() - options['older_than'] * 3600
+        verbosity = options['verbosity']
+
+        referenced = self._referenced()
+        scanned = scanned_bytes = recent = 0
+        orphans = []
+        for name, size, mtime in scan_media(root, max(1, options['workers'])):
+            if os.path.join(root, name).startswith(quarantine + os.sep):
+                continue
+            scanned += 1
+            scanned_bytes += size
+            if name in referenced:
+                continue
+            if mtime > cutoff:
+                recent += 1
+                continue
+            orphans.append((name, size))
+
+        by_directory = defaultdict(lambda: [0, 0])
+        moved = moved_bytes = 0
+        for batch in _batches(orphans, max(1, options['batch_size'])):
+            if options['apply']:
+                # Checked again right before moving: a row may have been saved meanwhile
+                still_referenced = self._still_referenced([name for name, _ in batch])
+                batch = [(name, size) for name, size in batch if name not in still_referenced]
+            for name, size in batch:
+                totals = by_directory[os.path.dirname(name) or '.']
+                totals[0] += 1
+                totals[1] += size
+                if not options['apply']:
+                    if verbosity > 1:
+                        self.stdout.write(f'Orphan {name} ({size} bytes)')
+                    continue
+                try:
+                    self._move(root, quarantine, name)
+                except OSError as e:
+                    self.stderr.write(self.style.ERROR(f'{name}: {str(e)}'))
+                    continue
+                moved += 1
+                moved_bytes += size
+                if verbosity > 1:
+                    self.stdout.write(f'Quarantined {name}')
+
+        # Largest directories first; all of them at verbosity 2
+        ranked = sorted(by_directory.items(), key=lambda item: -item[1][1])
+        for directory, (count, size) in ranked if verbosity > 1 else ranked[:20]:
+            self.stdout.write(f'{directory}: {count} orphan(s), {size / 1024 / 1024:.1f} MB')
+
+        orphan_bytes = sum(size for _, size in orphans)
+        summary = (
+            f'{scanned} file(s) scanned ({scanned_bytes / 1024 / 1024:.1f} MB): '
+            f'{len(orphans)} orphan(s) ({orphan_bytes / 1024 / 1024:.1f} MB), '
+            f'{recent} unreferenced but recent'
+        )
+        if options['apply']:
+            pruned = self._prune_empty_directories(root, {os.path.dirname(name) for name, _ in orphans if '/' in name})
+            summary += (
+                f'; {moved} moved to {quarantine} ({moved_bytes / 1024 / 1024:.1f} MB), '
+                f'{pruned} empty director(ies) removed'
+            )
+        self.stdout.write(self.style.SUCCESS(summary))
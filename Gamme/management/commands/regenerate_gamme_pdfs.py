@@ -0,0 +1,102 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, time as dtime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from Gamme.models import MissionControle
+from Gamme.pdf_jobs import init_worker_process
+
+
+def _regenerate(mission_id, force):
+    from Gamme.pdf_jobs import regenerate_mission_pdf
+    try:
+        return mission_id, regenerate_mission_pdf(mission_id, force=force), ''
+    except Exception as e:
+        return mission_id, 'failed', str(e)
+
+
+class Command(BaseCommand):
+    help = (
+        'Regenerate the stored mission PDFs in parallel. Missions whose gamme content '
+        'fingerprint is unchanged since the last render are skipped, so an interrupted '
+        'run resumes where it stopped. Bump GAMME_PDF_CACHE_VERSION to force a full '
+        'regeneration after a logo change.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mission', type=int, action='append', dest='missions',
+                            help='Mission id to regenerate (repeatable)')
+        parser.add_argument('--client', help='Only missions of this client')
+        parser.add_argument('--since',
+                            help='Only missions or gammes modified since this date (YYYY-MM-DD or ISO datetime)')
+        parser.add_argument('--processes', type=int, default=os.cpu_count() or 1,
+                            help='Number of worker processes')
+        parser.add_argument('--force', action='store_true',
+                            help='Render even when the fingerprint is unchanged')
+
+    def _parse_since(self, value):
+        since = parse_datetime(value)
+        if since is None:
+            day = parse_date(value)
+            if day is None:
+                raise CommandError(f'Invalid --since value: {value}')
+            since = datetime.combine(day, dtime.min)
+        if timezone.is_naive(since):
+            since = timezone.make_aware(since)
+        return since
+
+    def handle(self, *args, **options):
+        missions = MissionControle.objects.all()
+        if options['missions']:
+            missions = missions.filter(id__in=options['missions'])
+        if options['client']:
+            missions = missions.filter(client=options['client'])
+        if options['since']:
+            since = self._parse_since(options['since'])
+            missions = missions.filter(Q(date_mise_a_jour__gte=since) | Q(gammes__date_mise_a_jour__gte=since))
+        mission_ids = list(missions.filter(gammes__isnull=False).distinct().order_by('id').values_list('id', flat=True))
+
+        total = len(mission_ids)
+        if not total:
+            self.stdout.write('No mission to regenerate')
+            return
+
+        processes = max(1, min(options['processes'], total))
+        self.stdout.write(f'Checking {total} mission(s) with {processes} process(es)...')
+
+        counts = {'rendered': 0, 'skipped': 0, 'no_gamme': 0, 'failed': 0}
+        failures = []
+        start = time.monotonic()
+        pool = ProcessPoolExecutor(max_workers=processes, initializer=init_worker_process)
+        try:
+            futures = [pool.submit(_regenerate, mission_id, options['force']) for mission_id in mission_ids]
+            for done, future in enumerate(as_completed(futures), 1):
+                mission_id, status, error = future.result()
+                counts[status] += 1
+                if status == 'failed':
+                    failures.append((mission_id, error))
+                    self.stderr.write(self.style.ERROR(f'Mission {mission_id}: {error}'))
+                elif options['verbosity'] > 1:
+                    self.stdout.write(f'Mission {mission_id}: {status}')
+                if done % 50 == 0:
+                    elapsed = time.monotonic() - start
+                    self.stdout.write(f'{done}/{total} checked, {counts["rendered"] / elapsed:.2f} PDFs/sec')
+        except KeyboardInterrupt:
+            pool.shutdown(wait=True, cancel_futures=True)
+            self.stdout.write(self.style.WARNING('Interrupted: run the command again to resume'))
+            raise
+        pool.shutdown()
+
+        elapsed = time.monotonic() - start
+        rate = counts['rendered'] / elapsed if elapsed else 0
+        self.stdout.write(self.style.SUCCESS(
+            f'{counts["rendered"]} rendered, {counts["skipped"]} unchanged, '
+            f'{counts["failed"]} failed in {elapsed:.1f}s ({rate:.2f} PDFs/sec)'
+        ))
+        for mission_id, error in failures:
+            self.stdout.write(f'  mission {mission_id}: {error}')
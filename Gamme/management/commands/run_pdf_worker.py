@@ -0,0 +1,60 @@
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from django.core.management.base import BaseCommand
+
+from Gamme.pdf_jobs import claim_next_job, init_worker_process, requeue_stale_jobs
+
+
+def _run(job_id):
+    from Gamme.pdf_jobs import run_job
+    return job_id, run_job(job_id)
+
+
+class Command(BaseCommand):
+    help = 'Render queued mission PDFs in a pool of worker processes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=os.cpu_count() or 1,
+                            help='Number of worker processes')
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help='Seconds to wait when the queue is empty')
+        parser.add_argument('--stale-after', type=int, default=600,
+                            help='Requeue running jobs older than this many seconds')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit once the queue is drained')
+
+    def handle(self, *args, **options):
+        processes = max(1, options['processes'])
+        requeued = requeue_stale_jobs(options['stale_after'])
+        if requeued:
+            self.stdout.write(self.style.WARNING(f'Requeued {requeued} stale job(s)'))
+        self.stdout.write(f'PDF worker started with {processes} process(es)')
+
+        running = set()
+        with ProcessPoolExecutor(max_workers=processes, initializer=init_worker_process) as pool:
+            try:
+                while True:
+                    # Keep every process busy
+                    while len(running) < processes:
+                        job_id = claim_next_job()
+                        if job_id is None:
+                            break
+                        running.add(pool.submit(_run, job_id))
+
+                    if not running:
+                        if options['once']:
+                            break
+                        time.sleep(options['poll_interval'])
+                        continue
+
+                    done, running = wait(running, timeout=options['poll_interval'], return_when=FIRST_COMPLETED)
+                    for future in done:
+                        try:
+                            job_id, status = future.result()
+                            self.stdout.write(f'Job {job_id}: {status}')
+                        except Exception as e:
+                            self.stderr.write(self.style.ERROR(f'Worker error: {str(e)}'))
+            except KeyboardInterrupt:
+                self.stdout.write('Stopping PDF worker, waiting for running jobs...')
@@ -0,0 +1,59 @@
+from itertools import islice
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from Gamme.cold_storage import archive_blobs, prune_archives, restore_blob, tiering_candidates
+
+
+def _batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+class Command(BaseCommand):
+    help = (
+        'Move the photos referenced only by inactive gamme versions not modified for '
+        '--days days into zip archives (one per batch), bring back archived photos a '
+        'version in use refers to again, and delete archives left without blobs.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=getattr(settings, 'GAMME_MEDIA_COLD_AFTER_DAYS', 180),
+                            help='Age (days since last change) of an inactive version before its photos go cold')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of photos packed per archive')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Report what would be archived or restored without touching anything')
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        to_archive, to_restore = tiering_candidates(options['days'])
+
+        archived = archived_bytes = restored = 0
+        if dry_run:
+            archived = len(to_archive)
+        else:
+            for batch in _batches(to_archive, max(1, options['batch_size'])):
+                archive, count, size = archive_blobs(batch)
+                archived += count
+                archived_bytes += size
+                if archive and options['verbosity'] > 1:
+                    self.stdout.write(f'{archive}: {count} photo(s), {size / 1024 / 1024:.1f} MB')
+
+        for name in to_restore:
+            if dry_run or restore_blob(name):
+                restored += 1
+                if options['verbosity'] > 1:
+                    self.stdout.write(f'Restored {name}')
+
+        pruned, freed = (0, 0) if dry_run else prune_archives()
+        prefix = 'Would archive' if dry_run else 'Archived'
+        self.stdout.write(self.style.SUCCESS(
+            f'{prefix} {archived} photo(s) ({archived_bytes / 1024 / 1024:.1f} MB), '
+            f'restored {restored}, {pruned} empty archive(s) deleted ({freed / 1024 / 1024:.1f} MB)'
+        ))
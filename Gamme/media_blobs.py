@@ -0,0 +1,249 @@
+"""
+Content-addressed, reference-counted storage of uploaded images.
+
+The image fields of the photo models store their files through
+`BlobStorage`: a file is written once under
+blobs/<sha[:2]>/<sha[2:4]>/<sha256><ext> whatever its upload name, so
+identical uploads and the photos copied into a new gamme version share one
+file, and two levels of hashed fan-out keep every directory small. Each
+blob has a MediaBlob row counting the model rows pointing at it. The count
+follows saves and deletes of those models (see signals.py) and bulk inserts
+call `incref` themselves; the file and its derivatives are deleted when the
+count drops to zero.
+
+Files stored before this layout (including blobs of the former single-level
+layout) are left alone until the `migrate_media_blobs` command moves them.
+"""
+import hashlib
+import logging
+import os
+import re
+import shutil
+import uuid
+from collections import Counter
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.db import transaction
+from django.db.models import F
+
+logger = logging.getLogger(__name__)
+
+BLOB_PREFIX = 'blobs'
+
+BLOB_NAME_RE = re.compile(r'^blobs/([0-9a-f]{2})/([0-9a-f]{2})/([0-9a-f]{64})(\.[a-z0-9]{1,10})?$')
+
+
+def blob_name(sha256, extension=''):
+    return f'{BLOB_PREFIX}/{sha256[:2]}/{sha256[2:4]}/{sha256}{extension}'
+
+
+def blob_sha256(name):
+    """Content hash of a blob name, or None for names of another layout."""
+    match = BLOB_NAME_RE.match(name or '')
+    if match and match.group(3).startswith(match.group(1) + match.group(2)):
+        return match.group(3)
+    return None
+
+
+def is_blob_name(name):
+    """True for names of the content-addressed layout (as opposed to legacy uploads)."""
+    return blob_sha256(name) is not None
+
+
+def _extension(name):
+    extension = os.path.splitext(name or '')[1].lower()
+    return extension if re.match(r'^\.[a-z0-9]{1,10}$', extension) else ''
+
+
+def content_sha256(content):
+    """SHA-256 of a Django File, read in chunks."""
+    digest = hashlib.sha256()
+    if hasattr(content, 'seek'):
+        content.seek(0)
+    for chunk in content.chunks():
+        digest.update(chunk)
+    content.seek(0)
+    return digest.hexdigest()
+
+
+def blob_name_for(content, name=None):
+    """Blob name a Django File is stored under."""
+    return blob_name(content_sha256(content), _extension(name or getattr(content, 'name', '')))
+
+
+class BlobStorage(FileSystemStorage):
+    """
+    MEDIA_ROOT storage naming every saved file after its content.
+
+    The directory given by upload_to is ignored and only the extension of the
+    upload name is kept. Saving content that is already stored returns the
+    existing name without writing anything. Blobs moved to cold storage are
+    still opened, sized and found through it.
+    """
+
+    def _open(self, name, mode='rb'):
+        try:
+            return super()._open(name, mode)
+        except FileNotFoundError:
+            from .cold_storage import cold_path
+
+            path = cold_path(name) if 'r' in mode else None
+            if path is None:
+                raise
+            return File(open(path, mode), name)
+
+    def exists(self, name):
+        if super().exists(name):
+            return True
+        from .cold_storage import archived_size
+
+        return archived_size(name) is not None
+
+    def size(self, name):
+        try:
+            return super().size(name)
+        except FileNotFoundError:
+            from .cold_storage import archived_size
+
+            size = archived_size(name)
+            if size is None:
+                raise
+            return size
+
+    def save(self, name, content, max_length=None):
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        name = blob_name_for(content, name)
+        if self.exists(name):
+            return name
+        saved = self._save(name, content)
+        if saved != name:
+            # Another request stored the same blob in the meantime: keep theirs
+            self.delete(saved)
+        return name
+
+
+blob_storage = BlobStorage()
+
+
+# ioctl cloning a file on copy-on-write filesystems (btrfs, XFS), from linux/fs.h
+FICLONE = 0x40049409
+
+
+def link_or_copy(source, target):
+    """
+    Give the immutable file at path `source` a second path `target`, the
+    cheapest way the filesystems allow: a hard link, else a reflink, else a
+    streaming copy (never the whole file in memory). The target appears
+    atomically. Returns 'link', 'reflink' or 'copy'.
+    """
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+        os.link(source, target)
+        return 'link'
+    except FileExistsError:
+        return 'link'
+    except OSError:
+        # Other filesystem, or links not supported
+        pass
+
+    temporary = f'{target}.{uuid.uuid4().hex}.tmp'
+    try:
+        try:
+            import fcntl
+
+            with open(source, 'rb') as src, open(temporary, 'wb') as dest:
+                fcntl.ioctl(dest.fileno(), FICLONE, src.fileno())
+            method = 'reflink'
+        except (ImportError, OSError):
+            # shutil copies in chunks (sendfile on Linux)
+            shutil.copyfile(source, temporary)
+            method = 'copy'
+        os.replace(temporary, target)
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+    return method
+
+
+def get_blob_storage():
+    """Storage of the photo fields (a callable keeps the storage out of the migrations)."""
+    return blob_storage
+
+
+def incref(names):
+    """Add one reference to each blob name of `names` (repeats count), creating missing MediaBlob rows."""
+    from .models import MediaBlob
+
+    counts = Counter(name for name in names if is_blob_name(name))
+    if not counts:
+        return
+    with transaction.atomic():
+        existing = set(MediaBlob.objects.filter(name__in=counts).values_list('name', flat=True))
+        missing = []
+        for name in counts:
+            if name in existing:
+                continue
+            try:
+                size = blob_storage.size(name)
+            except OSError:
+                size = 0
+            missing.append(MediaBlob(name=name, sha256=blob_sha256(name), size=size))
+        MediaBlob.objects.bulk_create(missing, ignore_conflicts=True)
+        # One UPDATE per distinct count, not per name
+        by_count = {}
+        for name, count in counts.items():
+            by_count.setdefault(count, []).append(name)
+        for count, batch in by_count.items():
+            MediaBlob.objects.filter(name__in=batch).update(refcount=F('refcount') + count)
+
+
+def decref(names):
+    """
+    Remove one reference to each blob name of `names`. Blobs left without
+    references are deleted, with their derivatives, once the transaction commits.
+    """
+    from .models import MediaBlob
+
+    counts = Counter(name for name in names if is_blob_name(name))
+    if not counts:
+        return
+    with transaction.atomic():
+        for name, count in counts.items():
+            MediaBlob.objects.filter(name=name, refcount__gte=count).update(refcount=F('refcount') - count)
+            # Counts out of sync (rows written by queryset updates) stop at zero
+            MediaBlob.objects.filter(name=name, refcount__lt=count).update(refcount=0)
+        unreferenced = list(MediaBlob.objects.filter(name__in=counts, refcount__lte=0).values_list('name', flat=True))
+        if unreferenced:
+            MediaBlob.objects.filter(name__in=unreferenced, refcount__lte=0).delete()
+            transaction.on_commit(lambda: _delete_blobs(unreferenced))
+
+
+def _delete_blobs(names):
+    from .models import ImageDerivative, MediaBlob
+
+    # A save may have referenced the same content again since the count hit zero
+    names = set(names) - set(MediaBlob.objects.filter(name__in=names).values_list('name', flat=True))
+    if not names:
+        return
+    derivatives = ImageDerivative.objects.filter(source__in=names)
+    for name in list(derivatives.values_list('file', flat=True)) + sorted(names):
+        try:
+            default_storage.delete(name)
+        except Exception as e:
+            logger.warning(f'Could not delete {name}: {str(e)}')
+    derivatives.delete()
+
+
+def discard(name):
+    """Delete a blob written for a row that was never saved, unless something references it."""
+    from .models import MediaBlob
+
+    if not is_blob_name(name):
+        default_storage.delete(name)
+        return False
+    if MediaBlob.objects.filter(name=name, refcount__gt=0).exists():
+        return False
+    default_storage.delete(name)
+    return True
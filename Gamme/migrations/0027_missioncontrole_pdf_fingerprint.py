@@ -0,0 +1,18 @@
+# Generated by Django 5.2.2 on 2026-10-18 11:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Gamme', '0026_pdfrenderjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='missioncontrole',
+            name='pdf_fingerprint',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.2 on 2026-10-18 11:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Gamme', '0027_missioncontrole_pdf_fingerprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImageDerivative',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('source', models.CharField(db_index=True, max_length=255)),
+                ('size', models.CharField(choices=[('thumb', 'Miniature'), ('card', 'Carte'), ('print', 'Impression')], max_length=10)),
+                ('format', models.CharField(choices=[('webp', 'WebP'), ('jpeg', 'JPEG')], max_length=10)),
+                ('file', models.FileField(max_length=255, upload_to='derivatives/')),
+                ('width', models.PositiveIntegerField()),
+                ('height', models.PositiveIntegerField()),
+                ('date_creation', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': "Dérivé d'image",
+                'verbose_name_plural': "Dérivés d'images",
+                'unique_together': {('source', 'size', 'format')},
+            },
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.2.2 on 2026-10-18 11:35
+
+import django.db.models.deletion
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Gamme', '0028_imagederivative'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChunkedUpload',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('token', models.UUIDField(default=uuid.uuid4, editable=False, unique=True)),
+                ('kind', models.CharField(choices=[('defaut', 'Photo de défaut'), ('acceptable', 'Photo de limite acceptable'), ('operation', "Photo d'opération")], max_length=20)),
+                ('filename', models.CharField(max_length=255)),
+                ('description', models.CharField(blank=True, default='', max_length=255)),
+                ('size', models.BigIntegerField()),
+                ('offset', models.BigIntegerField(default=0)),
+                ('sha256', models.CharField(blank=True, default='', max_length=64)),
+                ('status', models.CharField(choices=[('uploading', 'En cours'), ('complete', 'Terminé')], db_index=True, default='uploading', max_length=20)),
+                ('photo_id', models.IntegerField(blank=True, null=True)),
+                ('date_creation', models.DateTimeField(auto_now_add=True)),
+                ('date_mise_a_jour', models.DateTimeField(auto_now=True)),
+                ('created_by', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunked_uploads', to=settings.AUTH_USER_MODEL)),
+                ('gamme', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='chunked_uploads', to='Gamme.gammecontrole')),
+                ('operation', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='chunked_uploads', to='Gamme.operationcontrole')),
+            ],
+            options={
+                'verbose_name': 'Téléversement par morceaux',
+                'verbose_name_plural': 'Téléversements par morceaux',
+            },
+        ),
+    ]
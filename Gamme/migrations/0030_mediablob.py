@@ -0,0 +1,60 @@
+# Generated by Django 5.2.2 on 2026-10-18 11:39
+
+import Gamme.media_blobs
+import Gamme.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Gamme', '0029_chunkedupload'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MediaBlob',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('sha256', models.CharField(max_length=64, unique=True)),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('size', models.BigIntegerField(default=0)),
+                ('refcount', models.PositiveIntegerField(default=0)),
+                ('date_creation', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'Blob média',
+                'verbose_name_plural': 'Blobs média',
+            },
+        ),
+        migrations.AlterField(
+            model_name='epi',
+            name='photo',
+            field=models.ImageField(storage=Gamme.media_blobs.get_blob_storage, upload_to='photos/epi/'),
+        ),
+        migrations.AlterField(
+            model_name='gammecontrole',
+            name='photo_traitement_non_conforme',
+            field=models.ImageField(blank=True, null=True, storage=Gamme.media_blobs.get_blob_storage, upload_to=Gamme.models.GammeControle.photo_traitement_non_conforme_upload_to),
+        ),
+        migrations.AlterField(
+            model_name='moyens_controle',
+            name='photo',
+            field=models.ImageField(storage=Gamme.media_blobs.get_blob_storage, upload_to='photos/moyens_controle/'),
+        ),
+        migrations.AlterField(
+            model_name='photodefaut',
+            name='image',
+            field=models.ImageField(storage=Gamme.media_blobs.get_blob_storage, upload_to=Gamme.models.photo_defaut_upload_to),
+        ),
+        migrations.AlterField(
+            model_name='photolimiteacceptable',
+            name='image',
+            field=models.ImageField(storage=Gamme.media_blobs.get_blob_storage, upload_to=Gamme.models.photo_defaut_upload_to),
+        ),
+        migrations.AlterField(
+            model_name='photooperation',
+            name='image',
+            field=models.ImageField(storage=Gamme.media_blobs.get_blob_storage, upload_to='photos/'),
+        ),
+    ]
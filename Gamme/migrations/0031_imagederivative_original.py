@@ -0,0 +1,23 @@
+# Generated by Django 5.2.2 on 2026-10-18 11:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Gamme', '0030_mediablob'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='imagederivative',
+            name='format',
+            field=models.CharField(choices=[('webp', 'WebP'), ('jpeg', 'JPEG'), ('original', 'Original')], max_length=10),
+        ),
+        migrations.AlterField(
+            model_name='imagederivative',
+            name='size',
+            field=models.CharField(choices=[('thumb', 'Miniature'), ('card', 'Carte'), ('print', 'Impression'), ('original', 'Original')], max_length=10),
+        ),
+    ]
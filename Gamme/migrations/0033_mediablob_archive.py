@@ -0,0 +1,18 @@
+# Generated by Django 5.2.2 on 2026-10-18 11:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Gamme', '0032_photo_metadata'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mediablob',
+            name='archive',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=100),
+        ),
+    ]
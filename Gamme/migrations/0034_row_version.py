@@ -0,0 +1,23 @@
+# Generated by Django 5.2.2 on 2026-10-18 12:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Gamme', '0033_mediablob_archive'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gammecontrole',
+            name='row_version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='missioncontrole',
+            name='row_version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
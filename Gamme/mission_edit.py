@@ -0,0 +1,81 @@
+"""
+Data of the mission edit page (MissionControleUpdateView).
+
+The page renders the most recently updated gamme version, the one being
+edited, in full. Older versions and the photo galleries of the photo modals
+are fetched as HTML fragments when opened (see the
+missioncontrole_version_panel and gamme_photo_gallery views), so the page
+costs the same whatever the version history.
+
+Details are loaded in a fixed number of queries, whatever the number of
+operations. What the templates need per gamme or per operation is computed
+in one pass over the prefetched rows, so that they never query (no
+aggregate, values_list, .first or non-prefetched relation inside loops).
+"""
+from django.db.models import Prefetch, prefetch_related_objects
+
+from .models import GammeControle, OperationControle, PhotoDefaut, Photolimiteacceptable, moyens_controle
+
+GALLERY_MODELS = {
+    'defaut': PhotoDefaut,
+    'acceptable': Photolimiteacceptable,
+}
+
+
+def load_mission_gammes(mission):
+    """
+    Gamme versions of the mission, newest first. Only the first one, edited
+    on the page, is loaded with its details (see load_gamme_details).
+    """
+    gammes = list(GammeControle.objects.filter(mission=mission).order_by('-date_mise_a_jour'))
+    load_gamme_details(gammes[:1])
+    return gammes
+
+
+def load_gamme_details(gammes):
+    """
+    Prefetch operations (with moyens and photos), validations, EPIs and moyens
+    of the gammes, and set on each:
+
+    - is_active, next_order (order proposed for a new operation)
+    - selected_epi_ids, selected_moyen_ids (sets)
+    - first_validation (or None)
+
+    and on each of their operations selected_moyen_ids (set).
+    """
+    prefetch_related_objects(
+        gammes,
+        Prefetch('operations', queryset=OperationControle.objects.all().prefetch_related(
+            Prefetch('moyenscontrole', queryset=moyens_controle.objects.all().order_by('ordre')),
+            'photooperation_set'
+        )),
+        'validations',
+        'epis',
+        'moyens_controle',
+    )
+    for gamme in gammes:
+        gamme.is_active = gamme.statut
+        operations = list(gamme.operations.all())
+        gamme.next_order = max((op.ordre for op in operations), default=1)
+        gamme.selected_epi_ids = {e.id for e in gamme.epis.all()}
+        gamme.selected_moyen_ids = {m.id for m in gamme.moyens_controle.all()}
+        # Same row as validations.first(): lowest primary key
+        gamme.first_validation = min(gamme.validations.all(), key=lambda v: v.pk, default=None)
+        for op in operations:
+            op.selected_moyen_ids = {m.id for m in op.moyenscontrole.all()}
+    return gammes
+
+
+def gallery_photos(gamme_id, kind):
+    """Defect ('defaut') or acceptable-limit ('acceptable') photos of a gamme, newest first."""
+    return list(GALLERY_MODELS[kind].objects.filter(gamme_id=gamme_id).order_by('-date_ajout'))
+
+
+def gamme_image_names(gammes):
+    """Names of the images shown for gammes loaded by load_gamme_details, for derivatives_for()."""
+    names = []
+    for gamme in gammes:
+        names.append(gamme.photo_traitement_non_conforme.name)
+        for op in gamme.operations.all():
+            names += [photo.image.name for photo in op.photooperation_set.all()]
+    return names
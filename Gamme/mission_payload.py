@@ -0,0 +1,490 @@
+"""
+Parsing and diffing of the mission edit form (MissionControleUpdateView.post).
+
+`parse_mission_payload` reads request.POST and request.FILES once, matching
+each key against the field names the edit page sends, and groups the values
+by what they edit: mission -> gammes -> operations -> photos / moyens.
+`diff_gamme` then compares the part of the payload about one gamme with its
+rows and returns a GammeChanges listing only what differs, which the view
+applies: in place with `apply_in_place`, or on a new version of the gamme
+(versioning.fork_gamme) when the gamme's own fields changed.
+
+Field names of the edit page (ids are database ids unless noted):
+
+- mission: code, intitule, reference, statut, client, designation, section,
+  row_version (see row_versions.py)
+- gamme: <gamme>-<field>, <gamme>-row_version, <gamme>-photo_non_conforme (file),
+  gamme_<gamme>_moyen_controle_<moyen> and gamme_<gamme>_epi_<epi> checkboxes
+- operation: <op>-<field>, <op>-moyenscontrole (one value per checked moyen)
+- operation photo: photo_<photo>_description, photo_<photo>_DELETE
+- new photo of an operation: form-<op>-photo-<n>-image / -description, or
+  photo_<op>_<n>_image / photo_<op>_<n>_description
+- new operation: newop_<gamme>_<n>_<field>, newop_<gamme>_<n>_moyens_controle,
+  newop_<gamme>_<n>_photo_<m>_image / _description
+- EPI comment: epi_<epi>_commentaire
+- new gamme form: gamme_epi_<epi>, gamme_moyen_controle_<moyen>, and the
+  operation formset, whose photos are form-<form index>-photo-<n>-image
+"""
+import logging
+import re
+
+from django.db import transaction
+
+from .ingest import ingest_images
+from .models import OperationControle, PhotoOperation, epi
+from .row_versions import claim
+
+logger = logging.getLogger(__name__)
+
+MISSION_FIELDS = ('code', 'intitule', 'reference', 'statut', 'client', 'designation', 'section')
+
+# Form field -> GammeControle attribute
+GAMME_FIELDS = {
+    'intitule': 'intitule',
+    'No_incident': 'No_incident',
+    'commentaire': 'commantaire',
+    'temps_alloue': 'Temps_alloué',
+    'commentaire_identification': 'commantaire_identification',
+    'commentaire_non_conforme': 'commantaire_traitement_non_conforme',
+}
+GAMME_CHECKBOXES = ('picto_s', 'picto_r')
+
+OPERATION_FIELDS = ('titre', 'ordre', 'description', 'criteres', 'frequence', 'moyen_controle')
+NEW_OPERATION_FIELDS = ('titre', 'ordre', 'description', 'criteres', 'frequence', 'moyen_controle')
+
+_POST_KEYS = [
+    ('gamme_field', re.compile(r'^(\d+)-(%s)$' % '|'.join(list(GAMME_FIELDS) + list(GAMME_CHECKBOXES) + ['statut']))),
+    ('operation_field', re.compile(r'^(\d+)-(%s)$' % '|'.join(OPERATION_FIELDS))),
+    ('operation_moyens', re.compile(r'^(\d+)-moyenscontrole$')),
+    ('gamme_row_version', re.compile(r'^(\d+)-row_version$')),
+    ('gamme_selection', re.compile(r'^gamme_(\d+)_(moyen_controle|epi)_(\d+)$')),
+    ('photo_description', re.compile(r'^photo_(\d+)_description$')),
+    ('photo_delete', re.compile(r'^photo_(\d+)_DELETE$')),
+    ('new_photo_description', re.compile(r'^photo_(\d+)_(\d+)_description$')),
+    ('form_photo_description', re.compile(r'^form-(\d+)-photo-(\d+)-description$')),
+    ('new_operation_field', re.compile(r'^newop_(\d+)_(\d+)_(%s)$' % '|'.join(NEW_OPERATION_FIELDS))),
+    ('new_operation_moyens', re.compile(r'^newop_(\d+)_(\d+)_moyens_controle$')),
+    ('new_operation_photo_description', re.compile(r'^newop_(\d+)_(\d+)_photo_(\d+)_description$')),
+    ('epi_comment', re.compile(r'^epi_(\d+)_commentaire$')),
+    ('new_gamme_selection', re.compile(r'^gamme_(moyen_controle|epi)_(\d+)$')),
+]
+_FILE_KEYS = [
+    ('non_conforme_photo', re.compile(r'^(\d+)-photo_non_conforme$')),
+    ('new_photo', re.compile(r'^photo_(\d+)_(\d+)_image$')),
+    ('form_photo', re.compile(r'^form-(\d+)-photo-(\d+)-image$')),
+    ('new_operation_photo', re.compile(r'^newop_(\d+)_(\d+)_photo_(\d+)_image$')),
+]
+
+
+def _match(patterns, key):
+    for kind, pattern in patterns:
+        match = pattern.match(key)
+        if match:
+            return kind, match.groups()
+    return None, None
+
+
+def _int(value, default=None):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def _photos(files, descriptions):
+    """[(file, description)] in index order, from {index: file} and {index: description}."""
+    return [(files[n], descriptions.get(n, '')) for n in sorted(files)]
+
+
+class GammePayload:
+    """What the form sent about one existing gamme."""
+
+    def __init__(self, gamme_id):
+        self.id = gamme_id
+        self.row_version = None
+        self.fields = {}
+        self.moyen_ids = set()
+        self.epi_ids = set()
+        self.non_conforme_photo = None
+        # {index: NewOperationPayload}
+        self.new_operations = {}
+
+
+class OperationPayload:
+    """What the form sent about one existing operation."""
+
+    def __init__(self, op_id):
+        self.id = op_id
+        self.fields = {}
+        # None when the moyen checkboxes were not part of the form
+        self.moyen_ids = None
+        self._photo_files = {}
+        self._photo_descriptions = {}
+
+    @property
+    def new_photos(self):
+        return _photos(self._photo_files, self._photo_descriptions)
+
+
+class NewOperationPayload:
+    """An operation added to an existing gamme (newop_<gamme>_<n>_...)."""
+
+    def __init__(self):
+        self.fields = {}
+        self.moyen_ids = []
+        self._photo_files = {}
+        self._photo_descriptions = {}
+
+    @property
+    def photos(self):
+        return _photos(self._photo_files, self._photo_descriptions)
+
+    @property
+    def is_empty(self):
+        return not self.fields.get('titre') and not self._photo_files
+
+
+class MissionPayload:
+    def __init__(self):
+        self.fields = {}
+        self.row_version = None
+        self.gammes = {}
+        self.operations = {}
+        # {photo id: new description} and deleted photo ids, for existing operation photos
+        self.photo_descriptions = {}
+        self.deleted_photo_ids = set()
+        self.epi_comments = {}
+        # Form of a new gamme
+        self.new_gamme_moyen_ids = []
+        self.new_gamme_epi_ids = []
+        self._form_photo_files = {}
+        self._form_photo_descriptions = {}
+
+    def gamme(self, gamme_id):
+        if gamme_id not in self.gammes:
+            self.gammes[gamme_id] = GammePayload(gamme_id)
+        return self.gammes[gamme_id]
+
+    def operation(self, op_id):
+        if op_id not in self.operations:
+            self.operations[op_id] = OperationPayload(op_id)
+        return self.operations[op_id]
+
+    def form_photos(self, index):
+        """Photos sent as form-<index>-photo-<n>-image (operation id or formset index)."""
+        return _photos(self._form_photo_files.get(index, {}), self._form_photo_descriptions.get(index, {}))
+
+
+def parse_mission_payload(post, files):
+    """Group the fields of the edit form by what they edit, in one pass over the keys."""
+    payload = MissionPayload()
+    payload.fields = {field: post[field] for field in MISSION_FIELDS if field in post}
+    payload.row_version = _int(post.get('row_version'))
+
+    for key in post:
+        kind, groups = _match(_POST_KEYS, key)
+        if kind is None:
+            continue
+        value = post.get(key)
+        if kind == 'gamme_field':
+            payload.gamme(int(groups[0])).fields[groups[1]] = value
+        elif kind == 'operation_field':
+            payload.operation(int(groups[0])).fields[groups[1]] = value
+        elif kind == 'operation_moyens':
+            payload.operation(int(groups[0])).moyen_ids = list(dict.fromkeys(post.getlist(key)))
+        elif kind == 'gamme_row_version':
+            payload.gamme(int(groups[0])).row_version = _int(value)
+        elif kind == 'gamme_selection':
+            if value == 'on':
+                gamme = payload.gamme(int(groups[0]))
+                selected = gamme.moyen_ids if groups[1] == 'moyen_controle' else gamme.epi_ids
+                selected.add(int(groups[2]))
+        elif kind == 'photo_description':
+            payload.photo_descriptions[int(groups[0])] = value
+        elif kind == 'photo_delete':
+            payload.deleted_photo_ids.add(int(groups[0]))
+        elif kind == 'new_photo_description':
+            payload.operation(int(groups[0]))._photo_descriptions[('photo', int(groups[1]))] = value
+        elif kind == 'form_photo_description':
+            payload._form_photo_descriptions.setdefault(int(groups[0]), {})[int(groups[1])] = value
+        elif kind in ('new_operation_field', 'new_operation_moyens', 'new_operation_photo_description'):
+            new_operations = payload.gamme(int(groups[0])).new_operations
+            new_op = new_operations.setdefault(int(groups[1]), NewOperationPayload())
+            if kind == 'new_operation_field':
+                new_op.fields[groups[2]] = value
+            elif kind == 'new_operation_moyens':
+                new_op.moyen_ids = list(dict.fromkeys(post.getlist(key)))
+            else:
+                new_op._photo_descriptions[int(groups[2])] = value
+        elif kind == 'epi_comment':
+            payload.epi_comments[int(groups[0])] = value
+        elif kind == 'new_gamme_selection':
+            selected = payload.new_gamme_moyen_ids if groups[0] == 'moyen_controle' else payload.new_gamme_epi_ids
+            selected.append(int(groups[1]))
+
+    for key in files:
+        kind, groups = _match(_FILE_KEYS, key)
+        if kind == 'non_conforme_photo':
+            payload.gamme(int(groups[0])).non_conforme_photo = files[key]
+        elif kind == 'new_photo':
+            payload.operation(int(groups[0]))._photo_files[('photo', int(groups[1]))] = files[key]
+        elif kind == 'form_photo':
+            payload._form_photo_files.setdefault(int(groups[0]), {})[int(groups[1])] = files[key]
+        elif kind == 'new_operation_photo':
+            new_operations = payload.gamme(int(groups[0])).new_operations
+            new_operations.setdefault(int(groups[1]), NewOperationPayload())._photo_files[int(groups[2])] = files[key]
+
+    # Photos of existing operations sent with the form-<op>-photo-<n> names
+    for op_id, payload_op in payload.operations.items():
+        for n, (image, description) in enumerate(payload.form_photos(op_id)):
+            payload_op._photo_files[('form', n)] = image
+            payload_op._photo_descriptions[('form', n)] = description
+    return payload
+
+
+class GammeChanges:
+    """
+    Differences between the form and one gamme, as returned by diff_gamme.
+
+    Every attribute only lists what changed: model attribute -> new value for
+    `fields` and for each operation in `operations`, new id sets for the
+    moyen/EPI selections (None when unchanged).
+    """
+
+    def __init__(self, gamme):
+        self.gamme = gamme
+        # row_version the form was loaded with (None when not sent)
+        self.row_version = None
+        self.fields = {}
+        self.statut = None
+        self.non_conforme_photo = None
+        self.moyen_ids = None
+        self.epi_ids = None
+        # {op id: {attribute: value}} and {op id: [moyen ids]}
+        self.operations = {}
+        self.operation_moyens = {}
+        self.photo_descriptions = {}
+        self.deleted_photo_ids = set()
+        # {op id: [(file, description)]}
+        self.new_photos = {}
+        self.new_operations = []
+
+    @property
+    def content_changed(self):
+        """The gamme's own fields changed: saved as a new version."""
+        return bool(self.fields) or self.non_conforme_photo is not None
+
+    @property
+    def has_changes(self):
+        return any([
+            self.content_changed, self.statut is not None, self.moyen_ids is not None, self.epi_ids is not None,
+            self.operations, self.operation_moyens, self.photo_descriptions, self.deleted_photo_ids,
+            self.new_photos, self.new_operations,
+        ])
+
+    def operation_values(self, op):
+        """Field values of an operation once its changes are applied."""
+        values = {field: getattr(op, field) for field in OPERATION_FIELDS}
+        values.update(self.operations.get(op.id, {}))
+        return values
+
+    def operation_moyen_ids(self, op):
+        if op.id in self.operation_moyens:
+            return self.operation_moyens[op.id]
+        return [m.id for m in op.moyenscontrole.all()]
+
+
+def diff_mission(mission, payload):
+    """Mission fields of the form that differ from `mission`: {field: value}."""
+    changed = {}
+    for field, value in payload.fields.items():
+        current = getattr(mission, field)
+        if field == 'statut':
+            value = value == 'True'
+        elif current is None:
+            current = ''
+        if value != current:
+            changed[field] = value
+    return changed
+
+
+def diff_gamme(gamme, payload, mission):
+    """
+    Compare the form with `gamme`, loaded with its operations (moyens and
+    photos prefetched), EPIs and moyens. Returns None when the form did not
+    include this gamme (versions not shown on the page are left alone).
+    """
+    sent = payload.gammes.get(gamme.id)
+    if sent is None:
+        return None
+    changes = GammeChanges(gamme)
+    changes.row_version = sent.row_version
+
+    for field, attribute in GAMME_FIELDS.items():
+        if field not in sent.fields:
+            continue
+        value = sent.fields[field]
+        current = getattr(gamme, attribute)
+        if field == 'intitule' and not value.strip():
+            value = f"Gamme: {mission.intitule}"
+        if field == 'temps_alloue':
+            value = _int(value)
+        elif current is None:
+            current = ''
+        if value != current:
+            changes.fields[attribute] = value
+    for field in GAMME_CHECKBOXES:
+        # Unchecked boxes are not sent
+        if sent.fields and (sent.fields.get(field) == 'on') != getattr(gamme, field):
+            changes.fields[field] = sent.fields.get(field) == 'on'
+    if 'statut' in sent.fields and (sent.fields['statut'] == 'True') != gamme.statut:
+        changes.statut = sent.fields['statut'] == 'True'
+    changes.non_conforme_photo = sent.non_conforme_photo
+
+    # Unchecked boxes are not sent: the selections are only compared when the gamme's form was
+    if sent.fields and sent.moyen_ids != {m.id for m in gamme.moyens_controle.all()}:
+        changes.moyen_ids = sent.moyen_ids
+    if sent.fields and sent.epi_ids != {e.id for e in gamme.epis.all()}:
+        changes.epi_ids = sent.epi_ids
+
+    for op in gamme.operations.all():
+        sent_op = payload.operations.get(op.id)
+        if sent_op is not None:
+            fields = {}
+            for field in OPERATION_FIELDS:
+                if field not in sent_op.fields:
+                    continue
+                value = sent_op.fields[field]
+                current = getattr(op, field)
+                if field in ('ordre', 'frequence'):
+                    value = _int(value, current)
+                if value != (current if current is not None else ''):
+                    fields[field] = value
+            if fields:
+                changes.operations[op.id] = fields
+            if sent_op.moyen_ids is not None or sent_op.fields:
+                moyen_ids = [int(mid) for mid in sent_op.moyen_ids or [] if mid.isdigit()]
+                if set(moyen_ids) != {m.id for m in op.moyenscontrole.all()}:
+                    changes.operation_moyens[op.id] = moyen_ids
+            if sent_op.new_photos:
+                changes.new_photos[op.id] = sent_op.new_photos
+
+        for photo in op.photooperation_set.all():
+            if photo.id in payload.deleted_photo_ids:
+                changes.deleted_photo_ids.add(photo.id)
+            elif payload.photo_descriptions.get(photo.id, photo.description) != photo.description:
+                changes.photo_descriptions[photo.id] = payload.photo_descriptions[photo.id]
+
+    changes.new_operations = [new_op for _, new_op in sorted(sent.new_operations.items()) if not new_op.is_empty]
+    return changes
+
+
+def new_operation_values(new_op, index):
+    """Field values of an operation added through the newop_ fields."""
+    return {
+        'titre': new_op.fields.get('titre') or f"Nouvelle opération {index + 1}",
+        'description': new_op.fields.get('description', ''),
+        'criteres': new_op.fields.get('criteres', ''),
+        'frequence': _int(new_op.fields.get('frequence'), 1),
+        'moyen_controle': new_op.fields.get('moyen_controle', ''),
+    }
+
+
+def apply_in_place(changes, user):
+    """
+    Apply changes that do not create a new version: status, selections,
+    operation edits, photo edits and additions, new operations.
+
+    The writes run in one transaction that starts by claiming the gamme
+    (row_versions.claim); uploaded photos are normalized and stored once the
+    outermost transaction commits, so that the write lock is not held while
+    images are processed and a rolled back save stores none.
+    """
+    gamme = changes.gamme
+    operations = list(gamme.operations.all())
+    by_id = {op.id: op for op in operations}
+    uploads = [(by_id[op_id], image, description)
+               for op_id, photos in changes.new_photos.items() for image, description in photos]
+
+    with transaction.atomic():
+        claim(gamme, changes.row_version, user, **({} if changes.statut is None else {'statut': changes.statut}))
+        if changes.moyen_ids is not None:
+            gamme.moyens_controle.set(changes.moyen_ids)
+        if changes.epi_ids is not None:
+            gamme.epis.set(changes.epi_ids)
+
+        edited = [op for op in operations if op.id in changes.operations]
+        for op in edited:
+            for field, value in changes.operations[op.id].items():
+                setattr(op, field, value)
+            op.updated_by = user
+        if edited:
+            fields = sorted({field for op in edited for field in changes.operations[op.id]} - {'ordre'})
+            if fields:
+                OperationControle.objects.bulk_update(edited, fields + ['updated_by'])
+            if any('ordre' in changes.operations[op.id] for op in edited):
+                _renumber(operations)
+        for op in operations:
+            if op.id in changes.operation_moyens:
+                op.moyenscontrole.set(changes.operation_moyens[op.id])
+
+        if changes.photo_descriptions:
+            photos = list(PhotoOperation.objects.filter(id__in=changes.photo_descriptions, operation__gamme=gamme))
+            for photo in photos:
+                photo.description = changes.photo_descriptions[photo.id]
+            PhotoOperation.objects.bulk_update(photos, ['description'])
+        if changes.deleted_photo_ids:
+            # Row by row, so that the image references are released (see signals.py)
+            PhotoOperation.objects.filter(id__in=changes.deleted_photo_ids, operation__gamme=gamme).delete()
+
+        next_order = max((op.ordre for op in operations), default=0) + 1
+        for index, new_op in enumerate(changes.new_operations):
+            op = create_operation(gamme, new_operation_values(new_op, index), next_order + index, new_op.moyen_ids, user)
+            uploads += [(op, image, description) for image, description in new_op.photos]
+
+    transaction.on_commit(lambda: store_photos(uploads, user))
+
+
+def store_photos(uploads, user):
+    """
+    Save uploaded operation photos, [(operation, file, description)], with
+    ingest_images. Run outside transactions: images are processed in worker
+    threads before a short bulk insert.
+    """
+    if not uploads:
+        return
+    items = [(PhotoOperation(operation=op, description=description, created_by=user), image, image.name)
+             for op, image, description in uploads]
+    for result in ingest_images(PhotoOperation, 'image', items):
+        if result['error'] is not None:
+            logger.warning(f"Photo {result['upload'].name} not saved: {result['error']}")
+
+
+def apply_epi_comments(payload):
+    """Save the EPI comments that differ from the form (epi_<id>_commentaire)."""
+    changed = [e for e in epi.objects.filter(id__in=list(payload.epi_comments))
+               if e.commentaire != payload.epi_comments[e.id]]
+    for e in changed:
+        e.commentaire = payload.epi_comments[e.id]
+    epi.objects.bulk_update(changed, ['commentaire'])
+
+
+def _renumber(operations):
+    """Give the operations orders 1..n following their (edited) order; unique per gamme."""
+    ordered = sorted(operations, key=lambda op: (op.ordre, op.id))
+    # Two passes: the final orders may collide with current ones
+    for index, op in enumerate(ordered, 1):
+        op.ordre = -index
+    OperationControle.objects.bulk_update(ordered, ['ordre'])
+    for op in ordered:
+        op.ordre = -op.ordre
+    OperationControle.objects.bulk_update(ordered, ['ordre'])
+
+
+def create_operation(gamme, values, ordre, moyen_ids, user):
+    """Create an operation of `gamme` with its moyens."""
+    op = OperationControle.objects.create(gamme=gamme, ordre=ordre, created_by=user, **values)
+    moyen_ids = [int(mid) for mid in moyen_ids if str(mid).isdigit()]
+    if moyen_ids:
+        op.moyenscontrole.set(moyen_ids)
+    return op
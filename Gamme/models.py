@@ -2,6 +2,9 @@ from ast import Num
 from django.db import models
 from django.contrib.auth.models import AbstractUser
 from decimal import Decimal
+import uuid
+
+from .media_blobs import get_blob_storage
 
 # ----------- UTILISATEUR -----------
 
@@ -28,10 +31,14 @@ class MissionControle(models.Model):
     client = models.CharField(max_length=100, null=True, blank=True)
     designation = models.CharField(max_length=100, null=True, blank=True)
     pdf_file = models.FileField(upload_to='gammes_pdf/', null=True, blank=True)
+    # Content fingerprint of the gamme rendered into pdf_file (see pdf_cache.gamme_fingerprint)
+    pdf_fingerprint = models.CharField(max_length=64, blank=True, default='')
     date_creation = models.DateTimeField(auto_now_add=True)
     date_mise_a_jour = models.DateTimeField(auto_now=True)
     created_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='mission_created')
     updated_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='mission_updated', null=True, blank=True)
+    # Bumped by each save of the mission edit page, which sends it back (see row_versions.py)
+    row_version = models.PositiveIntegerField(default=0, editable=False)
     
     def __str__(self):
         return self.intitule
@@ -40,6 +47,11 @@ class MissionControle(models.Model):
     def latest_gamme(self):
         return self.gammes.order_by('-date_creation').first()
 
+    @property
+    def active_gamme(self):
+        """Gamme shown and printed for the mission: its highest active version."""
+        return self.gammes.filter(statut=True).order_by('-version_num').first()
+
 
 # ----------- GAMME CONTROLE -----------
 
@@ -59,7 +71,14 @@ class GammeControle(models.Model):
         gid = instance.id or 0
         return f'photos/non_conformes/gamme_{gid}/{filename}'
 
-    photo_traitement_non_conforme = models.ImageField(upload_to=photo_traitement_non_conforme_upload_to, null=True, blank=True)
+    photo_traitement_non_conforme = models.ImageField(upload_to=photo_traitement_non_conforme_upload_to, storage=get_blob_storage, null=True, blank=True)
+    # Stored at upload time (see ingest.image_metadata) so that pages and PDFs need not open the file
+    # (prefixed, see ingest.IMAGE_METADATA_PREFIXES)
+    photo_non_conforme_width = models.PositiveIntegerField(null=True, blank=True)
+    photo_non_conforme_height = models.PositiveIntegerField(null=True, blank=True)
+    photo_non_conforme_file_size = models.PositiveIntegerField(null=True, blank=True)
+    photo_non_conforme_mime_type = models.CharField(max_length=50, blank=True, default='')
+    photo_non_conforme_sha256 = models.CharField(max_length=64, blank=True, default='')
     No_incident = models.CharField(max_length=100)
     version = models.CharField(max_length=100)
     version_num = models.DecimalField(max_digits=5, decimal_places=2, default=1.0)
@@ -72,6 +91,8 @@ class GammeControle(models.Model):
     date_mise_a_jour = models.DateTimeField(auto_now=True)
     created_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='gamme_created')
     updated_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='gamme_updated', null=True, blank=True)
+    # Bumped by each save of the mission edit page, which sends it back (see row_versions.py)
+    row_version = models.PositiveIntegerField(default=0, editable=False)
     epis = models.ManyToManyField('epi', related_name='gammes', blank=True, verbose_name='Équipements de Protection Individuelle')
     moyens_controle = models.ManyToManyField('moyens_controle', related_name='gammes', blank=True, verbose_name='Moyens de Contrôle')
 
@@ -95,8 +116,14 @@ def photo_defaut_upload_to(instance, filename):
 class PhotoDefaut(models.Model):
     id = models.AutoField(primary_key=True)
     gamme = models.ForeignKey(GammeControle, on_delete=models.CASCADE, related_name='defaut_photos')
-    image = models.ImageField(upload_to=photo_defaut_upload_to)
+    image = models.ImageField(upload_to=photo_defaut_upload_to, storage=get_blob_storage)
     description = models.CharField(max_length=255, blank=True, default='')
+    # Stored at upload time (see ingest.image_metadata) so that pages and PDFs need not open the file
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    file_size = models.PositiveIntegerField(null=True, blank=True)
+    mime_type = models.CharField(max_length=50, blank=True, default='')
+    sha256 = models.CharField(max_length=64, blank=True, default='')
     date_ajout = models.DateTimeField(auto_now_add=True)
     created_by = models.ForeignKey(User, on_delete=models.SET_NULL, related_name='photo_defaut_created', null=True, blank=True)
 
@@ -107,24 +134,19 @@ class PhotoDefaut(models.Model):
 
     def __str__(self):
         return self.description or f'Photo {self.id} pour {self.gamme.intitule}'
-    
-    def delete(self, *args, **kwargs):
-        """
-        Delete the file from storage when the model instance is deleted.
-        """
-        if self.image:
-            storage, path = self.image.storage, self.image.path
-            # Delete the model first
-            super().delete(*args, **kwargs)
-            # Then delete the file
-            storage.delete(path)
-        else:
-            super().delete(*args, **kwargs)
+
+
 class Photolimiteacceptable(models.Model):
     id = models.AutoField(primary_key=True)
     gamme = models.ForeignKey(GammeControle, on_delete=models.CASCADE, related_name='limiteacceptable_photos')
-    image = models.ImageField(upload_to=photo_defaut_upload_to)
+    image = models.ImageField(upload_to=photo_defaut_upload_to, storage=get_blob_storage)
     description = models.CharField(max_length=255, blank=True, default='')
+    # Stored at upload time (see ingest.image_metadata) so that pages and PDFs need not open the file
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    file_size = models.PositiveIntegerField(null=True, blank=True)
+    mime_type = models.CharField(max_length=50, blank=True, default='')
+    sha256 = models.CharField(max_length=64, blank=True, default='')
     date_ajout = models.DateTimeField(auto_now_add=True)
     created_by = models.ForeignKey(User, on_delete=models.SET_NULL, related_name='limiteacceptable_created', null=True, blank=True)
 
@@ -136,18 +158,6 @@ class Photolimiteacceptable(models.Model):
     def __str__(self):
         return self.description or f'Photo {self.id} pour {self.gamme.intitule}'
     
-    def delete(self, *args, **kwargs):
-        """
-        Delete the file from storage when the model instance is deleted.
-        """
-        if self.image:
-            storage, path = self.image.storage, self.image.path
-            # Delete the model first
-            super().delete(*args, **kwargs)
-            # Then delete the file
-            storage.delete(path)
-        else:
-            super().delete(*args, **kwargs)
 
 # ----------- OPÉRATION CONTROLE -----------
 
@@ -178,8 +188,14 @@ class OperationControle(models.Model):
 class PhotoOperation(models.Model):
     id = models.AutoField(primary_key=True)
     operation = models.ForeignKey(OperationControle, on_delete=models.CASCADE)
-    image = models.ImageField(upload_to='photos/')
+    image = models.ImageField(upload_to='photos/', storage=get_blob_storage)
     description = models.CharField(max_length=255)
+    # Stored at upload time (see ingest.image_metadata) so that pages and PDFs need not open the file
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    file_size = models.PositiveIntegerField(null=True, blank=True)
+    mime_type = models.CharField(max_length=50, blank=True, default='')
+    sha256 = models.CharField(max_length=64, blank=True, default='')
     date_ajout = models.DateTimeField(auto_now_add=True)
     created_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='photo_operation_created', null=True, blank=True)
 
@@ -237,7 +253,13 @@ class validation(models.Model):
 class epi(models.Model):
     id = models.AutoField(primary_key=True)
     nom = models.CharField(max_length=100)
-    photo = models.ImageField(upload_to='photos/epi/')
+    photo = models.ImageField(upload_to='photos/epi/', storage=get_blob_storage)
+    # Stored at upload time (see ingest.image_metadata) so that pages and PDFs need not open the file
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    file_size = models.PositiveIntegerField(null=True, blank=True)
+    mime_type = models.CharField(max_length=50, blank=True, default='')
+    sha256 = models.CharField(max_length=64, blank=True, default='')
     commentaire = models.TextField(blank=True)
 
     def __str__(self):
@@ -248,10 +270,152 @@ class epi(models.Model):
 class moyens_controle(models.Model):
     id = models.AutoField(primary_key=True)
     nom = models.CharField(max_length=100)
-    photo = models.ImageField(upload_to='photos/moyens_controle/')
+    photo = models.ImageField(upload_to='photos/moyens_controle/', storage=get_blob_storage)
+    # Stored at upload time (see ingest.image_metadata) so that pages and PDFs need not open the file
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    file_size = models.PositiveIntegerField(null=True, blank=True)
+    mime_type = models.CharField(max_length=50, blank=True, default='')
+    sha256 = models.CharField(max_length=64, blank=True, default='')
     ordre = models.IntegerField()
    
 
     def __str__(self):
         return f"{self.nom} (Ordre: {self.ordre})"
-    
\ No newline at end of file
+    
+# ----------- RENDU PDF EN ARRIÈRE-PLAN -----------
+
+class PdfRenderJob(models.Model):
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'En attente'),
+        (STATUS_RUNNING, 'En cours'),
+        (STATUS_DONE, 'Terminé'),
+        (STATUS_FAILED, 'Échec'),
+    ]
+
+    id = models.AutoField(primary_key=True)
+    mission = models.ForeignKey(MissionControle, on_delete=models.CASCADE, related_name='pdf_jobs')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING, db_index=True)
+    attempts = models.IntegerField(default=0)
+    error = models.TextField(blank=True, default='')
+    worker = models.CharField(max_length=100, blank=True, default='')
+    date_creation = models.DateTimeField(auto_now_add=True)
+    date_debut = models.DateTimeField(null=True, blank=True)
+    date_fin = models.DateTimeField(null=True, blank=True)
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, related_name='pdf_jobs_created', null=True, blank=True)
+
+    class Meta:
+        ordering = ['date_creation']
+        verbose_name = 'Tâche de rendu PDF'
+        verbose_name_plural = 'Tâches de rendu PDF'
+
+    def __str__(self):
+        return f"PDF mission {self.mission_id} ({self.get_status_display()})"
+
+
+# ----------- DÉRIVÉS D'IMAGES -----------
+
+class ImageDerivative(models.Model):
+    """
+    Resized copy of an uploaded image, keyed by the storage name of the stored
+    image. Size and format 'original' mark the camera original kept when
+    GAMME_IMAGE_KEEP_ORIGINAL is on.
+    """
+    SIZE_CHOICES = [
+        ('thumb', 'Miniature'),
+        ('card', 'Carte'),
+        ('print', 'Impression'),
+        ('original', 'Original'),
+    ]
+    FORMAT_CHOICES = [
+        ('webp', 'WebP'),
+        ('jpeg', 'JPEG'),
+        ('original', 'Original'),
+    ]
+
+    id = models.AutoField(primary_key=True)
+    source = models.CharField(max_length=255, db_index=True)
+    size = models.CharField(max_length=10, choices=SIZE_CHOICES)
+    format = models.CharField(max_length=10, choices=FORMAT_CHOICES)
+    file = models.FileField(upload_to='derivatives/', max_length=255)
+    width = models.PositiveIntegerField()
+    height = models.PositiveIntegerField()
+    date_creation = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('source', 'size', 'format')
+        verbose_name = "Dérivé d'image"
+        verbose_name_plural = "Dérivés d'images"
+
+    def __str__(self):
+        return f"{self.source} ({self.size}, {self.format})"
+
+
+# ----------- BLOBS MÉDIA -----------
+
+class MediaBlob(models.Model):
+    """Content-addressed image file shared by every row pointing at it (see media_blobs.py)."""
+    id = models.AutoField(primary_key=True)
+    sha256 = models.CharField(max_length=64, unique=True)
+    name = models.CharField(max_length=255, unique=True)
+    size = models.BigIntegerField(default=0)
+    # Number of model rows whose image field points at this blob
+    refcount = models.PositiveIntegerField(default=0)
+    # Archive of GAMME_MEDIA_ARCHIVE_DIR holding the file once moved to cold storage (see cold_storage.py)
+    archive = models.CharField(max_length=100, blank=True, default='', db_index=True)
+    date_creation = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Blob média'
+        verbose_name_plural = 'Blobs média'
+
+    def __str__(self):
+        return f"{self.name} ({self.refcount} réf.)"
+
+
+# ----------- TÉLÉVERSEMENT PAR MORCEAUX -----------
+
+class ChunkedUpload(models.Model):
+    """Photo being uploaded in chunks; the bytes live in a temporary file until completion."""
+    KIND_DEFAUT = 'defaut'
+    KIND_ACCEPTABLE = 'acceptable'
+    KIND_OPERATION = 'operation'
+    KIND_CHOICES = [
+        (KIND_DEFAUT, 'Photo de défaut'),
+        (KIND_ACCEPTABLE, 'Photo de limite acceptable'),
+        (KIND_OPERATION, "Photo d'opération"),
+    ]
+    STATUS_UPLOADING = 'uploading'
+    STATUS_COMPLETE = 'complete'
+    STATUS_CHOICES = [
+        (STATUS_UPLOADING, 'En cours'),
+        (STATUS_COMPLETE, 'Terminé'),
+    ]
+
+    id = models.AutoField(primary_key=True)
+    token = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    gamme = models.ForeignKey(GammeControle, on_delete=models.CASCADE, related_name='chunked_uploads', null=True, blank=True)
+    operation = models.ForeignKey(OperationControle, on_delete=models.CASCADE, related_name='chunked_uploads', null=True, blank=True)
+    filename = models.CharField(max_length=255)
+    description = models.CharField(max_length=255, blank=True, default='')
+    size = models.BigIntegerField()
+    offset = models.BigIntegerField(default=0)
+    sha256 = models.CharField(max_length=64, blank=True, default='')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_UPLOADING, db_index=True)
+    # Id of the PhotoDefaut / Photolimiteacceptable / PhotoOperation created on completion
+    photo_id = models.IntegerField(null=True, blank=True)
+    date_creation = models.DateTimeField(auto_now_add=True)
+    date_mise_a_jour = models.DateTimeField(auto_now=True)
+    created_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='chunked_uploads')
+
+    class Meta:
+        verbose_name = 'Téléversement par morceaux'
+        verbose_name_plural = 'Téléversements par morceaux'
+
+    def __str__(self):
+        return f"{self.filename} ({self.offset}/{self.size})"
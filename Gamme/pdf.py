@@ -0,0 +1,257 @@
+import contextvars
+import hashlib
+import os
+from io import BytesIO
+from urllib.parse import parse_qs, unquote, urlparse
+
+from django.conf import settings
+from django.db.models import Prefetch, Q, prefetch_related_objects
+from django.template.loader import get_template
+
+from .cold_storage import archived_names, media_path
+from .images import pdf_image_path
+from .ingest import image_metadata_columns
+from .profiling import stage
+from .models import OperationControle, PhotoDefaut, PhotoOperation, Photolimiteacceptable, User, moyens_controle, validation
+
+GAMME_PDF_TEMPLATE = 'gamme/gamme_pdf_template.html'
+
+# Lifetime of the rendered HTML fragments; keys change with the content anyway
+FRAGMENT_CACHE_TIMEOUT = 7 * 24 * 3600
+
+
+# Stored metadata of the photos of the document being rendered, by storage name (see fetch_resources)
+_image_metadata = contextvars.ContextVar('gamme_pdf_image_metadata', default={})
+
+
+class PdfRenderError(Exception):
+    """Raised when xhtml2pdf could not lay out the gamme document."""
+
+
+def template_signature():
+    """Identify the current template source so that template edits invalidate the cache."""
+    version = str(getattr(settings, 'GAMME_PDF_CACHE_VERSION', 1))
+    try:
+        origin = get_template(GAMME_PDF_TEMPLATE).origin.name
+        return f'{version}:{os.path.getmtime(origin)}'
+    except (AttributeError, OSError):
+        return version
+
+
+def fragment_key(*parts):
+    """
+    Cache key for a `{% cache %}` fragment of the gamme template.
+
+    Built from the values the fragment prints, so that an edited operation or
+    photo gets a new key while untouched blocks are served from the cache.
+    """
+    signature = (template_signature(), settings.MEDIA_URL, settings.TIME_ZONE)
+    return hashlib.sha1(repr(signature + parts).encode('utf-8')).hexdigest()
+
+
+def recorded_image_metadata(rows, field):
+    """{storage name: (width, height, file_size, sha256)} of the images of rows whose metadata is recorded."""
+    metadata = {}
+    for row in rows:
+        columns = image_metadata_columns(type(row))
+        file = getattr(row, field)
+        values = tuple(getattr(row, columns[key]) for key in ('width', 'height', 'file_size', 'sha256'))
+        if file and all(values):
+            metadata[file.name] = values
+    return metadata
+
+
+def _role_label(user, default="Responsable Qualité"):
+    if user.is_ro:
+        return "Responsable Opérationnel"
+    if user.is_rs:
+        return "Responsable de Service"
+    if user.is_admin:
+        return "Administrateur"
+    return default
+
+
+def gamme_pdf_prefetches():
+    """Prefetch plan covering every relation read by gamme_pdf_template.html."""
+    return [
+        'created_by',
+        Prefetch('operations', queryset=OperationControle.objects.order_by('ordre')),
+        Prefetch('operations__moyenscontrole', queryset=moyens_controle.objects.order_by('ordre')),
+        Prefetch('operations__photooperation_set', queryset=PhotoOperation.objects.order_by('id')),
+        Prefetch('defaut_photos', queryset=PhotoDefaut.objects.order_by('date_ajout')),
+        Prefetch('limiteacceptable_photos', queryset=Photolimiteacceptable.objects.order_by('date_ajout')),
+        'epis',
+        Prefetch('moyens_controle', queryset=moyens_controle.objects.order_by('ordre')),
+        Prefetch('validations', queryset=validation.objects.select_related('user_ro').order_by('-date_validation_user_ro')),
+    ]
+
+
+def build_gamme_pdf_context(mission, gamme, user=None):
+    """
+    Build the gamme_pdf_template.html context for a gamme version.
+
+    Runs a fixed number of queries whatever the number of operations and
+    photos. `user` is the fallback for rs_user/ro_user when no such user exists.
+    """
+    with stage('context'):
+        return _build_gamme_pdf_context(mission, gamme, user)
+
+
+def _build_gamme_pdf_context(mission, gamme, user):
+    gamme.mission = mission
+    prefetch_related_objects([gamme], *gamme_pdf_prefetches())
+
+    creator = gamme.created_by
+    creator_name = creator.get_full_name() or creator.username
+
+    # Most recent validation of the gamme
+    validator_name = ""
+    validator_role = "Responsable Qualité"
+    validation_date = None
+    latest_validation = next(iter(gamme.validations.all()), None)
+    if latest_validation and latest_validation.user_ro:
+        validator = latest_validation.user_ro
+        validator_name = f"{validator.first_name} {validator.last_name}".strip() or validator.username
+        validator_role = _role_label(validator)
+        validation_date = latest_validation.date_validation_user_ro
+
+    operations = {}
+    for i, op in enumerate(gamme.operations.all(), 1):
+        photos = op.photooperation_set.all()
+        moyens = list(op.moyenscontrole.all())
+        operations[i] = {
+            'description': op.description,
+            'photos': photos,
+            'moyenscontrole': moyens,
+            'frequence': op.frequence,
+            'moyen_controle': op.moyen_controle,
+            'criteres': op.criteres,
+            'fragment_key': fragment_key(
+                'operation', i, op.description, op.frequence, op.moyen_controle, op.criteres,
+                [(m.id, m.photo.name) for m in moyens],
+                [(p.id, p.image.name) for p in photos],
+            ),
+        }
+
+    # RS (Responsable de Service) and RO (Responsable Opérationnel) users in one query
+    responsables = list(User.objects.filter(Q(is_rs=True) | Q(is_ro=True)).order_by('id'))
+    rs_user = next((u for u in responsables if u.is_rs), None)
+    ro_user = next((u for u in responsables if u.is_ro), None)
+    if user is not None and user.is_authenticated:
+        rs_user = rs_user or user
+        ro_user = ro_user or user
+
+    epis = list(gamme.epis.all())
+    photo_defauts = gamme.defaut_photos.all()
+    photo_acceptables = gamme.limiteacceptable_photos.all()
+
+    unique_moyens = list(gamme.moyens_controle.all())
+
+    photos = [p for op in gamme.operations.all() for p in op.photooperation_set.all()]
+    moyens = unique_moyens + [m for op in operations.values() for m in op['moyenscontrole']]
+    image_metadata = recorded_image_metadata(photos + list(photo_defauts) + list(photo_acceptables), 'image')
+    image_metadata.update(recorded_image_metadata(epis + moyens, 'photo'))
+    image_metadata.update(recorded_image_metadata([gamme], 'photo_traitement_non_conforme'))
+    # Archived photos are not under MEDIA_ROOT: fetch_resources looks them up
+    for name in archived_names(image_metadata):
+        del image_metadata[name]
+
+    return {
+        'mission': mission,
+        'gammecontrole': gamme,
+        'operations': operations,
+        'unique_moyens': unique_moyens,
+        'title': f'Gamme - {mission.intitule}',
+        'rs_user': rs_user,
+        'ro_user': ro_user,
+        'photo_defauts': photo_defauts,
+        'photo_acceptables': photo_acceptables,
+        'temps_alloue': str(gamme.Temps_alloué) if gamme.Temps_alloué is not None else '',
+        'static_defect_photos': [
+            {'image_path': '1.jpg', 'title': 'Défaut de surface'},
+            {'image_path': '2.jpg', 'title': 'Défaut d\'assemblage'},
+            {'image_path': 'logo.jpg', 'title': 'Défaut de marquage'},
+        ],
+        'epis': epis,
+        'fragment_timeout': FRAGMENT_CACHE_TIMEOUT,
+        'epis_fragment_key': fragment_key('epis', [(e.id, e.nom, e.photo.name) for e in epis]),
+        'defauts_fragment_key': fragment_key(
+            'defauts', [(p.id, p.image.name, p.description, p.date_ajout) for p in photo_defauts]),
+        'acceptables_fragment_key': fragment_key(
+            'acceptables', [(p.id, p.image.name, p.description, p.date_ajout) for p in photo_acceptables]),
+        'validator_name': validator_name,
+        'validator_role': validator_role,
+        'validation_date': validation_date,
+        'creator_name': creator_name,
+        'creator_role': _role_label(creator),
+        'gamme_creation_date': gamme.date_creation,
+        'image_metadata': image_metadata,
+    }
+
+
+def fetch_resources(uri, rel):
+    """
+    link_callback for xhtml2pdf: map static/media URLs to files on disk.
+
+    Media URLs may carry a `?pdf=<slot>` query (see images.PDF_IMAGE_SLOTS), in
+    which case a downscaled derivative sized for that slot is returned.
+    """
+    base, _, query = uri.partition('?')
+    slot = parse_qs(query).get('pdf', [None])[0]
+
+    # Handle static files
+    if base.startswith(settings.STATIC_URL):
+        path = os.path.join(settings.STATIC_ROOT, base.replace(settings.STATIC_URL, ''))
+    # Handle media files
+    elif base.startswith(settings.MEDIA_URL):
+        name = unquote(base.replace(settings.MEDIA_URL, ''))
+        path = os.path.join(settings.MEDIA_ROOT, name)
+        metadata = _image_metadata.get().get(name)
+        if metadata is not None:
+            # Known photo: no stat of the original
+            if not slot:
+                return path
+            with stage('images'):
+                return pdf_image_path(path, slot, metadata)
+        path = media_path(name)
+        if slot and os.path.exists(path):
+            with stage('images'):
+                return pdf_image_path(path, slot)
+    else:
+        # Handle absolute URLs (e.g., CDN)
+        parsed_uri = urlparse(uri)
+        if parsed_uri.netloc:
+            return uri
+        # Handle relative paths
+        path = os.path.join(settings.STATIC_ROOT, base.lstrip('/'))
+
+    # Ensure the path exists and return it
+    if os.path.exists(path):
+        return path
+    return uri
+
+
+def render_gamme_pdf(context):
+    """
+    Render the gamme template with the given context and return the PDF bytes.
+    """
+    with stage('template'):
+        html = get_template(GAMME_PDF_TEMPLATE).render(context)
+
+    result = BytesIO()
+    token = _image_metadata.set(context.get('image_metadata') or {})
+    try:
+        with stage('pisa'):
+            from xhtml2pdf import pisa
+
+            pdf = pisa.pisaDocument(
+                BytesIO(html.encode("UTF-8")),
+                result,
+                encoding='UTF-8',
+                link_callback=fetch_resources
+            )
+    finally:
+        _image_metadata.reset(token)
+    if pdf.err:
+        raise PdfRenderError(f"Error generating PDF: {pdf.err}")
+    return result.getvalue()
@@ -0,0 +1,165 @@
+"""
+Persistent render cache for gamme PDFs.
+
+A rendered PDF is stored on disk under GAMME_PDF_CACHE_DIR, keyed by the gamme
+id and a fingerprint of every row the template reads. Repeat views (and
+conditional GETs) can then be answered without re-running pisa.
+"""
+import hashlib
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.cache import quote_etag
+
+from .models import (OperationControle, PhotoDefaut, PhotoOperation, Photolimiteacceptable, User, epi,
+                     moyens_controle, validation)
+from .pdf import template_signature
+
+# How long a concurrent request waits for another worker's render before rendering itself
+RENDER_LOCK_TIMEOUT = 120
+
+
+def _cache_dir():
+    return getattr(settings, 'GAMME_PDF_CACHE_DIR', os.path.join(settings.BASE_DIR, 'cache', 'gamme_pdf'))
+
+
+def gamme_fingerprint(gamme):
+    """
+    Hash every value the PDF template depends on for this gamme version.
+
+    Uses a fixed number of values_list() queries, independent of the number of
+    operations and photos.
+    """
+    mission = gamme.mission
+    rows = [
+        template_signature(),
+        (mission.id, mission.code, mission.intitule, mission.reference, mission.section,
+         mission.client, mission.date_mise_a_jour.isoformat()),
+        (gamme.id, gamme.date_mise_a_jour.isoformat(), gamme.statut, gamme.version,
+         gamme.photo_traitement_non_conforme.name or ''),
+        list(User.objects.filter(id=gamme.created_by_id).values_list(
+            'id', 'username', 'first_name', 'last_name', 'is_ro', 'is_rs', 'is_admin')),
+        list(validation.objects.filter(gamme=gamme).order_by('id_validation').values_list(
+            'id_validation', 'date_validation_user_ro', 'user_ro__username', 'user_ro__first_name',
+            'user_ro__last_name', 'user_ro__is_ro', 'user_ro__is_rs', 'user_ro__is_admin')),
+        list(OperationControle.objects.filter(gamme=gamme).order_by('id').values_list(
+            'id', 'ordre', 'date_mise_a_jour')),
+        list(OperationControle.moyenscontrole.through.objects.filter(
+            operationcontrole__gamme=gamme).order_by('id').values_list(
+            'operationcontrole_id', 'moyens_controle_id')),
+        list(PhotoOperation.objects.filter(operation__gamme=gamme).order_by('id').values_list(
+            'id', 'operation_id', 'image', 'description')),
+        list(PhotoDefaut.objects.filter(gamme=gamme).order_by('id').values_list(
+            'id', 'image', 'description', 'date_ajout')),
+        list(Photolimiteacceptable.objects.filter(gamme=gamme).order_by('id').values_list(
+            'id', 'image', 'description', 'date_ajout')),
+        list(epi.objects.filter(gammes=gamme).order_by('id').values_list(
+            'id', 'nom', 'photo', 'commentaire')),
+        list(moyens_controle.objects.filter(Q(gammes=gamme) | Q(operations__gamme=gamme))
+             .distinct().order_by('id').values_list('id', 'nom', 'photo', 'ordre')),
+    ]
+    return hashlib.sha256(repr(rows).encode('utf-8')).hexdigest()
+
+
+def gamme_pdf_etag(gamme, fingerprint=None):
+    """
+    Strong ETag for the rendered PDF.
+
+    The template prints the current date in the client validation box, so the
+    render date is part of the representation as well.
+    """
+    fingerprint = fingerprint or gamme_fingerprint(gamme)
+    digest = hashlib.sha256(f'{fingerprint}:{timezone.localdate().isoformat()}'.encode('ascii')).hexdigest()
+    return quote_etag(digest[:32])
+
+
+def _cache_path(gamme_id, etag):
+    return os.path.join(_cache_dir(), str(gamme_id), etag.strip('"') + '.pdf')
+
+
+def get_cached_pdf(gamme_id, etag):
+    """Return the path of the cached PDF for this key, or None."""
+    path = _cache_path(gamme_id, etag)
+    return path if os.path.exists(path) else None
+
+
+def store_pdf(gamme_id, etag, content):
+    """
+    Atomically write the PDF bytes for this key and drop older renders of the gamme.
+    """
+    path = _cache_path(gamme_id, etag)
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as tmp:
+        tmp.write(content)
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, path)
+
+    for entry in os.scandir(directory):
+        if entry.name.endswith('.pdf') and entry.path != path:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+    return path
+
+
+@contextmanager
+def _render_lock(gamme_id, etag):
+    """
+    Cross-process lock so that only one worker renders a given key.
+
+    Yields True if the lock was acquired, False if the wait timed out (the
+    caller then renders anyway rather than failing the request).
+    """
+    lock_path = _cache_path(gamme_id, etag) + '.lock'
+    os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+    deadline = time.monotonic() + RENDER_LOCK_TIMEOUT
+    acquired = False
+    while True:
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            acquired = True
+            break
+        except FileExistsError:
+            try:
+                # A lock older than the timeout belongs to a crashed worker
+                if time.time() - os.path.getmtime(lock_path) > RENDER_LOCK_TIMEOUT:
+                    os.remove(lock_path)
+                    continue
+            except OSError:
+                continue
+            if get_cached_pdf(gamme_id, etag) or time.monotonic() > deadline:
+                break
+            time.sleep(0.2)
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            try:
+                os.remove(lock_path)
+            except OSError:
+                pass
+
+
+def get_or_render(gamme_id, etag, render):
+    """
+    Return the path of the cached PDF for this key, calling render() to
+    produce the bytes on a miss. Concurrent misses on the same key wait for
+    the first render instead of rendering in parallel.
+    """
+    path = get_cached_pdf(gamme_id, etag)
+    if path:
+        return path
+    with _render_lock(gamme_id, etag):
+        path = get_cached_pdf(gamme_id, etag)
+        if path:
+            return path
+        return store_pdf(gamme_id, etag, render())
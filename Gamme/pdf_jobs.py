@@ -0,0 +1,151 @@
+"""
+DB-backed queue for rendering mission PDFs outside the request cycle.
+
+Views enqueue a PdfRenderJob; the `run_pdf_worker` management command claims
+pending jobs and renders them in a pool of worker processes.
+"""
+import logging
+import os
+import socket
+import traceback
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import MissionControle, PdfRenderJob
+from .pdf import build_gamme_pdf_context, render_gamme_pdf
+from .pdf_cache import gamme_fingerprint
+from .pdf_store import store_pdf
+from .profiling import pdf_profile
+
+logger = logging.getLogger(__name__)
+
+# A job is retried this many times before being left in the failed state
+MAX_ATTEMPTS = 3
+
+
+def render_mission_pdf(mission):
+    """
+    Render the active gamme of the mission (the one view_gamme_pdf shows) and
+    store it in mission.pdf_file.
+
+    Raises ValueError if the mission has no active gamme, PdfRenderError if pisa fails.
+    """
+    gamme = mission.active_gamme
+    if not gamme:
+        raise ValueError('No active gamme found for this mission')
+
+    # Taken before rendering: an edit made during the render triggers a new one next time
+    fingerprint = gamme_fingerprint(gamme)
+    content = render_gamme_pdf(build_gamme_pdf_context(mission, gamme))
+
+    # The previous blob may be shared with other missions: gc_gamme_pdfs reclaims it
+    mission.pdf_file.name = store_pdf(content)
+    # Update the columns only, so that date_mise_a_jour keeps tracking content edits
+    mission.pdf_fingerprint = fingerprint
+    MissionControle.objects.filter(pk=mission.pk).update(
+        pdf_file=mission.pdf_file.name,
+        pdf_fingerprint=fingerprint
+    )
+    return mission.pdf_file
+
+
+def mission_pdf_is_current(mission):
+    """True when the stored PDF of the mission was rendered from its active gamme as it is now."""
+    gamme = mission.active_gamme
+    return gamme is not None and bool(mission.pdf_file) and mission.pdf_fingerprint == gamme_fingerprint(gamme)
+
+
+def regenerate_mission_pdf(mission_id, force=False):
+    """
+    Re-render the stored PDF of a mission unless its gamme content is unchanged.
+
+    Returns 'rendered', 'skipped' or 'no_gamme'. Because the fingerprint is only
+    stored once the file is written, an interrupted bulk run resumes where it
+    stopped when launched again.
+    """
+    mission = MissionControle.objects.get(id=mission_id)
+    gamme = mission.active_gamme
+    if not gamme:
+        return 'no_gamme'
+    if not force and mission.pdf_file and mission.pdf_fingerprint == gamme_fingerprint(gamme):
+        return 'skipped'
+    render_mission_pdf(mission)
+    return 'rendered'
+
+
+def init_worker_process():
+    """ProcessPoolExecutor initializer for processes that use the ORM."""
+    # Each process needs its own Django setup (spawn) and DB connection (fork)
+    import django
+    django.setup()
+    from django.db import connections
+    connections.close_all()
+
+
+def enqueue_mission_pdf(mission, user=None):
+    """
+    Queue a render for the mission, reusing a job that is still pending. A
+    running job is not reused: it may have read the gamme before the edit
+    this render is asked for.
+    """
+    with transaction.atomic():
+        job = PdfRenderJob.objects.filter(mission=mission, status=PdfRenderJob.STATUS_PENDING).first()
+        if job is None:
+            job = PdfRenderJob.objects.create(
+                mission=mission,
+                created_by=user if user is not None and user.is_authenticated else None
+            )
+    return job
+
+
+def claim_next_job():
+    """
+    Atomically move the oldest pending job to running and return its id, or None.
+
+    The conditional UPDATE makes claiming safe across several worker commands.
+    """
+    worker = f'{socket.gethostname()}:{os.getpid()}'
+    for job_id in PdfRenderJob.objects.filter(status=PdfRenderJob.STATUS_PENDING).values_list('id', flat=True)[:10]:
+        claimed = PdfRenderJob.objects.filter(id=job_id, status=PdfRenderJob.STATUS_PENDING).update(
+            status=PdfRenderJob.STATUS_RUNNING,
+            worker=worker,
+            date_debut=timezone.now(),
+        )
+        if claimed:
+            return job_id
+    return None
+
+
+def requeue_stale_jobs(max_age):
+    """Return running jobs older than max_age (seconds) to the queue, e.g. after a worker crash."""
+    cutoff = timezone.now() - timedelta(seconds=max_age)
+    return PdfRenderJob.objects.filter(
+        status=PdfRenderJob.STATUS_RUNNING,
+        date_debut__lt=cutoff,
+    ).update(status=PdfRenderJob.STATUS_PENDING, worker='')
+
+
+def run_job(job_id):
+    """
+    Render a claimed job. Runs inside a worker process.
+
+    Returns the final status of the job.
+    """
+    job = PdfRenderJob.objects.select_related('mission').get(id=job_id)
+    job.attempts += 1
+    try:
+        # Logged as a structured record; the summary stays in the worker process
+        with pdf_profile('run_pdf_worker'):
+            render_mission_pdf(job.mission)
+    except Exception as e:
+        logger.error(f'Error rendering PDF for mission {job.mission_id}: {str(e)}', exc_info=True)
+        job.error = traceback.format_exc()
+        job.status = PdfRenderJob.STATUS_PENDING if job.attempts < MAX_ATTEMPTS else PdfRenderJob.STATUS_FAILED
+    else:
+        job.error = ''
+        job.status = PdfRenderJob.STATUS_DONE
+    job.date_fin = timezone.now()
+    job.save(update_fields=['attempts', 'error', 'status', 'date_fin'])
+    return job.status
@@ -0,0 +1,70 @@
+"""
+Content-addressed storage of mission PDFs.
+
+A PDF is stored once under gammes_pdf/<sha[:2]>/<sha256>.pdf, whatever the
+number of missions (or successive saves) producing the same bytes, and
+MissionControle.pdf_file points at the blob. Saving never deletes the
+previous blob since another mission may share it: unreferenced files are
+reclaimed by the `gc_gamme_pdfs` command.
+"""
+import hashlib
+import re
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+PDF_STORE_PREFIX = 'gammes_pdf'
+
+BLOB_NAME_RE = re.compile(r'^gammes_pdf/([0-9a-f]{2})/([0-9a-f]{64})\.pdf$')
+
+
+def blob_name(sha256):
+    return f'{PDF_STORE_PREFIX}/{sha256[:2]}/{sha256}.pdf'
+
+
+def is_blob_name(name):
+    """True for names of the content-addressed layout (as opposed to legacy uploads)."""
+    match = BLOB_NAME_RE.match(name or '')
+    return bool(match) and match.group(2).startswith(match.group(1))
+
+
+def file_sha256(f):
+    """SHA-256 of a Django File, read in chunks."""
+    digest = hashlib.sha256()
+    for chunk in f.chunks():
+        digest.update(chunk)
+    f.seek(0)
+    return digest.hexdigest()
+
+
+def store_pdf(content, storage=None):
+    """
+    Store PDF bytes or a Django File and return its storage name.
+
+    Identical content is written only once.
+    """
+    storage = storage or default_storage
+    if isinstance(content, (bytes, bytearray)):
+        content = ContentFile(content)
+    name = blob_name(file_sha256(content))
+    if storage.exists(name):
+        return name
+
+    saved = storage.save(name, content)
+    if saved != name:
+        # Another process stored the same blob in the meantime: keep theirs
+        storage.delete(saved)
+    return name
+
+
+def iter_stored_pdfs(storage=None, path=PDF_STORE_PREFIX):
+    """Yield the storage names of every file under gammes_pdf/, blobs and legacy files alike."""
+    storage = storage or default_storage
+    try:
+        directories, files = storage.listdir(path)
+    except FileNotFoundError:
+        return
+    for name in sorted(files):
+        yield f'{path}/{name}'
+    for directory in sorted(directories):
+        yield from iter_stored_pdfs(storage, f'{path}/{directory}')
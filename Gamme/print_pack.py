@@ -0,0 +1,284 @@
+"""
+Print packs: the gamme PDFs of several missions in a single document.
+
+The stored mission PDFs (MissionControle.pdf_file) are brought up to date,
+then either merged into one PDF (with one outline entry per mission) or
+copied into a ZIP. The `build_print_pack` command renders out-of-date PDFs
+itself in parallel worker processes; the print_pack view queues them for
+`run_pdf_worker` instead (see stale_missions).
+
+Both formats are written to a file as they go, one mission PDF at a time:
+the merge copies the objects of each PDF renumbered, streams still
+compressed, and keeps only the object offsets and page numbers until the
+end, so large batches never sit in memory as a whole.
+"""
+import logging
+import os
+import shutil
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from pypdf import PdfReader
+from pypdf.generic import (
+    ArrayObject, DictionaryObject, IndirectObject, NameObject, NullObject, NumberObject, StreamObject, TextStringObject
+)
+
+from .models import MissionControle
+from .pdf_jobs import init_worker_process, mission_pdf_is_current, regenerate_mission_pdf
+
+logger = logging.getLogger(__name__)
+
+PACK_FORMATS = ('pdf', 'zip')
+
+
+def pack_missions(mission_ids=None, client=None, section=None):
+    """Missions having an active gamme, filtered and in print order (section, code)."""
+    missions = MissionControle.objects.filter(gammes__statut=True)
+    if mission_ids:
+        missions = missions.filter(id__in=mission_ids)
+    if client:
+        missions = missions.filter(client=client)
+    if section:
+        missions = missions.filter(section=section)
+    return missions.distinct().order_by('section', 'code')
+
+
+def stale_missions(missions):
+    """The missions whose stored PDF is missing or out of date."""
+    return [mission for mission in missions if not mission_pdf_is_current(mission)]
+
+
+def _refresh_pdf(mission_id):
+    try:
+        return mission_id, regenerate_mission_pdf(mission_id), ''
+    except Exception as e:
+        return mission_id, 'failed', str(e)
+
+
+def refresh_mission_pdfs(mission_ids, processes=None):
+    """
+    Re-render the stored PDFs that are out of date (unchanged ones are reused).
+
+    Returns {mission_id: (status, error)} where status is one of the
+    regenerate_mission_pdf results or 'failed'.
+    """
+    if processes is None:
+        processes = getattr(settings, 'GAMME_PRINT_PACK_PROCESSES', os.cpu_count() or 1)
+    processes = max(1, min(processes, len(mission_ids)))
+
+    if processes == 1:
+        results = map(_refresh_pdf, mission_ids)
+        return {mission_id: (status, error) for mission_id, status, error in results}
+
+    with ProcessPoolExecutor(max_workers=processes, initializer=init_worker_process) as pool:
+        results = pool.map(_refresh_pdf, mission_ids)
+        return {mission_id: (status, error) for mission_id, status, error in results}
+
+
+def _pack_name(mission):
+    return f'gamme_mission_{mission.code}.pdf'
+
+
+def _ref(number):
+    return IndirectObject(number, 0, None)
+
+
+def _renumbered(obj, renumber):
+    """Copy of a PDF object whose indirect references go through renumber()."""
+    if isinstance(obj, IndirectObject):
+        return renumber(obj)
+    if isinstance(obj, StreamObject):
+        copy = StreamObject()
+        # The raw bytes, still encoded with the /Filter kept below
+        copy._data = obj._data
+        # /Length is recomputed on write (and may be an indirect object)
+        copy.update({key: _renumbered(value, renumber) for key, value in obj.items() if key != '/Length'})
+        return copy
+    if isinstance(obj, DictionaryObject):
+        return DictionaryObject({key: _renumbered(value, renumber) for key, value in obj.items()})
+    if isinstance(obj, ArrayObject):
+        return ArrayObject([_renumbered(value, renumber) for value in obj])
+    return obj
+
+
+class PdfPackWriter:
+    """
+    Concatenate PDFs into a binary file object, writing each object as soon
+    as it is copied. Between sources only the xref offsets, the page object
+    numbers and the outline entries are kept.
+    """
+
+    def __init__(self, out):
+        self.out = out
+        self.position = 0
+        # Offset of each object by number (0 is the head of the free list)
+        self.offsets = [None]
+        self.kids = []
+        self.outline = []
+        self.write(b'%PDF-1.7\n%\xe2\xe3\xcf\xd3\n')
+        self.catalog, self.pages, self.outlines = self.reserve(), self.reserve(), self.reserve()
+
+    def write(self, data):
+        self.out.write(data)
+        self.position += len(data)
+
+    def reserve(self):
+        self.offsets.append(None)
+        return len(self.offsets) - 1
+
+    def write_object(self, number, obj):
+        self.offsets[number] = self.position
+        self.write(f'{number} 0 obj\n'.encode())
+        obj.write_to_stream(self)
+        self.write(b'\nendobj\n')
+
+    def append(self, source, title):
+        """Copy the pages of the PDF file object source, with an outline entry titled title."""
+        reader = PdfReader(source)
+        if reader.is_encrypted:
+            raise ValueError('Encrypted PDF')
+        # (source number, generation): number in the pack, and the objects left to copy
+        numbers = {}
+        pending = []
+
+        def renumber(ref):
+            key = (ref.idnum, ref.generation)
+            if key not in numbers:
+                numbers[key] = self.reserve()
+                pending.append(ref)
+            return _ref(numbers[key])
+
+        # Whatever points at the source page tree gets the pack's
+        tree = reader.root_object.raw_get('/Pages')
+        if isinstance(tree, IndirectObject):
+            numbers[(tree.idnum, tree.generation)] = self.pages
+        pages = [renumber(page.indirect_reference).idnum for page in reader.pages]
+        page_numbers = set(pages)
+        while pending:
+            ref = pending.pop()
+            number = numbers[(ref.idnum, ref.generation)]
+            obj = reader.get_object(ref)
+            if obj is None:
+                obj = NullObject()
+            elif number in page_numbers:
+                # Pages come flattened: inherited resources and boxes are in their dictionary
+                obj = DictionaryObject({key: value for key, value in obj.items() if key != '/Parent'})
+            obj = _renumbered(obj, renumber)
+            if number in page_numbers:
+                obj[NameObject('/Parent')] = _ref(self.pages)
+            self.write_object(number, obj)
+
+        self.kids.extend(pages)
+        if pages:
+            self.outline.append((title, pages[0]))
+        return len(pages)
+
+    def close(self):
+        """Write the page tree, outline, catalog and cross-reference table."""
+        items = [self.reserve() for _ in self.outline]
+        for index, ((title, page), number) in enumerate(zip(self.outline, items)):
+            item = DictionaryObject({
+                NameObject('/Title'): TextStringObject(title),
+                NameObject('/Parent'): _ref(self.outlines),
+                NameObject('/Dest'): ArrayObject([_ref(page), NameObject('/Fit')]),
+            })
+            if index:
+                item[NameObject('/Prev')] = _ref(items[index - 1])
+            if index + 1 < len(items):
+                item[NameObject('/Next')] = _ref(items[index + 1])
+            self.write_object(number, item)
+        outlines = DictionaryObject({NameObject('/Type'): NameObject('/Outlines'), NameObject('/Count'): NumberObject(len(items))})
+        if items:
+            outlines[NameObject('/First')] = _ref(items[0])
+            outlines[NameObject('/Last')] = _ref(items[-1])
+        self.write_object(self.outlines, outlines)
+        self.write_object(self.pages, DictionaryObject({
+            NameObject('/Type'): NameObject('/Pages'),
+            NameObject('/Kids'): ArrayObject([_ref(number) for number in self.kids]),
+            NameObject('/Count'): NumberObject(len(self.kids)),
+        }))
+        self.write_object(self.catalog, DictionaryObject({
+            NameObject('/Type'): NameObject('/Catalog'),
+            NameObject('/Pages'): _ref(self.pages),
+            NameObject('/Outlines'): _ref(self.outlines),
+            NameObject('/PageMode'): NameObject('/UseOutlines'),
+        }))
+        # Numbers reserved by a source that failed half way
+        for number, offset in enumerate(self.offsets):
+            if number and offset is None:
+                self.write_object(number, NullObject())
+
+        xref = self.position
+        self.write(f'xref\n0 {len(self.offsets)}\n0000000000 65535 f \n'.encode())
+        for offset in self.offsets[1:]:
+            self.write(f'{offset:010d} 00000 n \n'.encode())
+        self.write(f'trailer\n<< /Size {len(self.offsets)} /Root {self.catalog} 0 R >>\nstartxref\n{xref}\n%%EOF\n'.encode())
+
+
+def write_pdf_pack(missions, out):
+    """
+    Merge the stored PDFs of missions into one PDF on out, one outline entry
+    per mission. Returns (mission, error) for the PDFs that could not be read,
+    which are left out.
+    """
+    writer = PdfPackWriter(out)
+    failures = []
+    for mission in missions:
+        try:
+            with mission.pdf_file.open('rb') as f:
+                writer.append(f, f'{mission.code} - {mission.intitule}')
+        except Exception as e:
+            logger.error(f'Mission {mission.id} left out of the print pack: {str(e)}')
+            failures.append((mission, str(e)))
+    writer.close()
+    return failures
+
+
+def write_zip_pack(missions, out):
+    """Write the stored PDFs of missions into a ZIP archive on out."""
+    # PDFs are already compressed: storing them avoids burning CPU for nothing
+    with zipfile.ZipFile(out, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+        for mission in missions:
+            with mission.pdf_file.open('rb') as src, archive.open(_pack_name(mission), 'w', force_zip64=True) as dest:
+                shutil.copyfileobj(src, dest, 1024 * 1024)
+
+
+def build_print_pack(missions, out, fmt='pdf', processes=None, refresh=True):
+    """
+    Write the print pack of missions to the binary file object out. With
+    refresh=False, out-of-date PDFs are not rendered but left out as failures.
+
+    Returns (packed, failures): the missions included, in order, and a list of
+    (mission, error) for those whose PDF could not be produced.
+    """
+    if fmt not in PACK_FORMATS:
+        raise ValueError(f'Unknown print pack format: {fmt}')
+
+    missions = list(missions)
+    if refresh:
+        results = refresh_mission_pdfs([m.id for m in missions], processes)
+    else:
+        stale = {m.id for m in stale_missions(missions)}
+        results = {m.id: ('failed', 'PDF out of date') if m.id in stale else ('skipped', '') for m in missions}
+
+    # Reload the file names written by the workers
+    stored = MissionControle.objects.in_bulk([m.id for m in missions])
+    packed, failures = [], []
+    for mission in missions:
+        status, error = results[mission.id]
+        mission = stored[mission.id]
+        if status == 'failed' or not mission.pdf_file:
+            logger.error(f'Mission {mission.id} left out of the print pack: {error or status}')
+            failures.append((mission, error or status))
+        else:
+            packed.append(mission)
+
+    if packed and fmt == 'pdf':
+        unreadable = write_pdf_pack(packed, out)
+        left_out = {mission.id for mission, _ in unreadable}
+        packed = [mission for mission in packed if mission.id not in left_out]
+        failures.extend(unreadable)
+    elif packed:
+        write_zip_pack(packed, out)
+    return packed, failures
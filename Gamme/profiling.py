@@ -0,0 +1,239 @@
+"""
+Per-stage profiling of the PDF pipeline.
+
+A profile is opened around a PDF view (see `profile_pdf`) and code further
+down marks its stages with `stage(name)`. Stages outside an open profile cost
+nothing, so pdf.py can be instrumented unconditionally. For each stage the
+profile records the wall time, the number of SQL queries and, when
+GAMME_PDF_PROFILE_MEMORY is on, the peak traced memory. Times and queries are
+exclusive of nested stages (image decoding runs inside the pisa layout).
+
+Each profile is returned as a Server-Timing header, logged as a structured
+record and added to a rolling in-process summary (`summary()`).
+"""
+import contextvars
+import functools
+import logging
+import threading
+import time
+import tracemalloc
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+_current = contextvars.ContextVar('gamme_pdf_profile', default=None)
+
+_summary_lock = threading.Lock()
+_records = defaultdict(deque)
+
+
+class _Frame:
+    __slots__ = ('name', 'start', 'queries', 'child_time', 'child_queries', 'peak')
+
+    def __init__(self, name, queries):
+        self.name = name
+        self.start = time.perf_counter()
+        self.queries = queries
+        self.child_time = 0.0
+        self.child_queries = 0
+        self.peak = 0
+
+
+class PdfProfile:
+    """Stage measurements of one request (or worker job)."""
+
+    def __init__(self, name, trace_memory=False):
+        self.name = name
+        self.trace_memory = trace_memory
+        self.query_count = 0
+        self.stages = {}
+        self._stack = []
+        self._memory_base = 0
+        self.status = None
+        self.record = None
+
+    def _execute_wrapper(self, execute, sql, params, many, context):
+        self.query_count += 1
+        return execute(sql, params, many, context)
+
+    def _fold_peak(self):
+        # tracemalloc has a single peak counter: charge it to the innermost stage and restart it
+        if self.trace_memory and self._stack:
+            peak = tracemalloc.get_traced_memory()[1] - self._memory_base
+            self._stack[-1].peak = max(self._stack[-1].peak, peak)
+            tracemalloc.reset_peak()
+
+    def push(self, name):
+        self._fold_peak()
+        self._stack.append(_Frame(name, self.query_count))
+
+    def pop(self):
+        self._fold_peak()
+        frame = self._stack.pop()
+        elapsed = time.perf_counter() - frame.start
+        queries = self.query_count - frame.queries
+        if self._stack:
+            parent = self._stack[-1]
+            parent.child_time += elapsed
+            parent.child_queries += queries
+            parent.peak = max(parent.peak, frame.peak)
+
+        data = self.stages.setdefault(frame.name, {'ms': 0.0, 'queries': 0, 'peak_kb': 0})
+        data['ms'] += (elapsed - frame.child_time) * 1000
+        data['queries'] += queries - frame.child_queries
+        data['peak_kb'] = max(data['peak_kb'], frame.peak // 1024)
+        return elapsed
+
+    def as_record(self, total_seconds):
+        # Time spent in the root frame outside any stage is reported as 'other'
+        stages = dict(self.stages)
+        root = stages.pop('total', {'ms': 0.0, 'queries': 0, 'peak_kb': 0})
+        stages['other'] = root
+        return {
+            'endpoint': self.name,
+            'status': self.status,
+            'total_ms': round(total_seconds * 1000, 2),
+            'queries': self.query_count,
+            'peak_kb': max([data['peak_kb'] for data in stages.values()]),
+            'stages': {
+                name: {key: round(value, 2) for key, value in data.items()}
+                for name, data in stages.items()
+            },
+        }
+
+
+def server_timing(record):
+    """Format a profile record as a Server-Timing header value."""
+    metrics = []
+    for name, data in record['stages'].items():
+        metrics.append(f'{name};dur={data["ms"]:.1f};desc="{data["queries"]} queries, {data["peak_kb"]} KB"')
+    metrics.append(f'total;dur={record["total_ms"]:.1f};desc="{record["queries"]} queries, {record["peak_kb"]} KB"')
+    return ', '.join(metrics)
+
+
+@contextmanager
+def stage(name):
+    """Measure a stage of the profile open in this context, if any."""
+    profile = _current.get()
+    if profile is None:
+        yield
+        return
+    profile.push(name)
+    try:
+        yield
+    finally:
+        profile.pop()
+
+
+@contextmanager
+def pdf_profile(name):
+    """
+    Open a profile for the enclosed code and yield it.
+
+    The finished record is stored on `profile.record`, logged and added to the
+    rolling summary. Memory tracing is process-wide: with concurrent requests
+    the peaks include allocations of the other threads.
+    """
+    trace_memory = getattr(settings, 'GAMME_PDF_PROFILE_MEMORY', False)
+    started_tracing = trace_memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+
+    profile = PdfProfile(name, trace_memory=trace_memory)
+    if trace_memory:
+        profile._memory_base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+    token = _current.set(profile)
+    profile.push('total')
+    try:
+        with connection.execute_wrapper(profile._execute_wrapper):
+            yield profile
+    finally:
+        total = profile.pop()
+        _current.reset(token)
+        if started_tracing:
+            tracemalloc.stop()
+        profile.record = profile.as_record(total)
+        _store(profile.record)
+        logger.info(
+            f'PDF profile {name}: {profile.record["total_ms"]} ms, {profile.record["queries"]} queries',
+            extra={'pdf_profile': profile.record}
+        )
+
+
+def profile_pdf(name):
+    """
+    View decorator: profile the request and add a Server-Timing header.
+
+    Disabled when GAMME_PDF_PROFILING is False.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if not getattr(settings, 'GAMME_PDF_PROFILING', True):
+                return view(request, *args, **kwargs)
+            with pdf_profile(name) as profile:
+                response = view(request, *args, **kwargs)
+                profile.status = response.status_code
+            response['Server-Timing'] = server_timing(profile.record)
+            return response
+        return wrapper
+    return decorator
+
+
+def _store(record):
+    window = getattr(settings, 'GAMME_PDF_PROFILE_WINDOW', 200)
+    with _summary_lock:
+        records = _records[record['endpoint']]
+        records.append(record)
+        while len(records) > window:
+            records.popleft()
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def summary():
+    """
+    Rolling statistics of the last GAMME_PDF_PROFILE_WINDOW profiles per
+    endpoint, for this process only.
+    """
+    with _summary_lock:
+        snapshot = {endpoint: list(records) for endpoint, records in _records.items()}
+
+    result = {}
+    for endpoint, records in snapshot.items():
+        if not records:
+            continue
+        totals = [r['total_ms'] for r in records]
+        stages = defaultdict(list)
+        for r in records:
+            for name, data in r['stages'].items():
+                stages[name].append(data)
+        result[endpoint] = {
+            'count': len(records),
+            'total_ms': {
+                'mean': round(sum(totals) / len(totals), 2),
+                'p50': _percentile(totals, 0.5),
+                'p95': _percentile(totals, 0.95),
+                'max': max(totals),
+            },
+            'queries_mean': round(sum(r['queries'] for r in records) / len(records), 2),
+            'peak_kb_max': max(r['peak_kb'] for r in records),
+            'stages': {
+                name: {
+                    'mean_ms': round(sum(d['ms'] for d in items) / len(items), 2),
+                    'p95_ms': _percentile([d['ms'] for d in items], 0.95),
+                    'queries_mean': round(sum(d['queries'] for d in items) / len(items), 2),
+                    'peak_kb_max': max(d['peak_kb'] for d in items),
+                }
+                for name, items in stages.items()
+            },
+        }
+    return result
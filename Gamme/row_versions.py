@@ -0,0 +1,71 @@
+"""
+Optimistic concurrency for the mission edit page.
+
+MissionControle and GammeControle carry a row_version counter that the edit
+page sends back (row_version, <gamme>-row_version). A save claims each row
+it changes with a compare-and-swap UPDATE ... WHERE row_version = <sent>,
+which bumps the counter. When another save got there first the UPDATE
+matches no row and the save stops with EditConflict, answered with a 409
+telling what changed, instead of both saves forking their own version.
+
+`stale_rows` runs the same comparison before anything is written or any
+image processed, so most conflicts are answered without doing the work.
+"""
+from django.db.models import F
+from django.utils import timezone
+
+from .models import GammeControle, MissionControle
+
+
+class EditConflict(Exception):
+    """Rows of the form were saved by someone else since the page was loaded."""
+
+    def __init__(self, changes):
+        super().__init__(' '.join(changes))
+        self.changes = changes
+
+
+def describe(row):
+    """What happened to `row`, for the conflict message."""
+    user = row.updated_by or row.created_by
+    when = timezone.localtime(row.date_mise_a_jour).strftime('%d/%m/%Y à %H:%M')
+    if isinstance(row, MissionControle):
+        return f"La mission « {row.intitule} » a été modifiée par {user} le {when}."
+    message = f"La gamme « {row.intitule} » (version {row.version}) a été modifiée par {user} le {when}"
+    if not row.statut:
+        newer = GammeControle.objects.filter(mission_id=row.mission_id, statut=True).exclude(pk=row.pk).first()
+        if newer is not None:
+            return f"{message} ; la version active est maintenant la {newer.version}."
+    return f"{message}."
+
+
+def stale_rows(mission, payload):
+    """Messages for the rows of the form whose row_version changed since the page was loaded."""
+    changes = []
+    if payload.row_version is not None and payload.row_version != mission.row_version:
+        changes.append(describe(mission))
+    sent = {gamme_id: g.row_version for gamme_id, g in payload.gammes.items() if g.row_version is not None}
+    for gamme in GammeControle.objects.filter(mission=mission, pk__in=list(sent)).select_related('updated_by', 'created_by'):
+        if gamme.row_version != sent[gamme.id]:
+            changes.append(describe(gamme))
+    return changes
+
+
+def claim(row, expected, user, **fields):
+    """
+    Write `fields` to `row` if its row_version is still `expected` (the one
+    loaded with the row when the form did not send one), bumping it.
+    Raises EditConflict otherwise.
+    """
+    if expected is None:
+        expected = row.row_version
+    model = type(row)
+    updated = model.objects.filter(pk=row.pk, row_version=expected).update(
+        row_version=F('row_version') + 1, updated_by=user, date_mise_a_jour=timezone.now(), **fields
+    )
+    if not updated:
+        raise EditConflict([describe(model.objects.select_related('updated_by', 'created_by').get(pk=row.pk))])
+    row.row_version = expected + 1
+    row.updated_by = user
+    for field, value in fields.items():
+        setattr(row, field, value)
@@ -1,10 +1,112 @@
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models.signals import post_delete, post_init, post_save, pre_save
 from django.dispatch import receiver
-from django.contrib.auth.models import User
-from .models import profile
-
-@receiver(post_save, sender=User)
-def create_or_update_user_profile(sender, instance, created, **kwargs):
-    if created:
-        Profile.objects.create(user=instance)
-    instance.profile.save()
+
+from .images import ensure_derivatives
+from .ingest import image_metadata, keep_original, normalize_image, set_image_metadata
+from .media_blobs import blob_name_for, decref, incref
+from .models import GammeControle, PhotoDefaut, Photolimiteacceptable, PhotoOperation, epi, moyens_controle
+
+# Image fields that get web derivatives at upload time and are stored as shared blobs
+IMAGE_FIELDS = {
+    PhotoOperation: 'image',
+    PhotoDefaut: 'image',
+    Photolimiteacceptable: 'image',
+    epi: 'photo',
+    moyens_controle: 'photo',
+    GammeControle: 'photo_traitement_non_conforme',
+}
+
+# Attribute holding the file name the instance was loaded or last saved with
+_SAVED_NAME = '_blob_saved_name'
+
+
+def _field_name(instance, field):
+    value = instance.__dict__.get(field)
+    return getattr(value, 'name', value) or ''
+
+
+@receiver(pre_save)
+def normalize_uploaded_image(sender, instance, raw=False, **kwargs):
+    """Normalize images assigned from a form or request.FILES and record their metadata, as ingest_images does."""
+    field = IMAGE_FIELDS.get(sender)
+    if field is None or raw:
+        return
+    file = getattr(instance, field)
+    if not file or file._committed:
+        return
+    from PIL import Image
+
+    upload = file.file
+    try:
+        img = Image.open(upload)
+        img.load()
+    except Exception:
+        # Not decodable: left to the field validation, stored unchanged
+        upload.seek(0)
+        return
+    content, upright, filename = normalize_image(img, file.name)
+    if content is None:
+        upload.seek(0)
+        stored = upload
+    else:
+        content.name = filename
+        setattr(instance, field, content)
+        instance._image_original = (upload, file.name)
+        stored = content
+    set_image_metadata(instance, image_metadata(upright, stored, blob_name_for(stored, filename), img.format))
+
+
+@receiver(post_save)
+def store_image_original(sender, instance, raw=False, **kwargs):
+    original = instance.__dict__.pop('_image_original', None)
+    if original is None or raw:
+        return
+    row = keep_original(getattr(instance, IMAGE_FIELDS[sender]).name, *original)
+    if row is not None:
+        row.save()
+
+
+@receiver(post_save)
+def build_image_derivatives(sender, instance, raw=False, **kwargs):
+    field = IMAGE_FIELDS.get(sender)
+    if field is None or raw:
+        return
+    name = getattr(instance, field).name
+    if name:
+        # After commit, so that a rolled back upload leaves no derivative behind
+        transaction.on_commit(lambda: ensure_derivatives(name))
+
+
+@receiver(post_init)
+def remember_blob_name(sender, instance, **kwargs):
+    field = IMAGE_FIELDS.get(sender)
+    if field is None:
+        return
+    # None when the field is deferred: the previous name is then unknown
+    setattr(instance, _SAVED_NAME, _field_name(instance, field) if field in instance.__dict__ else None)
+
+
+@receiver(post_save)
+def count_blob_references(sender, instance, created, raw=False, update_fields=None, **kwargs):
+    field = IMAGE_FIELDS.get(sender)
+    if field is None or raw or (update_fields is not None and field not in update_fields):
+        return
+    previous = None if created else getattr(instance, _SAVED_NAME, None)
+    if previous is None and not created:
+        return
+    name = _field_name(instance, field)
+    if name != previous:
+        incref([name])
+        decref([previous])
+    setattr(instance, _SAVED_NAME, name)
+
+
+@receiver(post_delete)
+def release_blob(sender, instance, **kwargs):
+    field = IMAGE_FIELDS.get(sender)
+    if field is None:
+        return
+    name = getattr(instance, _SAVED_NAME, None)
+    if name:
+        decref([name])
@@ -0,0 +1,68 @@
+from django import template
+from django.utils.html import format_html, format_html_join
+
+from ..images import DERIVATIVE_SIZES, derivatives_for
+
+register = template.Library()
+
+
+def _srcset(derivatives, fmt):
+    # Small originals give several sizes of the same width: list each width once
+    candidates = {}
+    for (size, f), d in derivatives.items():
+        if f == fmt and d.width not in candidates:
+            candidates[d.width] = d
+    return ', '.join(f'{d.file.url} {width}w' for width, d in sorted(candidates.items()))
+
+
+@register.simple_tag(takes_context=True)
+def responsive_img(context, image, size='card', **attrs):
+    """
+    Render an uploaded image as a lazy-loaded <picture> with WebP and JPEG srcsets.
+
+        {% responsive_img photo.image 'thumb' class='img-thumbnail' alt=photo.description %}
+
+    `size` (thumb, card, print) is the display size the browser picks from.
+    The original URL is kept in data-full (used by the zoom overlay) and the
+    width/height attributes give the aspect ratio before loading. Views can
+    put derivatives_for(...) in the context as `image_derivatives` to avoid one
+    query per image; otherwise they are looked up here.
+    """
+    if not image:
+        return ''
+    source = image.name
+
+    preloaded = context.get('image_derivatives')
+    if preloaded is not None and source in preloaded:
+        derivatives = preloaded[source]
+    else:
+        cache = context.render_context.setdefault('gamme_image_derivatives', {})
+        if source not in cache:
+            cache.update(derivatives_for([source]))
+        derivatives = cache[source]
+
+    attrs.setdefault('alt', '')
+    attrs['loading'] = 'lazy'
+    attrs['decoding'] = 'async'
+    attrs['data-full'] = image.url
+    fallback = derivatives.get((size, 'jpeg'))
+    if fallback is None:
+        # Derivatives not built (yet): the original, still lazily loaded
+        instance = getattr(image, 'instance', None)
+        if getattr(instance, 'width', None) and getattr(instance, 'height', None):
+            attrs.setdefault('width', instance.width)
+            attrs.setdefault('height', instance.height)
+        attr_html = format_html_join(' ', '{}="{}"', attrs.items())
+        return format_html('<img src="{}" {}>', image.url, attr_html)
+
+    sizes = f'{DERIVATIVE_SIZES[size][0]}px'
+    # Intrinsic size: the browser reserves the right aspect ratio before the image loads
+    attrs.setdefault('width', fallback.width)
+    attrs.setdefault('height', fallback.height)
+    attr_html = format_html_join(' ', '{}="{}"', attrs.items())
+    return format_html(
+        '<picture><source type="image/webp" srcset="{}" sizes="{}">'
+        '<img src="{}" srcset="{}" sizes="{}" {}></picture>',
+        _srcset(derivatives, 'webp'), sizes,
+        fallback.file.url, _srcset(derivatives, 'jpeg'), sizes, attr_html
+    )
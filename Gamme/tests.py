@@ -1,3 +1,1038 @@
-from django.test import TestCase
+from io import StringIO
 
-# Create your tests here.
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from .chunked_upload import part_path
+from .mission_edit import gamme_image_names, load_gamme_details, load_mission_gammes
+from .models import ChunkedUpload, GammeControle, MediaBlob, MissionControle, OperationControle, PdfRenderJob, PhotoOperation, PhotoDefaut, User, epi, moyens_controle, validation
+from .pdf import build_gamme_pdf_context
+
+
+class TempDirMixin:
+    """
+    Run each test with the settings of temp_dir_settings pointing at a new
+    temporary directory, self.tmp, removed afterwards.
+    """
+    temp_dir_settings = ('MEDIA_ROOT',)
+
+    def temp_settings(self, path):
+        return {name: path for name in self.temp_dir_settings}
+
+    def setUp(self):
+        import tempfile
+
+        super().setUp()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.settings_override = override_settings(**self.temp_settings(self.tmp.name))
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+
+
+class GammePdfContextTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('rs', password='test', is_rs=True)
+        self.moyens = [moyens_controle.objects.create(nom=f'Moyen {i}', photo=f'photos/moyens_controle/{i}.png', ordre=i) for i in range(3)]
+        self.epi = epi.objects.create(nom='Gants', photo='photos/epi/gants.png')
+
+    def _make_gamme(self, code, nb_operations, nb_photos):
+        mission = MissionControle.objects.create(code=code, intitule='Mission', description='', reference='REF', created_by=self.user)
+        gamme = GammeControle.objects.create(mission=mission, intitule='Gamme', No_incident='1', version='1.0', created_by=self.user)
+        gamme.epis.add(self.epi)
+        gamme.moyens_controle.set(self.moyens)
+        for ordre in range(1, nb_operations + 1):
+            op = OperationControle.objects.create(gamme=gamme, ordre=ordre, description=f'Op {ordre}', created_by=self.user)
+            op.moyenscontrole.set(self.moyens[:2])
+            for i in range(nb_photos):
+                PhotoOperation.objects.create(operation=op, image=f'photos/op_{ordre}_{i}.jpg', description='')
+        for i in range(nb_photos):
+            PhotoDefaut.objects.create(gamme=gamme, image=f'photos/defauts/{i}.jpg')
+        return mission, gamme
+
+    def _count_queries(self, mission, gamme):
+        gamme = GammeControle.objects.get(pk=gamme.pk)
+        with CaptureQueriesContext(connection) as ctx:
+            context = build_gamme_pdf_context(mission, gamme)
+            # Touch everything the template iterates over
+            for op in context['operations'].values():
+                list(op['photos'])
+                list(op['moyenscontrole'])
+            list(context['photo_defauts'])
+            list(context['photo_acceptables'])
+        return len(ctx.captured_queries), context
+
+    def test_query_count_is_constant(self):
+        small_mission, small_gamme = self._make_gamme('SMALL', nb_operations=1, nb_photos=1)
+        large_mission, large_gamme = self._make_gamme('LARGE', nb_operations=12, nb_photos=4)
+
+        small_count, _ = self._count_queries(small_mission, small_gamme)
+        large_count, context = self._count_queries(large_mission, large_gamme)
+
+        self.assertEqual(small_count, large_count)
+        self.assertLessEqual(large_count, 10)
+        self.assertEqual(len(context['operations']), 12)
+        self.assertEqual(len(context['operations'][1]['photos']), 4)
+        self.assertEqual([m.ordre for m in context['unique_moyens']], [0, 1, 2])
+        self.assertEqual(context['rs_user'], self.user)
+
+    def test_pdf_and_print_pack_use_the_active_version(self):
+        from .print_pack import pack_missions
+
+        mission, active = self._make_gamme('ACTIVE', nb_operations=1, nb_photos=0)
+        # Created later but inactive: never printed
+        GammeControle.objects.create(mission=mission, intitule='Gamme', No_incident='1', version='1.1',
+                                     statut=False, created_by=self.user)
+        self.assertEqual(mission.active_gamme, active)
+
+        inactive, _ = self._make_gamme('INACTIVE', nb_operations=1, nb_photos=0)
+        inactive.gammes.update(statut=False)
+        self.assertEqual(list(pack_missions([mission.id, inactive.id])), [mission])
+
+    def test_fragment_keys_follow_content(self):
+        mission, gamme = self._make_gamme('FRAG', nb_operations=2, nb_photos=1)
+        _, before = self._count_queries(mission, gamme)
+
+        OperationControle.objects.filter(gamme=gamme, ordre=2).update(description='Modifiée')
+        _, after = self._count_queries(mission, gamme)
+
+        self.assertEqual(before['operations'][1]['fragment_key'], after['operations'][1]['fragment_key'])
+        self.assertNotEqual(before['operations'][2]['fragment_key'], after['operations'][2]['fragment_key'])
+        self.assertEqual(before['epis_fragment_key'], after['epis_fragment_key'])
+        self.assertEqual(before['defauts_fragment_key'], after['defauts_fragment_key'])
+
+    @override_settings(CACHES={
+        'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+        'gamme_fragments': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'fragments'},
+    })
+    def test_cached_fragments_render_edits(self):
+        from django.template.loader import get_template
+        from .pdf import GAMME_PDF_TEMPLATE
+
+        mission, gamme = self._make_gamme('FRAGHTML', nb_operations=2, nb_photos=1)
+        template = get_template(GAMME_PDF_TEMPLATE)
+        first = template.render(self._count_queries(mission, gamme)[1])
+        self.assertEqual(first, template.render(self._count_queries(mission, gamme)[1]))
+
+        OperationControle.objects.filter(gamme=gamme, ordre=2).update(description='Modifiée')
+        html = template.render(self._count_queries(mission, gamme)[1])
+        self.assertIn('Modifiée', html)
+        self.assertIn('Op 1', html)
+
+
+class GammePdfCacheTests(TempDirMixin, TestCase):
+    temp_dir_settings = ('GAMME_PDF_CACHE_DIR',)
+
+    def setUp(self):
+        super().setUp()
+        user = User.objects.create_user('rs', password='test', is_rs=True)
+        self.mission = MissionControle.objects.create(code='E', intitule='Mission', description='', reference='REF', created_by=user)
+        gamme = GammeControle.objects.create(mission=self.mission, intitule='Gamme', No_incident='1', version='1.0', created_by=user)
+        self.operation = OperationControle.objects.create(gamme=gamme, ordre=1, description='Op', created_by=user)
+
+    def _get(self, **headers):
+        """Response of view_gamme_pdf and the number of renders it took."""
+        from unittest import mock
+
+        from django.urls import reverse
+
+        with mock.patch('Gamme.views.render_gamme_pdf', return_value=b'%PDF-1.4 gamme') as render:
+            response = self.client.get(reverse('Gamme:view_gamme_pdf', args=[self.mission.id]), **headers)
+            if response.status_code == 200:
+                self.assertEqual(b''.join(response.streaming_content), b'%PDF-1.4 gamme')
+            response.close()
+        return response, render.call_count
+
+    def test_matching_etag_gets_304_without_rendering(self):
+        response, renders = self._get()
+        self.assertEqual((response.status_code, renders), (200, 1))
+        etag = response['ETag']
+
+        response, renders = self._get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual((response.status_code, renders), (304, 0))
+        # Served from the render cache
+        response, renders = self._get()
+        self.assertEqual((response.status_code, renders, response['ETag']), (200, 0, etag))
+
+    def test_editing_an_operation_misses_the_cache(self):
+        etag = self._get()[0]['ETag']
+
+        self.operation.description = 'Modifiée'
+        self.operation.save()
+        response, renders = self._get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual((response.status_code, renders), (200, 1))
+        self.assertNotEqual(response['ETag'], etag)
+
+
+class MissionEditLoaderTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('rs', password='test', is_rs=True)
+        self.moyens = [moyens_controle.objects.create(nom=f'Moyen {i}', photo=f'photos/moyens_controle/{i}.png', ordre=i) for i in range(3)]
+        self.epi = epi.objects.create(nom='Gants', photo='photos/epi/gants.png')
+
+    def _make_mission(self, code, nb_versions, nb_operations):
+        mission = MissionControle.objects.create(code=code, intitule='Mission', description='', reference='REF', created_by=self.user)
+        for v in range(nb_versions):
+            gamme = GammeControle.objects.create(mission=mission, intitule='Gamme', No_incident='1', version=f'{v + 1}.0',
+                                                 statut=v == nb_versions - 1, created_by=self.user)
+            gamme.epis.add(self.epi)
+            gamme.moyens_controle.set(self.moyens[:2])
+            PhotoDefaut.objects.create(gamme=gamme, image=f'photos/defauts/{code}_{v}.jpg')
+            validation.objects.create(gamme=gamme, user_ro=self.user)
+            for ordre in range(1, nb_operations + 1):
+                op = OperationControle.objects.create(gamme=gamme, ordre=ordre, description=f'Op {ordre}', created_by=self.user)
+                op.moyenscontrole.set(self.moyens[1:])
+                PhotoOperation.objects.create(operation=op, image=f'photos/op_{code}_{v}_{ordre}.jpg', description='')
+        return mission
+
+    def _count_queries(self, mission):
+        with CaptureQueriesContext(connection) as ctx:
+            gammes = load_mission_gammes(mission)
+            gamme_image_names(gammes[:1])
+            # Everything the edit template reads inside its loops
+            for gamme in gammes[:1]:
+                gamme.operations.exists()
+                gamme.first_validation and gamme.first_validation.date_validation_user_ro
+                for op in gamme.operations.all():
+                    list(op.moyenscontrole.all())
+                    op.photooperation_set.exists()
+        return len(ctx.captured_queries), gammes
+
+    def test_query_count_is_constant(self):
+        small_count, _ = self._count_queries(self._make_mission('SMALL', nb_versions=1, nb_operations=1))
+        large_count, gammes = self._count_queries(self._make_mission('LARGE', nb_versions=6, nb_operations=8))
+
+        self.assertEqual(small_count, large_count)
+        self.assertLessEqual(large_count, 7)
+        self.assertEqual(len(gammes), 6)
+        # Only the version being edited is loaded in full
+        edited = gammes[0]
+        self.assertTrue(edited.is_active)
+        self.assertFalse(hasattr(gammes[1], 'next_order'))
+        self.assertEqual(edited.next_order, 8)
+        self.assertEqual(edited.selected_moyen_ids, {self.moyens[0].id, self.moyens[1].id})
+        self.assertEqual(edited.selected_epi_ids, {self.epi.id})
+        self.assertIsNotNone(edited.first_validation)
+        op = edited.operations.all()[0]
+        self.assertEqual(op.selected_moyen_ids, {self.moyens[1].id, self.moyens[2].id})
+
+    def test_older_versions_and_galleries_are_fragments(self):
+        from django.urls import reverse
+
+        mission = self._make_mission('LAZY', nb_versions=2, nb_operations=2)
+        older = GammeControle.objects.filter(mission=mission, statut=False).get()
+        panel_url = reverse('Gamme:missioncontrole_version_panel', args=[mission.id, older.id])
+        gallery_url = reverse('Gamme:gamme_photo_gallery', args=[older.id, 'defaut'])
+        self.assertEqual(self.client.get(panel_url).status_code, 403)
+
+        self.client.force_login(self.user)
+        response = self.client.get(panel_url)
+        self.assertContains(response, 'Op 2')
+        self.assertContains(response, f'tableOperationsGamme{older.id}')
+        self.assertContains(self.client.get(gallery_url), 'deletePhotoDefaut')
+        self.assertEqual(self.client.get(reverse('Gamme:gamme_photo_gallery', args=[older.id, 'autre'])).status_code, 404)
+
+    def _edit_form(self, gamme):
+        """The fields the edit page sends for `gamme`, unchanged."""
+        data = {f'{gamme.id}-intitule': gamme.intitule, f'{gamme.id}-No_incident': gamme.No_incident,
+                f'{gamme.id}-statut': str(gamme.statut), f'{gamme.id}-temps_alloue': '',
+                f'gamme_{gamme.id}_epi_{self.epi.id}': 'on'}
+        for moyen in gamme.moyens_controle.all():
+            data[f'gamme_{gamme.id}_moyen_controle_{moyen.id}'] = 'on'
+        for op in gamme.operations.all():
+            data.update({f'{op.id}-titre': op.titre, f'{op.id}-ordre': str(op.ordre), f'{op.id}-description': op.description,
+                         f'{op.id}-criteres': op.criteres, f'{op.id}-frequence': str(op.frequence),
+                         f'{op.id}-moyen_controle': op.moyen_controle,
+                         f'{op.id}-moyenscontrole': [str(m.id) for m in op.moyenscontrole.all()]})
+            for photo in op.photooperation_set.all():
+                data[f'photo_{photo.id}_description'] = photo.description
+        return data
+
+    def test_save_applies_only_what_changed(self):
+        mission = self._make_mission('SAVE', nb_versions=1, nb_operations=2)
+        gamme = mission.gammes.get()
+        first, second = gamme.operations.order_by('ordre')
+        url = f'/gamme/missioncontrole/update/{mission.id}/'
+        self.client.force_login(self.user)
+
+        data = self._edit_form(gamme)
+        updated = gamme.date_mise_a_jour
+        self.client.post(url, data)
+        gamme.refresh_from_db()
+        self.assertEqual(gamme.date_mise_a_jour, updated)
+
+        # Operation edits and new operations are saved in place
+        data.update({f'{first.id}-ordre': '2', f'{second.id}-ordre': '1', f'{first.id}-titre': 'Contrôle visuel',
+                     f'newop_{gamme.id}_0_titre': 'Mesure'})
+        self.assertEqual(self.client.post(url, data).status_code, 302)
+        self.assertEqual(GammeControle.objects.filter(mission=mission).count(), 1)
+        self.assertEqual([(op.ordre, op.titre) for op in gamme.operations.order_by('ordre')],
+                         [(1, second.titre), (2, 'Contrôle visuel'), (3, 'Mesure')])
+
+        # A change to the gamme itself makes a new version, without the deleted photo
+        data = self._edit_form(gamme)
+        data[f'{gamme.id}-intitule'] = 'Gamme B'
+        data[f'photo_{first.photooperation_set.get().id}_DELETE'] = 'on'
+        self.client.post(url, data)
+        new = GammeControle.objects.get(mission=mission, statut=True)
+        self.assertEqual((new.intitule, new.version), ('Gamme B', '1.1'))
+        self.assertEqual([(op.ordre, op.titre, op.photooperation_set.count()) for op in new.operations.order_by('ordre')],
+                         [(1, second.titre, 1), (2, 'Contrôle visuel', 0), (3, 'Mesure', 0)])
+        self.assertEqual(PhotoOperation.objects.filter(operation__gamme=gamme).count(), 2)
+
+    def test_second_save_of_a_stale_form_gets_409(self):
+        mission = self._make_mission('RACE', nb_versions=1, nb_operations=1)
+        gamme = mission.gammes.get()
+        url = f'/gamme/missioncontrole/update/{mission.id}/'
+        self.client.force_login(self.user)
+        data = self._edit_form(gamme)
+        data.update({'row_version': '0', f'{gamme.id}-row_version': '0', f'{gamme.id}-intitule': 'Gamme B'})
+
+        self.assertEqual(self.client.post(url, data).status_code, 302)
+        response = self.client.post(url, data, headers={'X-Requested-With': 'XMLHttpRequest'})
+        self.assertEqual(response.status_code, 409)
+        self.assertIn('la version active est maintenant la 1.1', response.json()['message'])
+        self.assertEqual(GammeControle.objects.filter(mission=mission).count(), 2)
+        self.assertEqual(GammeControle.objects.filter(mission=mission, statut=True).count(), 1)
+
+        # Lost between the check and the write: the compare-and-swap refuses it
+        from .row_versions import EditConflict, claim
+        gamme.refresh_from_db()
+        with self.assertRaises(EditConflict):
+            claim(gamme, gamme.row_version - 1, self.user, statut=True)
+        self.assertFalse(GammeControle.objects.get(pk=gamme.pk).statut)
+
+    def test_conflict_leaves_the_whole_save_unapplied(self):
+        from unittest import mock
+
+        mission = self._make_mission('ATOM', nb_versions=1, nb_operations=1)
+        gamme = mission.gammes.get()
+        self.client.force_login(self.user)
+        data = self._edit_form(gamme)
+        data.update({'intitule': 'Mission B', 'row_version': '0',
+                     f'{gamme.id}-row_version': '5', f'{gamme.id}-intitule': 'Gamme B'})
+        # Saved by someone else between the early check and the writes
+        with mock.patch('Gamme.views.stale_rows', return_value=[]):
+            response = self.client.post(f'/gamme/missioncontrole/update/{mission.id}/', data)
+
+        self.assertEqual(response.status_code, 409)
+        mission.refresh_from_db()
+        self.assertEqual((mission.intitule, mission.row_version), ('Mission', 0))
+        self.assertEqual(GammeControle.objects.filter(mission=mission).count(), 1)
+
+    def test_fork_query_count_is_constant(self):
+        from .mission_payload import GammeChanges
+        from .versioning import fork_gamme
+
+        counts = []
+        for code, nb_operations in (('FORK1', 1), ('FORK8', 8)):
+            mission = self._make_mission(code, nb_versions=1, nb_operations=nb_operations)
+            gamme = load_gamme_details([mission.gammes.get()])[0]
+            with CaptureQueriesContext(connection) as ctx:
+                new = fork_gamme(GammeChanges(gamme), mission, self.user)
+            counts.append(len(ctx.captured_queries))
+
+        self.assertEqual(counts[0], counts[1])
+        self.assertEqual((new.version, new.statut), ('1.1', True))
+        self.assertEqual(set(new.moyens_controle.values_list('id', flat=True)), {self.moyens[0].id, self.moyens[1].id})
+        self.assertEqual(list(new.operations.order_by('ordre').values_list('ordre', flat=True)), list(range(1, 9)))
+        self.assertEqual(OperationControle.moyenscontrole.through.objects.filter(operationcontrole__gamme=new).count(), 16)
+        self.assertEqual(PhotoOperation.objects.filter(operation__gamme=new).count(), 8)
+        self.assertEqual(PhotoDefaut.objects.filter(gamme=new).count(), 1)
+        self.assertFalse(GammeControle.objects.get(mission=new.mission, version='1.0').statut)
+
+
+class PdfProfileTests(TestCase):
+    def test_nested_stages_are_exclusive(self):
+        from .profiling import pdf_profile, server_timing, stage
+
+        with pdf_profile('test') as profile:
+            with stage('context'):
+                User.objects.count()
+                with stage('images'):
+                    User.objects.count()
+                    User.objects.count()
+
+        stages = profile.record['stages']
+        self.assertEqual(profile.record['queries'], 3)
+        self.assertEqual(stages['context']['queries'], 1)
+        self.assertEqual(stages['images']['queries'], 2)
+        self.assertLessEqual(sum(s['ms'] for s in stages.values()), profile.record['total_ms'] + 0.1)
+        self.assertIn('context;dur=', server_timing(profile.record))
+
+
+class PdfRenderJobTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('rs', password='test', is_rs=True)
+        self.mission = MissionControle.objects.create(code='J', intitule='Mission', description='', reference='REF', created_by=self.user)
+        GammeControle.objects.create(mission=self.mission, intitule='Gamme', No_incident='1', version='1.0', created_by=self.user)
+
+    def test_generate_queues_a_job_and_running_jobs_are_not_reused(self):
+        from django.urls import reverse
+
+        from .pdf_jobs import claim_next_job
+
+        self.client.force_login(self.user)
+        response = self.client.post(reverse('Gamme:generate_mission_pdf', args=[self.mission.id]))
+        self.assertEqual(response.status_code, 202)
+        job_id = response.json()['job_id']
+        status = self.client.get(response.json()['status_url']).json()
+        self.assertEqual((status['job_id'], status['status']), (job_id, PdfRenderJob.STATUS_PENDING))
+
+        # Pending: the same job serves a second request
+        response = self.client.post(reverse('Gamme:generate_mission_pdf', args=[self.mission.id]))
+        self.assertEqual(response.json()['job_id'], job_id)
+        # Running: it may have read the gamme before the edit, a new job is queued
+        self.assertEqual(claim_next_job(), job_id)
+        response = self.client.post(reverse('Gamme:generate_mission_pdf', args=[self.mission.id]))
+        self.assertNotEqual(response.json()['job_id'], job_id)
+
+
+class PrintPackTests(TempDirMixin, TestCase):
+    def setUp(self):
+        from django.core.files.base import ContentFile
+
+        from .pdf_cache import gamme_fingerprint
+        from .pdf_store import store_pdf
+
+        super().setUp()
+        self.user = User.objects.create_user('rs', password='test', is_rs=True)
+        self.missions = []
+        self.pdfs = {'A': self._pdf('A', 2), 'B': self._pdf('B', 1)}
+        for code, pdf in self.pdfs.items():
+            mission = MissionControle.objects.create(code=code, intitule='Mission', description='', reference='REF', created_by=self.user)
+            gamme = GammeControle.objects.create(mission=mission, intitule='Gamme', No_incident='1', version='1.0', created_by=self.user)
+            # Stored PDF up to date with the gamme
+            MissionControle.objects.filter(pk=mission.pk).update(
+                pdf_file=store_pdf(ContentFile(pdf)), pdf_fingerprint=gamme_fingerprint(gamme)
+            )
+            self.missions.append(mission)
+
+    def _pdf(self, code, nb_pages):
+        import io
+
+        from pypdf import PdfWriter
+        from pypdf.generic import DecodedStreamObject
+
+        writer = PdfWriter()
+        for number in range(nb_pages):
+            page = writer.add_blank_page(200, 100)
+            content = DecodedStreamObject()
+            content.set_data(f'BT ({code} {number}) Tj ET'.encode())
+            page.replace_contents(content)
+            page.compress_content_streams()
+        out = io.BytesIO()
+        writer.write(out)
+        return out.getvalue()
+
+    def test_pdf_pack_merges_the_stored_pdfs_in_order(self):
+        import io
+
+        from django.core.files.base import ContentFile
+        from pypdf import PdfReader
+
+        from .pdf_cache import gamme_fingerprint
+        from .pdf_store import store_pdf
+        from .print_pack import build_print_pack, pack_missions
+
+        # Unreadable PDF: left out, the others are still merged
+        broken = MissionControle.objects.create(code='C', intitule='Mission', description='', reference='REF', created_by=self.user)
+        gamme = GammeControle.objects.create(mission=broken, intitule='Gamme', No_incident='1', version='1.0', created_by=self.user)
+        MissionControle.objects.filter(pk=broken.pk).update(
+            pdf_file=store_pdf(ContentFile(b'not a pdf')), pdf_fingerprint=gamme_fingerprint(gamme)
+        )
+        missions = pack_missions([m.id for m in self.missions] + [broken.id])
+
+        out = io.BytesIO()
+        packed, failures = build_print_pack(missions, out, refresh=False)
+        self.assertEqual([m.code for m in packed], ['A', 'B'])
+        self.assertEqual([m.code for m, _ in failures], ['C'])
+
+        reader = PdfReader(io.BytesIO(out.getvalue()), strict=True)
+        self.assertEqual([page.get_contents().get_data() for page in reader.pages],
+                         [b'BT (A 0) Tj ET', b'BT (A 1) Tj ET', b'BT (B 0) Tj ET'])
+        self.assertEqual([(item.title, reader.get_destination_page_number(item)) for item in reader.outline],
+                         [('A - Mission', 0), ('B - Mission', 2)])
+
+    def test_zip_pack_holds_each_stored_pdf(self):
+        import io
+        import zipfile
+
+        from .print_pack import build_print_pack, pack_missions
+
+        out = io.BytesIO()
+        packed, failures = build_print_pack(pack_missions([m.id for m in self.missions]), out, 'zip', processes=1)
+        self.assertEqual(([m.code for m in packed], failures), (['A', 'B'], []))
+        with zipfile.ZipFile(out) as archive:
+            self.assertEqual(archive.read('gamme_mission_B.pdf'), self.pdfs['B'])
+
+    def test_view_queues_out_of_date_pdfs_instead_of_rendering(self):
+        from django.urls import reverse
+
+        url = reverse('Gamme:print_pack') + f'?mission={self.missions[0].id}&mission={self.missions[1].id}'
+        self.client.force_login(self.user)
+        response = self.client.get(url)
+        self.assertEqual((response.status_code, response['Content-Type']), (200, 'application/pdf'))
+        response = self.client.get(url + '&format=zip')
+        self.assertEqual((response.status_code, response['Content-Type']), (200, 'application/zip'))
+
+        OperationControle.objects.create(gamme=self.missions[1].active_gamme, ordre=1, created_by=self.user)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual([job['mission_id'] for job in response.json()['jobs']], [self.missions[1].id])
+        self.assertEqual(PdfRenderJob.objects.filter(mission=self.missions[1], status=PdfRenderJob.STATUS_PENDING).count(), 1)
+
+
+class StoredPdfTests(TempDirMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user('rs', password='test', is_rs=True)
+        self.mission = MissionControle.objects.create(code='S', intitule='Mission', description='', reference='REF', created_by=self.user)
+        self.gamme = GammeControle.objects.create(mission=self.mission, intitule='Gamme', No_incident='1', version='1.0', created_by=self.user)
+
+    def _regenerate(self, force=False):
+        from unittest import mock
+
+        from .pdf_jobs import regenerate_mission_pdf
+
+        with mock.patch('Gamme.pdf_jobs.render_gamme_pdf', return_value=b'%PDF-1.4 stored'):
+            return regenerate_mission_pdf(self.mission.id, force=force)
+
+    def test_regeneration_skips_unchanged_gammes(self):
+        self.assertEqual(self._regenerate(), 'rendered')
+        self.assertEqual(self._regenerate(), 'skipped')
+        self.assertEqual(self._regenerate(force=True), 'rendered')
+
+        OperationControle.objects.create(gamme=self.gamme, ordre=1, created_by=self.user)
+        self.assertEqual(self._regenerate(), 'rendered')
+        self.assertEqual(self._regenerate(), 'skipped')
+
+    def test_identical_pdfs_share_one_blob_and_gc_reclaims_the_rest(self):
+        import os
+
+        from django.core.files.base import ContentFile
+        from django.core.files.storage import default_storage
+        from django.core.management import call_command
+
+        from .pdf_store import is_blob_name, store_pdf
+
+        name = store_pdf(b'%PDF-1.4 same')
+        self.assertTrue(is_blob_name(name))
+        self.assertEqual(store_pdf(ContentFile(b'%PDF-1.4 same')), name)
+
+        # A legacy upload still referenced, and an unreferenced leftover
+        legacy = default_storage.save('gammes_pdf/gamme_S.pdf', ContentFile(b'%PDF-1.4 same'))
+        leftover = default_storage.save('gammes_pdf/old.pdf', ContentFile(b'%PDF-1.4 old'))
+        MissionControle.objects.filter(pk=self.mission.pk).update(pdf_file=legacy)
+
+        call_command('gc_gamme_pdfs', '--grace-hours', '0', stdout=StringIO())
+        self.mission.refresh_from_db()
+        self.assertEqual(self.mission.pdf_file.name, name)
+        self.assertTrue(default_storage.exists(name))
+        self.assertFalse(os.path.exists(os.path.join(self.tmp.name, legacy)))
+        self.assertFalse(os.path.exists(os.path.join(self.tmp.name, leftover)))
+
+
+class ChunkedUploadTests(TempDirMixin, TestCase):
+    temp_dir_settings = ('GAMME_CHUNKED_UPLOAD_DIR',)
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user('rs', password='test', is_rs=True)
+        mission = MissionControle.objects.create(code='C', intitule='Mission', description='', reference='REF', created_by=self.user)
+        self.gamme = GammeControle.objects.create(mission=mission, intitule='Gamme', No_incident='1', version='1.0', created_by=self.user)
+        self.client.force_login(self.user)
+
+    def test_resume_after_wrong_offset(self):
+        data = b'0123456789'
+        response = self.client.post('/gamme/uploads/', {'kind': 'defaut', 'filename': 'a.jpg', 'size': len(data), 'gamme_id': self.gamme.id})
+        self.assertEqual(response.status_code, 201)
+        url = response.json()['upload_url']
+
+        response = self.client.put(url, data[:4], content_type='application/octet-stream', HTTP_CONTENT_RANGE='bytes 0-3/10')
+        self.assertEqual(response.json()['offset'], 4)
+        # Replayed chunk: the server tells where to resume
+        response = self.client.put(url, data[:4], content_type='application/octet-stream', HTTP_CONTENT_RANGE='bytes 0-3/10')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['offset'], 4)
+        self.assertEqual(self.client.post(url + 'complete/').status_code, 409)
+
+        response = self.client.put(url, data[4:], content_type='application/octet-stream', HTTP_CONTENT_RANGE='bytes 4-9/10')
+        self.assertEqual(response.json()['offset'], 10)
+        upload = ChunkedUpload.objects.get()
+        with open(part_path(upload), 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+
+class PhotoUploadTests(TempDirMixin, TransactionTestCase):
+    # Committed rows: the ingest worker threads read the blob table through
+    # their own connections, which a test transaction would keep locked
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user('rs', password='test', is_rs=True)
+        mission = MissionControle.objects.create(code='U', intitule='Mission', description='', reference='REF', created_by=self.user)
+        self.gamme = GammeControle.objects.create(mission=mission, intitule='Gamme', No_incident='1', version='1.0', created_by=self.user)
+
+    def test_bad_file_fails_alone_in_a_batch(self):
+        from io import BytesIO
+
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from django.urls import reverse
+        from PIL import Image
+
+        buffer = BytesIO()
+        Image.new('RGB', (64, 48), 'maroon').save(buffer, 'JPEG')
+        photos = [
+            SimpleUploadedFile('good.jpg', buffer.getvalue(), content_type='image/jpeg'),
+            SimpleUploadedFile('<img src=x>.jpg', b'not an image', content_type='image/jpeg'),
+        ]
+        self.client.force_login(self.user)
+        response = self.client.post(reverse('Gamme:upload_photo_defaut'), {'gamme_id': self.gamme.id, 'photos': photos})
+
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual([r['success'] for r in data['results']], [True, False])
+        self.assertEqual(data['results'][1]['name'], '<img src=x>.jpg')
+        photo = PhotoDefaut.objects.get(gamme=self.gamme)
+        self.assertEqual((photo.width, photo.height, photo.created_by), (64, 48, self.user))
+
+    def test_identical_uploads_share_one_set_of_derivatives(self):
+        import os
+        from io import BytesIO
+        from unittest import mock
+
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from django.urls import reverse
+        from PIL import Image
+
+        from .models import ImageDerivative
+
+        buffer = BytesIO()
+        Image.new('RGB', (640, 480), 'navy').save(buffer, 'JPEG')
+        upload = lambda: SimpleUploadedFile('same.jpg', buffer.getvalue(), content_type='image/jpeg')
+        url = reverse('Gamme:upload_photo_defaut')
+        self.client.force_login(self.user)
+        self.client.post(url, {'gamme_id': self.gamme.id, 'photos': [upload(), upload()]})
+
+        name = PhotoDefaut.objects.values_list('image', flat=True).distinct().get()
+        self.assertEqual(ImageDerivative.objects.filter(source=name).count(), 6)
+        files = [f for _, _, names in os.walk(os.path.join(self.tmp.name, 'derivatives')) for f in names]
+        self.assertEqual(len(files), 6)
+
+        # Uploaded again: the derivatives are not rendered a second time
+        with mock.patch('Gamme.ingest.render_derivatives') as render:
+            self.client.post(url, {'gamme_id': self.gamme.id, 'photos': [upload()]})
+        render.assert_not_called()
+        self.assertEqual(PhotoDefaut.objects.filter(image=name).count(), 3)
+
+
+class MediaBlobTests(TempDirMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        user = User.objects.create_user('rs', password='test', is_rs=True)
+        mission = MissionControle.objects.create(code='C', intitule='Mission', description='', reference='REF', created_by=user)
+        self.gamme = GammeControle.objects.create(mission=mission, intitule='Gamme', No_incident='1', version='1.0', created_by=user)
+
+    def test_shared_blob_is_deleted_with_last_reference(self):
+        from django.core.files.base import ContentFile
+        from django.core.files.storage import default_storage
+
+        from .media_blobs import incref
+
+        photos = []
+        for filename in ('a.jpg', 'b.jpg'):
+            photo = PhotoDefaut(gamme=self.gamme)
+            photo.image.save(filename, ContentFile(b'same bytes'))
+            photos.append(photo)
+        name = photos[0].image.name
+        self.assertEqual(photos[1].image.name, name)
+
+        # Forking a version copies rows only
+        PhotoDefaut.objects.bulk_create([PhotoDefaut(gamme=self.gamme, image=name)])
+        incref([name])
+        self.assertEqual(MediaBlob.objects.get(name=name).refcount, 3)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            for photo in PhotoDefaut.objects.all()[:2]:
+                photo.delete()
+        self.assertEqual(MediaBlob.objects.get(name=name).refcount, 1)
+        self.assertTrue(default_storage.exists(name))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            PhotoDefaut.objects.get().delete()
+        self.assertFalse(MediaBlob.objects.filter(name=name).exists())
+        self.assertFalse(default_storage.exists(name))
+
+    def test_uploads_fan_out_and_older_layouts_are_migrated(self):
+        import hashlib
+
+        from django.core.files.base import ContentFile
+        from django.core.files.storage import default_storage
+        from django.core.management import call_command
+
+        from .media_blobs import blob_name
+
+        photo = PhotoDefaut(gamme=self.gamme)
+        photo.image.save('a.jpg', ContentFile(b'fan out bytes'))
+        sha256 = hashlib.sha256(b'fan out bytes').hexdigest()
+        self.assertEqual(photo.image.name, f'blobs/{sha256[:2]}/{sha256[2:4]}/{sha256}.jpg')
+
+        # The same bytes under the single-level blob layout and as a plain upload
+        sha256 = hashlib.sha256(b'older layout').hexdigest()
+        flat = default_storage.save(f'blobs/{sha256[:2]}/{sha256}.jpg', ContentFile(b'older layout'))
+        legacy = default_storage.save('photos/defauts/old.jpg', ContentFile(b'older layout'))
+        PhotoDefaut.objects.bulk_create([PhotoDefaut(gamme=self.gamme, image=flat), PhotoDefaut(gamme=self.gamme, image=legacy)])
+
+        call_command('migrate_media_blobs', stdout=StringIO())
+        name = blob_name(sha256, '.jpg')
+        self.assertEqual(set(PhotoDefaut.objects.exclude(pk=photo.pk).values_list('image', flat=True)), {name})
+        self.assertEqual(MediaBlob.objects.get(name=name).refcount, 2)
+        self.assertFalse(default_storage.exists(flat))
+        self.assertFalse(default_storage.exists(legacy))
+
+    def test_orphans_older_than_the_cutoff_are_quarantined(self):
+        import os
+        import time
+
+        from django.core.files.base import ContentFile
+        from django.core.files.storage import default_storage
+        from django.core.management import call_command
+
+        photo = PhotoDefaut(gamme=self.gamme)
+        photo.image.save('a.jpg', ContentFile(b'referenced'))
+        orphan = default_storage.save('photos/defauts/orphan.jpg', ContentFile(b'orphan'))
+        recent = default_storage.save('photos/defauts/recent.jpg', ContentFile(b'recent'))
+        two_days_ago = time.time() - 48 * 3600
+        for name in (photo.image.name, orphan):
+            os.utime(os.path.join(self.tmp.name, name), (two_days_ago, two_days_ago))
+
+        quarantine = os.path.join(self.tmp.name, 'quarantine')
+        call_command('reclaim_orphan_media', '--apply', '--quarantine', quarantine, stdout=StringIO())
+        self.assertTrue(default_storage.exists(photo.image.name))
+        self.assertTrue(default_storage.exists(recent))
+        self.assertFalse(default_storage.exists(orphan))
+        self.assertTrue(os.path.exists(os.path.join(quarantine, orphan)))
+
+    def test_link_or_copy_shares_the_file_on_one_filesystem(self):
+        import os
+
+        from .media_blobs import link_or_copy
+
+        source = os.path.join(self.tmp.name, 'source.jpg')
+        target = os.path.join(self.tmp.name, 'blobs', 'aa', 'target.jpg')
+        with open(source, 'wb') as f:
+            f.write(b'x' * 100000)
+        self.assertEqual(link_or_copy(source, target), 'link')
+        self.assertTrue(os.path.samefile(source, target))
+        # Already there: nothing to do
+        self.assertEqual(link_or_copy(source, target), 'link')
+
+    def test_photos_of_old_inactive_version_move_to_cold_storage(self):
+        import os
+        from datetime import timedelta
+
+        from django.core.files.base import ContentFile
+        from django.utils import timezone
+
+        from .cold_storage import archive_blobs, restore_blob, tiering_candidates
+        from .pdf import fetch_resources
+
+        photo = PhotoDefaut(gamme=self.gamme)
+        photo.image.save('a.jpg', ContentFile(b'old version bytes'))
+        name = photo.image.name
+        self.assertEqual(tiering_candidates(30), ([], []))
+
+        GammeControle.objects.filter(pk=self.gamme.pk).update(statut=False, date_mise_a_jour=timezone.now() - timedelta(days=31))
+        with override_settings(GAMME_MEDIA_ARCHIVE_DIR=os.path.join(self.tmp.name, 'archive'),
+                               GAMME_MEDIA_COLD_CACHE_DIR=os.path.join(self.tmp.name, 'cold')):
+            to_archive, _ = tiering_candidates(30)
+            self.assertEqual(to_archive, [name])
+            with self.captureOnCommitCallbacks(execute=True):
+                archive_blobs(to_archive)
+            self.assertFalse(os.path.exists(os.path.join(self.tmp.name, name)))
+
+            # Still read through the storage API
+            photo = PhotoDefaut.objects.get()
+            self.assertEqual(photo.image.size, len(b'old version bytes'))
+            with photo.image.open('rb') as f:
+                self.assertEqual(f.read(), b'old version bytes')
+
+            # And served by /media/ and to the PDF renderer from the cold cache
+            self.client.force_login(User.objects.get())
+            response = self.client.get(photo.image.url)
+            self.assertEqual(b''.join(response.streaming_content), b'old version bytes')
+            response.close()
+            path = fetch_resources(photo.image.url, None)
+            self.assertTrue(path.startswith(os.path.join(self.tmp.name, 'cold')))
+            # Handed to nginx like the hot files
+            roots = {self.tmp.name: '/protected/media/', os.path.join(self.tmp.name, 'cold'): '/protected/media_cold/'}
+            with override_settings(FILE_DELIVERY_BACKEND='nginx', FILE_DELIVERY_ROOTS=roots):
+                response = self.client.get(photo.image.url)
+            self.assertEqual(response['X-Accel-Redirect'], f'/protected/media_cold/{name}')
+
+            GammeControle.objects.filter(pk=self.gamme.pk).update(statut=True)
+            self.assertEqual(tiering_candidates(30), ([], [name]))
+            self.assertTrue(restore_blob(name))
+            self.assertTrue(os.path.exists(os.path.join(self.tmp.name, name)))
+
+
+class ImageNormalizationTests(TestCase):
+    @override_settings(GAMME_IMAGE_MAX_SIDE=1000)
+    def test_rotated_photo_is_upright_capped_and_stripped(self):
+        from io import BytesIO
+
+        from PIL import Image
+
+        from .ingest import normalize_image
+
+        exif = Image.Exif()
+        exif[0x0112] = 6  # Rotated 90°
+        buffer = BytesIO()
+        Image.new('RGB', (2000, 1500), 'orange').save(buffer, 'JPEG', exif=exif)
+        buffer.seek(0)
+
+        content, upright, filename = normalize_image(Image.open(buffer), 'photo.jpeg')
+        stored = Image.open(content)
+        self.assertEqual(filename, 'photo.jpg')
+        self.assertEqual(stored.size, (750, 1000))
+        self.assertNotIn('exif', stored.info)
+
+        # A normalized image is kept byte for byte
+        self.assertIsNone(normalize_image(stored, filename)[0])
+
+
+class ImageMetadataTests(TempDirMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user('rs', password='test', is_rs=True)
+        self.mission = MissionControle.objects.create(code='C', intitule='Mission', description='', reference='REF', created_by=self.user)
+
+    def _upload(self, filename, size):
+        from io import BytesIO
+
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from PIL import Image
+
+        buffer = BytesIO()
+        Image.new('RGB', size, 'teal').save(buffer, 'PNG')
+        return SimpleUploadedFile(filename, buffer.getvalue(), content_type='image/png')
+
+    def test_epi_moyen_and_non_conforme_pictures_are_known_to_the_pdf(self):
+        from django.core.management import call_command
+
+        equipment = epi.objects.create(nom='Gants', photo=self._upload('gants.png', (40, 30)))
+        moyen = moyens_controle.objects.create(nom='Pied à coulisse', ordre=1, photo=self._upload('pied.png', (20, 10)))
+        gamme = GammeControle.objects.create(
+            mission=self.mission, intitule='Gamme', No_incident='1', version='1.0', created_by=self.user,
+            photo_traitement_non_conforme=self._upload('nc.png', (60, 50))
+        )
+        gamme.epis.add(equipment)
+        gamme.moyens_controle.add(moyen)
+        self.assertEqual((equipment.width, equipment.height, equipment.mime_type), (40, 30, 'image/png'))
+        self.assertEqual((gamme.photo_non_conforme_width, gamme.photo_non_conforme_height), (60, 50))
+
+        epi.objects.update(width=None, sha256='')
+        GammeControle.objects.update(photo_non_conforme_width=None, photo_non_conforme_sha256='')
+        call_command('backfill_image_metadata', '--workers', '1', stdout=StringIO())
+        gamme.refresh_from_db()
+        self.assertEqual(epi.objects.get().width, 40)
+        self.assertEqual(gamme.photo_non_conforme_width, 60)
+        self.assertEqual(len(gamme.photo_non_conforme_sha256), 64)
+
+        metadata = build_gamme_pdf_context(self.mission, gamme)['image_metadata']
+        self.assertEqual(metadata[equipment.photo.name][:2], (40, 30))
+        self.assertEqual(metadata[moyen.photo.name][:2], (20, 10))
+        self.assertEqual(metadata[gamme.photo_traitement_non_conforme.name][:2], (60, 50))
+
+    def test_new_non_conforme_photo_is_stored_before_the_fork_transaction(self):
+        import os
+        from unittest import mock
+
+        from .mission_payload import GammeChanges
+        from .row_versions import EditConflict
+        from .versioning import fork_gamme
+
+        gamme = GammeControle.objects.create(mission=self.mission, intitule='Gamme', No_incident='1', version='1.0', created_by=self.user)
+        changes = GammeChanges(load_gamme_details([gamme])[0])
+        changes.non_conforme_photo = self._upload('nc.png', (60, 50))
+        # Claim refused: the picture stored for the new version does not stay behind
+        with mock.patch('Gamme.versioning.claim', side_effect=EditConflict(['Modifiée'])):
+            with self.assertRaises(EditConflict):
+                fork_gamme(changes, self.mission, self.user)
+        self.assertEqual([f for _, _, names in os.walk(self.tmp.name) for f in names], [])
+
+        changes.non_conforme_photo = self._upload('nc.png', (60, 50))
+        with mock.patch('Gamme.signals.normalize_image') as normalize:
+            new = fork_gamme(changes, self.mission, self.user)
+        # Nothing left to decode or write in the transaction
+        normalize.assert_not_called()
+        self.assertEqual((new.photo_non_conforme_width, new.photo_non_conforme_height), (60, 50))
+        self.assertEqual(MediaBlob.objects.get(name=new.photo_traitement_non_conforme.name).refcount, 1)
+
+
+class FileDeliveryTests(TempDirMixin, TestCase):
+    def setUp(self):
+        import os
+
+        from django.test import RequestFactory
+
+        super().setUp()
+        self.path = os.path.join(self.tmp.name, 'photo.jpg')
+        with open(self.path, 'wb') as f:
+            f.write(b'0123456789')
+        self.factory = RequestFactory()
+
+    def test_range_request_gets_partial_content(self):
+        from .delivery import serve_file
+
+        response = serve_file(self.factory.get('/', HTTP_RANGE='bytes=2-5'), self.path)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 2-5/10')
+        self.assertEqual(b''.join(response.streaming_content), b'2345')
+
+        response = serve_file(self.factory.get('/', HTTP_RANGE='bytes=20-'), self.path)
+        self.assertEqual(response.status_code, 416)
+
+    def test_matching_etag_gets_304(self):
+        from .delivery import serve_file
+
+        response = serve_file(self.factory.get('/'), self.path)
+        etag = response['ETag']
+        response.close()
+        response = serve_file(self.factory.get('/', HTTP_IF_NONE_MATCH=etag), self.path)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_directory_is_not_found(self):
+        from django.http import Http404
+
+        from .delivery import serve_file
+
+        with self.assertRaises(Http404):
+            serve_file(self.factory.get('/'), self.tmp.name)
+
+    def test_media_requires_login_unless_disabled(self):
+        self.assertEqual(self.client.get('/media/photo.jpg').status_code, 403)
+        with self.settings(GAMME_MEDIA_REQUIRE_LOGIN=False):
+            response = self.client.get('/media/photo.jpg')
+            self.assertEqual(response.status_code, 200)
+            response.close()
+        User.objects.create_user('rs', password='test', is_rs=True)
+        self.client.login(username='rs', password='test')
+        response = self.client.get('/media/photo.jpg')
+        self.assertEqual(response.status_code, 200)
+        response.close()
+
+
+class PdfImageTests(TempDirMixin, TestCase):
+    def temp_settings(self, path):
+        import os
+
+        return {'MEDIA_ROOT': path, 'GAMME_PDF_IMAGES_DIR': os.path.join(path, 'pdf_images'), 'GAMME_PDF_IMAGE_SCALE': 2}
+
+    def setUp(self):
+        import os
+
+        from PIL import Image
+
+        super().setUp()
+        self.source = os.path.join(self.tmp.name, 'photos', 'large.jpg')
+        os.makedirs(os.path.dirname(self.source))
+        Image.new('RGB', (1200, 900), 'navy').save(self.source, 'JPEG')
+
+    def test_slot_gets_a_copy_sized_for_its_box(self):
+        from PIL import Image
+
+        from .images import pdf_image_path
+
+        path = pdf_image_path(self.source, 'operation')
+        self.assertNotEqual(path, self.source)
+        with Image.open(path) as img:
+            # 150x100 box at twice the CSS size
+            self.assertEqual(img.size, (267, 200))
+        self.assertEqual(pdf_image_path(self.source, 'operation'), path)
+        self.assertEqual(pdf_image_path(self.source, 'unknown'), self.source)
+
+    def test_stored_metadata_finds_the_copy_without_the_source(self):
+        import os
+
+        from django.conf import settings
+
+        from .images import pdf_image_path
+        from .pdf import _image_metadata, fetch_resources
+
+        metadata = (1200, 900, os.path.getsize(self.source), 'a' * 64)
+        path = pdf_image_path(self.source, 'epi', metadata)
+        os.remove(self.source)
+        self.assertEqual(pdf_image_path(self.source, 'epi', metadata), path)
+
+        token = _image_metadata.set({'photos/large.jpg': metadata})
+        try:
+            self.assertEqual(fetch_resources(f'{settings.MEDIA_URL}photos/large.jpg?pdf=epi', None), path)
+        finally:
+            _image_metadata.reset(token)
+        # Small enough for its slot: the original is embedded as it is
+        self.assertEqual(pdf_image_path(self.source, 'operation', (100, 80, 5000, 'b' * 64)), self.source)
+
+
+class ResponsiveImageTests(TempDirMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        user = User.objects.create_user('rs', password='test', is_rs=True)
+        mission = MissionControle.objects.create(code='R', intitule='Mission', description='', reference='REF', created_by=user)
+        self.gamme = GammeControle.objects.create(mission=mission, intitule='Gamme', No_incident='1', version='1.0', created_by=user)
+
+    def _render(self, photo):
+        from django.template import Context, Template
+
+        return Template("{% load gamme_images %}{% responsive_img photo.image 'thumb' alt='Défaut' %}").render(Context({'photo': photo}))
+
+    def test_upload_gets_derivatives_and_falls_back_to_the_original_before(self):
+        from io import BytesIO
+
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from PIL import Image
+
+        from .models import ImageDerivative
+
+        buffer = BytesIO()
+        Image.new('RGB', (800, 600), 'olive').save(buffer, 'JPEG')
+        photo = PhotoDefaut(gamme=self.gamme, image=SimpleUploadedFile('defaut.jpg', buffer.getvalue()))
+        with self.captureOnCommitCallbacks() as callbacks:
+            photo.save()
+
+        # Derivatives are built once the upload is committed: the original meanwhile
+        html = self._render(photo)
+        self.assertNotIn('<picture>', html)
+        self.assertIn(f'src="{photo.image.url}"', html)
+        self.assertIn('width="800" height="600"', html)
+
+        for callback in callbacks:
+            callback()
+        self.assertEqual(ImageDerivative.objects.filter(source=photo.image.name).count(), 6)
+        thumb = ImageDerivative.objects.get(source=photo.image.name, size='thumb', format='jpeg')
+        self.assertEqual((thumb.width, thumb.height), (160, 120))
+        html = self._render(photo)
+        self.assertIn('<source type="image/webp"', html)
+        self.assertIn(f'src="{thumb.file.url}"', html)
+        self.assertIn(f'data-full="{photo.image.url}"', html)
+
+    def test_rebuilt_derivatives_replace_the_files_in_place(self):
+        import os
+        from unittest import mock
+
+        from django.core.files.base import ContentFile
+        from django.core.files.storage import default_storage
+        from PIL import Image
+
+        from .images import render_derivatives
+
+        source = default_storage.save('photos/source.jpg', ContentFile(b'original'))
+        first = render_derivatives(Image.new('RGB', (800, 600), 'teal'), source)
+        with mock.patch.object(default_storage, 'delete') as delete:
+            second = render_derivatives(Image.new('RGB', (800, 600), 'teal'), source)
+        delete.assert_not_called()
+        self.assertEqual([d.file.name for d in second], [d.file.name for d in first])
+        files = [f for _, _, names in os.walk(os.path.join(self.tmp.name, 'derivatives')) for f in names]
+        self.assertEqual(len(files), 6)
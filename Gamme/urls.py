@@ -1,5 +1,5 @@
 from django.urls import path
-from .views import (GammeControleCreateView, GammeControleDetailView, GammeControleListView, GammeControleUpdateView, GammeControleDeleteView, view_gamme_pdf, 
+from .views import (GammeControleCreateView, GammeControleDetailView, GammeControleListView, GammeControleUpdateView, GammeControleDeleteView, view_gamme_pdf, download_gamme_pdf, 
                     MissionControleCreateView, MissionControleListView, MissionControleUpdateView, MissionControleDeleteView,
                     OperationControleCreateView, OperationControleListView, OperationControleUpdateView, OperationControleDeleteView,
                     OperationControleDetailView, EpiListView, EpiCreateView, EpiUpdateView, EpiDeleteView,
@@ -8,7 +8,9 @@ from .views import (GammeControleCreateView, GammeControleDetailView, GammeContr
                     login, logoutView, RegisterView, ajouter_utilisateur, save_mission_pdf, upload_photo_defaut, delete_photo_defaut,
                     upload_photo_acceptable, delete_photo_acceptable,
                     MoyenControleListView, MoyenControleCreateView, MoyenControleUpdateView, MoyenControleDeleteView, check_mission_code,
-                    validate_gamme, generate_and_save_gamme_pdf)
+                    validate_gamme, generate_and_save_gamme_pdf, pdf_job_status, print_pack,
+                    pdf_profile_stats, chunked_upload_start, chunked_upload_detail, chunked_upload_complete,
+                    missioncontrole_version_panel, gamme_photo_gallery)
 app_name = 'Gamme'
 urlpatterns = [
     path('gamme/gammecontrole/create/', GammeControleCreateView.as_view(), name='gammecontrole_create'),
@@ -20,6 +22,8 @@ urlpatterns = [
     path('gamme/missioncontrole/list/', MissionControleListView.as_view(), name='missioncontrole_list'),
     path('gamme/missioncontrole/update/<int:pk>/', MissionControleUpdateView.as_view(), name='missioncontrole_update'),
     path('gamme/missioncontrole/delete/<int:pk>/', MissionControleDeleteView.as_view(), name='missioncontrole_delete'),
+    path('gamme/missioncontrole/update/<int:pk>/versions/<int:gamme_id>/', missioncontrole_version_panel, name='missioncontrole_version_panel'),
+    path('gamme/gamme/<int:gamme_id>/photos/<str:kind>/', gamme_photo_gallery, name='gamme_photo_gallery'),
     
     path('gamme/operationcontrole/create/', OperationControleCreateView.as_view(), name='operationcontrole_create'),
     path('gamme/operationcontrole/list/', OperationControleListView.as_view(), name='operationcontrole_list'),
@@ -47,9 +51,17 @@ urlpatterns = [
     # URL for viewing the PDF in browser
     path('gamme/pdf/<int:mission_id>/', view_gamme_pdf, name='view_gamme_pdf'),
     # URL for downloading generated PDF
+    path('gamme/pdf/<int:mission_id>/download/', download_gamme_pdf, name='download_gamme_pdf'),
     # URL for saving PDF to server
     path('gamme/missioncontrole/<int:mission_id>/save-pdf/', save_mission_pdf, name='save_mission_pdf'),
     path('gamme/missioncontrole/<int:mission_id>/generate-pdf/', generate_and_save_gamme_pdf, name='generate_mission_pdf'),
+    # URL for polling a background PDF render job
+    path('gamme/pdf-jobs/<int:job_id>/', pdf_job_status, name='pdf_job_status'),
+    path('gamme/print-pack/', print_pack, name='print_pack'),
+    path('gamme/pdf-stats/', pdf_profile_stats, name='pdf_profile_stats'),
+    path('gamme/uploads/', chunked_upload_start, name='chunked_upload_start'),
+    path('gamme/uploads/<uuid:token>/', chunked_upload_detail, name='chunked_upload_detail'),
+    path('gamme/uploads/<uuid:token>/complete/', chunked_upload_complete, name='chunked_upload_complete'),
     # URL for generating and saving PDF
     
     # Gamme validation URL
@@ -0,0 +1,169 @@
+"""
+Forking a gamme into a new version.
+
+A version is a full copy of the gamme: operations, their moyens and photos,
+the gamme's moyens, EPIs and defect photos. `fork_gamme` writes the copy
+with one bulk INSERT per table inside one transaction, orders computed in
+memory, so the number of queries does not depend on the number of
+operations or photos. Photo copies are rows only: they share the image
+blobs of the original (see media_blobs.incref).
+
+The transaction starts by claiming the forked gamme (row_versions.claim),
+so of two saves forking the same version only the first succeeds. What can
+be read or computed beforehand is, and uploaded photos are stored once the
+outermost transaction commits (mission_payload.store_photos). A new
+non-conformity photo is normalized and stored before it starts: the write
+lock is held for the inserts only.
+"""
+import logging
+from contextlib import contextmanager
+
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import F
+
+from .ingest import IMAGE_METADATA_FIELDS, image_metadata_columns, store_image
+from .media_blobs import discard, incref
+from .mission_payload import GAMME_CHECKBOXES, GAMME_FIELDS, new_operation_values, store_photos
+from .models import GammeControle, ImageDerivative, OperationControle, PhotoDefaut, PhotoOperation
+from .row_versions import claim
+
+GammeMoyen = GammeControle.moyens_controle.through
+GammeEpi = GammeControle.epis.through
+OperationMoyen = OperationControle.moyenscontrole.through
+
+logger = logging.getLogger(__name__)
+
+
+def next_version(gamme):
+    return round(float(gamme.version or 1.0) + 0.1, 1)
+
+
+def _ids(ids):
+    return [int(i) for i in ids if str(i).isdigit()]
+
+
+def _store_non_conforme_photo(upload):
+    """store_image() of an uploaded non-conformity photo; None when it is not a valid image."""
+    stored = store_image(GammeControle(), 'photo_traitement_non_conforme', upload)
+    if stored['error'] is not None:
+        logger.warning(f"Photo {upload.name} not saved: {stored['error']}")
+        return None
+    return stored
+
+
+@contextmanager
+def _discard_on_error(stored):
+    """Delete a photo stored for the new version when its transaction fails (EditConflict...)."""
+    try:
+        yield
+    except Exception:
+        if stored is not None:
+            try:
+                if discard(stored['instance'].photo_traitement_non_conforme.name):
+                    for d in stored['derivatives']:
+                        default_storage.delete(d.file.name)
+            except Exception:
+                pass
+        raise
+
+
+def fork_gamme(changes, mission, user):
+    """
+    Save `changes` (a mission_payload.GammeChanges, empty for a plain copy)
+    as a new active version of its gamme, and deactivate the active versions
+    of the same gamme. The gamme must be loaded with
+    mission_edit.load_gamme_details.
+
+    Operations are copied in their edited order and renumbered 1..n, new
+    operations follow. Photos are copied except deleted ones, with their
+    edited descriptions. Returns the new gamme, or None when that version
+    already exists. Raises row_versions.EditConflict when the gamme was
+    saved by someone else since the form was loaded.
+    """
+    gamme = changes.gamme
+    version = next_version(gamme)
+    if GammeControle.objects.filter(mission=mission, intitule=gamme.intitule, version=str(version)).exists():
+        return None
+
+    operations = sorted(gamme.operations.all(), key=lambda op: (changes.operation_values(op)['ordre'], op.ordre))
+    defects = list(PhotoDefaut.objects.filter(gamme=gamme))
+    photo = None
+    if changes.non_conforme_photo is not None:
+        photo = _store_non_conforme_photo(changes.non_conforme_photo)
+    with _discard_on_error(photo), transaction.atomic():
+        claim(gamme, changes.row_version, user, statut=False)
+        GammeControle.objects.filter(mission=mission, intitule=gamme.intitule, statut=True).exclude(pk=gamme.pk).update(
+            statut=False, row_version=F('row_version') + 1
+        )
+
+        values = {attribute: getattr(gamme, attribute) for attribute in list(GAMME_FIELDS.values()) + list(GAMME_CHECKBOXES)}
+        values.update(changes.fields)
+        # The picture comes with its metadata: the stored upload's, else the current one's
+        source = gamme if photo is None else photo['instance']
+        values.update({column: getattr(source, column) for column in image_metadata_columns(GammeControle).values()})
+        new_gamme = GammeControle.objects.create(
+            mission=mission,
+            statut=True,
+            version=str(version),
+            photo_traitement_non_conforme=source.photo_traitement_non_conforme,
+            created_by=user,
+            **values
+        )
+        if photo is not None:
+            ImageDerivative.objects.bulk_create(photo['derivatives'], ignore_conflicts=True)
+        moyen_ids = changes.moyen_ids if changes.moyen_ids is not None else gamme.selected_moyen_ids
+        epi_ids = changes.epi_ids if changes.epi_ids is not None else gamme.selected_epi_ids
+        GammeMoyen.objects.bulk_create([GammeMoyen(gammecontrole_id=new_gamme.id, moyens_controle_id=i) for i in moyen_ids])
+        GammeEpi.objects.bulk_create([GammeEpi(gammecontrole_id=new_gamme.id, epi_id=i) for i in epi_ids])
+
+        # (operation, moyen ids, copied photos, uploaded photos), in the new order
+        copies = []
+        for ordre, op in enumerate(operations, 1):
+            values = changes.operation_values(op)
+            values['ordre'] = ordre
+            photos = [
+                (photo, changes.photo_descriptions.get(photo.id, photo.description))
+                for photo in op.photooperation_set.all() if photo.id not in changes.deleted_photo_ids
+            ]
+            copies.append((OperationControle(gamme=new_gamme, created_by=user, **values),
+                           changes.operation_moyen_ids(op), photos, changes.new_photos.get(op.id, [])))
+        for index, new_op in enumerate(changes.new_operations):
+            values = new_operation_values(new_op, index)
+            copies.append((OperationControle(gamme=new_gamme, ordre=len(operations) + index + 1, created_by=user, **values),
+                           _ids(new_op.moyen_ids), [], new_op.photos))
+        OperationControle.objects.bulk_create([op for op, _, _, _ in copies])
+
+        OperationMoyen.objects.bulk_create([
+            OperationMoyen(operationcontrole_id=op.id, moyens_controle_id=moyen_id)
+            for op, moyen_ids, _, _ in copies for moyen_id in moyen_ids
+        ])
+        photo_copies = [
+            PhotoOperation(
+                operation=op,
+                image=photo.image.name,
+                description=description,
+                created_by_id=photo.created_by_id,
+                **{field: getattr(photo, field) for field in IMAGE_METADATA_FIELDS}
+            )
+            for op, _, photos, _ in copies for photo, description in photos
+        ]
+        defect_copies = [
+            PhotoDefaut(
+                gamme=new_gamme,
+                image=photo.image.name,
+                description=photo.description,
+                created_by_id=photo.created_by_id,
+                date_ajout=photo.date_ajout,
+                **{field: getattr(photo, field) for field in IMAGE_METADATA_FIELDS}
+            )
+            for photo in defects
+        ]
+        PhotoOperation.objects.bulk_create(photo_copies)
+        PhotoDefaut.objects.bulk_create(defect_copies)
+        # bulk_create sends no post_save: references are counted here
+        incref([photo.image.name for photo in photo_copies + defect_copies])
+
+    uploads = [(op, image, description) for op, _, _, photos in copies for image, description in photos]
+    transaction.on_commit(lambda: store_photos(uploads, user))
+    return new_gamme
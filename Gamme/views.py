@@ -1,9 +1,14 @@
 import logging
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import JsonResponse, HttpResponse, FileResponse
+from django.http import JsonResponse, HttpResponse, FileResponse, Http404, HttpResponseForbidden
+from django.core.exceptions import SuspiciousFileOperation, ValidationError
+from django.core.validators import validate_image_file_extension
+from django.utils._os import safe_join
 from django.views.decorators.http import require_http_methods
 from django.views.decorators.csrf import csrf_exempt
 from django.db.models import Max, Prefetch
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.conf import settings
 
 # Set up logging
 logger = logging.getLogger(__name__)
@@ -11,12 +16,14 @@ from django.template.loader import render_to_string
 import os
 import logging
 import json
+import re
+import tempfile
 from django.views.generic import ListView,DetailView, CreateView, UpdateView, DeleteView, View, TemplateView
 from django.urls import reverse_lazy, reverse
 from django.contrib import messages
 from django.forms import inlineformset_factory
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
-from .models import MissionControle, GammeControle, OperationControle, PhotoOperation, PhotoDefaut, Photolimiteacceptable, User, epi, moyens_controle
+from .models import MissionControle, GammeControle, OperationControle, PhotoOperation, PhotoDefaut, Photolimiteacceptable, User, epi, moyens_controle, PdfRenderJob, ChunkedUpload
 from .forms import MissionControleForm, GammeControleForm,ProfileUpdateForm, OperationControleForm,OperationControleFormSet, PhotoOperationForm, UpdateGammeFormSet, UpdateOperationFormSet, UpdatePhotoFormSet,RegisterForm, EpiForm, MoyenControleForm
 from django.contrib.auth import logout
 from django.views import View
@@ -29,6 +36,21 @@ from django.http import JsonResponse
 from django.core.files.storage import default_storage
 from django.core.files.base import ContentFile
 from django.utils import timezone
+from .pdf import PdfRenderError, build_gamme_pdf_context, render_gamme_pdf
+from .pdf_cache import gamme_pdf_etag, get_or_render
+from .pdf_jobs import enqueue_mission_pdf
+from .pdf_store import store_pdf
+from .delivery import serve_file
+from .cold_storage import cold_path
+from .images import derivatives_for
+from .mission_edit import GALLERY_MODELS, gallery_photos, gamme_image_names, load_gamme_details, load_mission_gammes
+from .mission_payload import apply_epi_comments, apply_in_place, diff_gamme, diff_mission, parse_mission_payload
+from .row_versions import EditConflict, claim, stale_rows
+from .versioning import fork_gamme
+from .ingest import ingest_images, upload_result
+from .chunked_upload import UploadConflict, UploadIncomplete, complete_upload, start_upload, write_chunk
+from .print_pack import PACK_FORMATS, build_print_pack, pack_missions, stale_missions
+from .profiling import profile_pdf, stage, summary as profiling_summary
 gammeFormSet = inlineformset_factory(   
     MissionControle,
     GammeControle,
@@ -43,73 +65,26 @@ class MissionControleUpdateView(LoginRequiredMixin,View):
         missioncontrole = get_object_or_404(MissionControle, pk=pk)
         operation_formset = OperationControleFormSet(prefix='form', queryset=OperationControle.objects.none())
         
-        # Get all gammes with their operations, regardless of status
-        gammes = GammeControle.objects.filter(mission=missioncontrole).prefetch_related(
-            Prefetch('operations', queryset=OperationControle.objects.all().prefetch_related(
-                Prefetch('moyenscontrole', queryset=moyens_controle.objects.all().order_by('ordre')), 
-                'photooperation_set'
-            )), 
-            'defaut_photos',
-            'epis',  # Prefetch EPIs for each gamme
-            'moyens_controle'  # Prefetch moyens_controle for each gamme
-        ).order_by('-date_mise_a_jour')
-        
-        # Add a flag to each gamme to indicate if it's active and calculate next order
-        for gamme in gammes:
-            gamme.is_active = gamme.statut
-            # Calculate next order number based on current gamme's operations
-            max_order = gamme.operations.aggregate(Max('ordre'))['ordre__max']
-            if max_order is not None:
-                gamme.next_order = (int(max_order) - 1) + 1  # This simplifies to just max_order
-            else:
-                gamme.next_order = 1
-        
+        # Every version; the edited one with its operations, photos and selections, in a fixed number of queries
+        gammes = load_mission_gammes(missioncontrole)
+
         # Get moyens de contrôle ordered by 'ordre'
-        moyens_controle_list = moyens_controle.objects.all().order_by('ordre')
-        
+        moyens_controle_list = list(moyens_controle.objects.all().order_by('ordre'))
+
         # Get all EPIs
-        all_epis = epi.objects.all()
-        
-        # Get all defect photos for the mission's gammes
-        photo_defauts = PhotoDefaut.objects.filter(gamme__in=gammes).order_by('-date_ajout')
-        
-        # Get all acceptable limit photos for the mission's gammes
-        photo_acceptables = Photolimiteacceptable.objects.filter(gamme__in=gammes).order_by('-date_ajout')
-        
-        # Group photos by gamme ID for easier access in template
-        photos_by_gamme = {}
-        acceptable_photos_by_gamme = {}
-        
-        # Process defect photos
-        for photo in photo_defauts:
-            if photo.gamme_id not in photos_by_gamme:
-                photos_by_gamme[photo.gamme_id] = []
-            photos_by_gamme[photo.gamme_id].append(photo)
-            
-        # Process acceptable photos
-        for photo in photo_acceptables:
-            if photo.gamme_id not in acceptable_photos_by_gamme:
-                acceptable_photos_by_gamme[photo.gamme_id] = []
-            acceptable_photos_by_gamme[photo.gamme_id].append(photo)
-        
-        # Add photos to each gamme object
-        for gamme in gammes:
-            gamme.photo_defauts = photos_by_gamme.get(gamme.id, [])
-            gamme.photo_acceptables = acceptable_photos_by_gamme.get(gamme.id, [])
-
-        # Add selected moyen IDs for each operation
-        for gamme in gammes:
-            for op in gamme.operations.all():
-                op.selected_moyen_ids = list(op.moyenscontrole.values_list('id', flat=True))
-        
+        all_epis = list(epi.objects.all())
+
+        # Web derivatives of every image on the page, loaded in one query for responsive_img
+        image_names = [m.photo.name for m in moyens_controle_list] + [e.photo.name for e in all_epis]
+        image_names += gamme_image_names(gammes[:1])
+
         context = {
             'missioncontrole': missioncontrole,
             'gammes': gammes,
             'operation_formset': operation_formset,
             'moyens_controle': moyens_controle_list,
             'epis': all_epis,
-            'photos_by_gamme': photos_by_gamme,  # For debugging/backward compatibility
-            'acceptable_photos_by_gamme': acceptable_photos_by_gamme,  # For debugging/backward compatibility
+            'image_derivatives': derivatives_for(image_names),
         }
         
         return render(request, self.template_name, context)
@@ -117,579 +92,35 @@ class MissionControleUpdateView(LoginRequiredMixin,View):
     def post(self, request, pk):
         missioncontrole = get_object_or_404(MissionControle, pk=pk)
         is_ajax = request.headers.get('X-Requested-With') == 'XMLHttpRequest'
-        
-        try:
-            # --- Mise à jour des champs mission ---
-            missioncontrole.code = request.POST.get('code', missioncontrole.code)
-            missioncontrole.intitule = request.POST.get('intitule', missioncontrole.intitule)
-            missioncontrole.reference = request.POST.get('reference', missioncontrole.reference)
-            missioncontrole.statut = request.POST.get('statut', str(missioncontrole.statut)) == 'True'
-            missioncontrole.client = request.POST.get('client', missioncontrole.client or '')
-            missioncontrole.designation = request.POST.get('designation', missioncontrole.designation or '')
-            missioncontrole.section = request.POST.get('section', missioncontrole.section or '')
-            missioncontrole.save()
-
-            # --- Mise à jour des gammes et opérations ---
-            gammes = GammeControle.objects.filter(mission=missioncontrole)
-            changes_made = False
-            changement_detecte = False  # Initialize at method level
-            
-            for gamme in gammes:
-                intitule = request.POST.get(f'{gamme.id}-intitule', gamme.intitule)
-                # Ensure gamme title follows the format 'Gamme: [Mission Title]' if it's empty or being reset
-                if not intitule or intitule.strip() == '':
-                    intitule = f"Gamme: {missioncontrole.intitule}"
-                statut = request.POST.get(f'{gamme.id}-statut', 'False')
-# Reset changement_detecte for each gamme
-                gamme_change_detected = False
-
-                # Check if there are actual content changes (not just status changes)
-                no_incident = request.POST.get(f'{gamme.id}-No_incident', gamme.No_incident)
-                commentaire = request.POST.get(f'{gamme.id}-commentaire', gamme.commantaire or '')
-                temps_alloue = request.POST.get(f'{gamme.id}-temps_alloue', gamme.Temps_alloué)
-                commentaire_identification = request.POST.get(f'{gamme.id}-commentaire_identification', gamme.commantaire_identification or '')
-                commentaire_non_conforme = request.POST.get(f'{gamme.id}-commentaire_non_conforme', gamme.commantaire_traitement_non_conforme or '')
-                
-                # Handle file upload for photo_non_conforme
-                photo_non_conforme = request.FILES.get(f'{gamme.id}-photo_non_conforme')
-                if not photo_non_conforme and hasattr(gamme, 'photo_traitement_non_conforme'):
-                    photo_non_conforme = gamme.photo_traitement_non_conforme
-                
-                picto_s = request.POST.get(f'{gamme.id}-picto_s') == 'on'
-                picto_r = request.POST.get(f'{gamme.id}-picto_r') == 'on'
-                
-                content_changed = (
-                    intitule != gamme.intitule or
-                    no_incident != gamme.No_incident or
-                    commentaire != (gamme.commantaire or '') or
-                    temps_alloue != gamme.Temps_alloué or
-                    commentaire_identification != (gamme.commantaire_identification or '') or
-                    commentaire_non_conforme != (gamme.commantaire_traitement_non_conforme or '') or
-                    (photo_non_conforme is not None and hasattr(gamme, 'photo_traitement_non_conforme') and 
-                     photo_non_conforme != gamme.photo_traitement_non_conforme) or
-                    picto_s != gamme.picto_s or
-                    picto_r != gamme.picto_r
-                )
-
-                # Only mark as changed if there are actual content changes
-                if content_changed or (statut == 'True') != gamme.statut:
-                    gamme_change_detected = content_changed
-                    changement_detecte = True
-
-                # Process existing operations
-                processed_op_ids = set()
-                for op in gamme.operations.all():
-                    if op.id in processed_op_ids:
-                        continue  # Skip already processed operations
-                    processed_op_ids.add(op.id)
-                    
-                    titre = request.POST.get(f"{op.id}-titre", op.titre)
-                    ordre = request.POST.get(f"{op.id}-ordre", op.ordre)
-                    description = request.POST.get(f"{op.id}-description", op.description)
-                    criteres = request.POST.get(f"{op.id}-criteres", op.criteres)
-                    frequence = request.POST.get(f"{op.id}-frequence", op.frequence)
-                    moyen_controle = request.POST.get(f"{op.id}-moyen_controle", op.moyen_controle or '')
-
-                    # Get selected moyenscontrole from checkboxes and remove duplicates
-                    moyen_ids = list(dict.fromkeys(request.POST.getlist(f'{op.id}-moyenscontrole', [])))
-                    current_moyen_ids = list(op.moyenscontrole.values_list('id', flat=True))
-                    
-                    # Convert to strings for comparison and remove empty strings
-                    current_moyen_ids_str = [str(id) for id in current_moyen_ids if id is not None]
-                    moyen_ids = [mid for mid in moyen_ids if mid]  # Remove empty strings
-                    
-                    # Debug output
-                    print(f"Operation {op.id} - Current moyens: {current_moyen_ids_str}")
-                    print(f"Operation {op.id} - Submitted moyens (deduplicated): {moyen_ids}")
-                    
-                    # Check for actual operation changes
-                    op_changed = any([
-                        titre != op.titre,
-                        str(ordre) != str(op.ordre),
-                        description != op.description,
-                        criteres != op.criteres,
-                        str(frequence) != str(op.frequence or ''),
-                        moyen_controle != (op.moyen_controle or ''),
-                        set(moyen_ids) != set(current_moyen_ids_str)
-                    ])
-                    
-                    if op_changed:
-                        gamme_change_detected = True
-                        changement_detecte = True
-                        
-                        # Update the operation fields
-                        op.titre = titre
-                        op.ordre = ordre
-                        op.description = description
-                        op.criteres = criteres
-                        op.frequence = frequence
-                        op.moyen_controle = moyen_controle  # Update the CharField
-                        
-                        # Save the operation first
-                        op.save()
-                        
-                        # Update the many-to-many relationship for moyenscontrole
-                        try:
-                            # Convert string IDs to integers and remove duplicates
-                            moyen_ids_int = list({int(mid) for mid in moyen_ids if mid and mid.isdigit()})
-                            
-                            # Get current IDs as integers for comparison
-                            current_ids_set = set(current_moyen_ids)
-                            new_ids_set = set(moyen_ids_int)
-                            
-                            if current_ids_set != new_ids_set:
-                                op.moyenscontrole.set(moyen_ids_int)
-                                print(f"Updated operation {op.id} with moyenscontrole: {moyen_ids_int}")
-                            else:
-                                print(f"Operation {op.id} - No change in moyenscontrole")
-                        except Exception as e:
-                            print(f"Error updating moyenscontrole for operation {op.id}: {str(e)}")
-                            # Fallback to clear and add all if there's an error
-                            op.moyenscontrole.clear()
-                            for mid in moyen_ids_int:
-                                try:
-                                    op.moyenscontrole.add(int(mid))
-                                except (ValueError, moyens_controle.DoesNotExist):
-                                    continue
-
-                    # Process existing photos
-                    for photo in op.photooperation_set.all():
-                        desc = request.POST.get(f"photo_{photo.id}_description", photo.description)
-                        delete = request.POST.get(f"photo_{photo.id}_DELETE", None)
-                        if desc != photo.description or delete is not None:
-                            gamme_change_detected = True
-                            changement_detecte = True
-                            # Update photo in place if no new gamme is being created
-                            if not gamme_change_detected and desc != photo.description:
-                                photo.description = desc
-                                photo.save()
-
-                    # Check for new dynamic photos
-                    has_new_photos = any(key.startswith(f'photo_{op.id}_') for key in request.FILES.keys())
-                    if has_new_photos:
-                        gamme_change_detected = True
-                        changement_detecte = True
-
-                # Check for changes in moyens de contrôle
-                selected_moyens_ids = set([k.split('_')[-1] for k in request.POST.keys() if k.startswith(f'gamme_{gamme.id}_moyen_controle_') and request.POST.get(k) == 'on'])
-                current_moyens_ids = set([str(m.id) for m in gamme.moyens_controle.all()])
-                if selected_moyens_ids != current_moyens_ids:
-                    gamme_change_detected = True
-                    changement_detecte = True
-
-                # Check for new operations
-                for key in request.POST.keys():
-                    if key.startswith(f"newop_{gamme.id}_"):
-                        gamme_change_detected = True
-                        changement_detecte = True
-                        break
+        payload = parse_mission_payload(request.POST, request.FILES)
+        # Before anything is written: most conflicting saves stop here
+        conflicts = stale_rows(missioncontrole, payload)
+        if conflicts:
+            return edit_conflict_response(conflicts, is_ajax)
 
-                # Check for files related to new operations
-                for key in request.FILES.keys():
-                    if key.startswith("newphoto_") or key.startswith(f"newop_{gamme.id}_") or key.startswith("formop_"):
-                        gamme_change_detected = True
-                        changement_detecte = True
-                        break
-
-                # Initialize new_gamme to the current gamme by default
-                new_gamme = gamme
-                
-                # If only status changed, just update the existing gamme
-                if not gamme_change_detected and statut != gamme.statut:
-                    gamme.statut = (statut == 'True')
-                    gamme.save()
-                    changes_made = True
-                # If there are content changes → create new version of the gamme
-                elif gamme_change_detected and content_changed:
-                    changes_made = True
-                    # Get the latest version number
-                    latest_version = float(gamme.version) if gamme.version else 1.0
-                    next_version = round(latest_version + 0.1, 1)
-                    
-                    # First, check if we already have an inactive version with this version number
-                    existing_version = GammeControle.objects.filter(
-                        mission=missioncontrole,
-                        intitule=gamme.intitule,
-                        version=str(next_version)
-                    ).exists()
-                    
-                    # Only proceed if we don't already have this version
-                    if not existing_version:
-                        with transaction.atomic():
-                            # Mark all versions of this gamme as inactive
-                            GammeControle.objects.filter(
-                                mission=missioncontrole, 
-                                intitule=gamme.intitule,
-                                statut=True  # Only mark active versions as inactive
-                            ).update(statut=False)
-                            
-                            # Mark the current gamme as inactive
-                            gamme.statut = False
-                            gamme.save()
+        try:
+            # --- Mise à jour des champs mission, des gammes et opérations ---
+            mission_changes = diff_mission(missioncontrole, payload)
+            # Only the versions included in the form are compared; the others are left alone
+            gammes = load_gamme_details(list(
+                GammeControle.objects.filter(mission=missioncontrole, id__in=list(payload.gammes))
+            ))
+            gamme_changes = [c for c in (diff_gamme(g, payload, missioncontrole) for g in gammes) if c.has_changes]
+
+            # One transaction: a conflict on any row leaves the whole save unapplied
+            with transaction.atomic():
+                if mission_changes:
+                    claim(missioncontrole, payload.row_version, request.user, **mission_changes)
+                for changes in gamme_changes:
+                    # Changes to the gamme itself make a new version; the rest is saved in place
+                    if changes.content_changed:
+                        fork_gamme(changes, missioncontrole, request.user)
                     else:
-                        # Skip creating a new version if it already exists
-                        continue
-
-                    no_incident = request.POST.get(f'{gamme.id}-No_incident', gamme.No_incident)
-                    # Get the new fields
-                    commentaire = request.POST.get(f'{gamme.id}-commentaire', gamme.commantaire or '')
-                    temps_alloue = request.POST.get(f'{gamme.id}-temps_alloue', gamme.Temps_alloué)
-                    commentaire_identification = request.POST.get(f'{gamme.id}-commentaire_identification', gamme.commantaire_identification or '')
-                    commentaire_non_conforme = request.POST.get(f'{gamme.id}-commentaire_non_conforme', gamme.commantaire_traitement_non_conforme or '')
-                    
-                    # Handle file upload for photo_non_conforme
-                    photo_non_conforme = request.FILES.get(f'{gamme.id}-photo_non_conforme')
-                    if not photo_non_conforme and hasattr(gamme, 'photo_traitement_non_conforme'):
-                        photo_non_conforme = gamme.photo_traitement_non_conforme
-                    
-                    picto_s = request.POST.get(f'{gamme.id}-picto_s') == 'on'
-                    picto_r = request.POST.get(f'{gamme.id}-picto_r') == 'on'
-                    
-                    # Create new gamme with statut=True
-                    new_gamme = GammeControle.objects.create(
-                        mission=missioncontrole,
-                        intitule=intitule,
-                        No_incident=no_incident,
-                        statut=True,  # Explicitly set to True for the new version
-                        version=next_version,
-                        commantaire=commentaire,
-                        Temps_alloué=temps_alloue if temps_alloue else None,
-                        commantaire_identification=commentaire_identification,
-                        commantaire_traitement_non_conforme=commentaire_non_conforme,
-                        photo_traitement_non_conforme=photo_non_conforme,
-                        picto_s=picto_s,
-                        picto_r=picto_r,
-                        created_by=request.user
-                    )
-
-                    # Save selected moyens de contrôle for the new gamme
-                    moyen_controle_ids = [k.split('_')[-1] for k in request.POST.keys()
-                                       if k.startswith(f'gamme_{gamme.id}_moyen_controle_') and request.POST.get(k) == 'on']
-                    if moyen_controle_ids:
-                        selected_moyens = moyens_controle.objects.filter(id__in=moyen_controle_ids)
-                        new_gamme.moyens_controle.set(selected_moyens)
-
-                    # Save selected EPIs for the new gamme
-                    epi_ids = [k.split('_')[-1] for k in request.POST.keys()
-                             if k.startswith(f'gamme_{gamme.id}_epi_') and request.POST.get(k) == 'on']
-                    if epi_ids:
-                        selected_epis = epi.objects.filter(id__in=epi_ids)
-                        new_gamme.epis.set(selected_epis)
-
-                    # Update EPI comments if submitted
-                    for key, value in request.POST.items():
-                        if key.startswith('epi_') and key.endswith('_commentaire'):
-                            try:
-                                epi_id = int(key.split('_')[1])
-                                epi_obj = epi.objects.get(id=epi_id)
-                                if epi_obj.commentaire != value:
-                                    epi_obj.commentaire = value
-                                    epi_obj.save()
-                                    print(f"Updated commentaire for EPI {epi_obj.nom} (ID: {epi_obj.id})")
-                            except (ValueError, epi.DoesNotExist) as e:
-                                print(f"Error updating EPI comment for key {key}: {e}")
-
-                # If we're creating a new gamme version, we'll create new operations for it
-                if changement_detecte and new_gamme != gamme:
-                    # Get the maximum order value from existing operations in the new gamme
-                    max_order = OperationControle.objects.filter(gamme=new_gamme).aggregate(Max('ordre'))['ordre__max'] or 0
-                    
-                    # First, collect all operations with their new order values
-                    operations_to_update = []
-                    processed_op_ids = set()  # Track processed operation IDs to prevent duplicates
-                    
-                    # Process existing operations
-                    for op in gamme.operations.all():
-                        if op.id in processed_op_ids:
-                            continue  # Skip already processed operations
-                            
-                        processed_op_ids.add(op.id)
-                        
-                        # Get the new values from the form
-                        new_titre = request.POST.get(f"{op.id}-titre", op.titre)
-                        new_description = request.POST.get(f"{op.id}-description", op.description)
-                        new_criteres = request.POST.get(f"{op.id}-criteres", op.criteres)
-                        new_ordre = request.POST.get(f"{op.id}-ordre")
-                        
-                        try:
-                            new_ordre = int(new_ordre) if new_ordre is not None else op.ordre
-                        except (ValueError, TypeError):
-                            new_ordre = op.ordre
-                        
-                        # Get the moyen_controle value from the form or use the existing one
-                        moyen_controle_value = request.POST.get(f"{op.id}-moyen_controle", '')
-                        if not moyen_controle_value and hasattr(op, 'moyen_controle'):
-                            moyen_controle_value = op.moyen_controle
-
-                        # Get the updated moyen_ids from the request
-                        moyen_ids = list(dict.fromkeys(request.POST.getlist(f'{op.id}-moyenscontrole', [])))
-                        moyen_ids_int = [int(mid) for mid in moyen_ids if mid and mid.isdigit()]
-                        
-                        # Only add the operation if it belongs to the current gamme version
-                        if op.gamme_id == gamme.id:
-                            operations_to_update.append({
-                                'op': op,
-                                'new_order': new_ordre,
-                                'titre': new_titre,
-                                'description': new_description or '',
-                                'criteres': new_criteres or '',
-                                'frequence': request.POST.get(f"{op.id}-frequence", getattr(op, 'frequence', 1)),
-                                'moyenscontrole_ids': moyen_ids_int,
-                                'moyen_controle': moyen_controle_value
-                            })
-                else:
-                    # If no new gamme version, update operations in place
-                    for op in gamme.operations.all():
-                        if op.id in processed_op_ids:
-                            continue
-                            
-                        processed_op_ids.add(op.id)
-                        
-                        # Get the new values from the form
-                        new_titre = request.POST.get(f"{op.id}-titre", op.titre)
-                        new_description = request.POST.get(f"{op.id}-description", op.description)
-                        new_criteres = request.POST.get(f"{op.id}-criteres", op.criteres)
-                        new_ordre = request.POST.get(f"{op.id}-ordre")
-                        
-                        try:
-                            new_ordre = int(new_ordre) if new_ordre is not None else op.ordre
-                        except (ValueError, TypeError):
-                            new_ordre = op.ordre
-                        
-                        # Update the operation in place
-                        op.titre = new_titre
-                        op.description = new_description
-                        op.criteres = new_criteres
-                        op.ordre = new_ordre
-                        
-                        # Update moyen_controle if needed
-                        moyen_controle_value = request.POST.get(f"{op.id}-moyen_controle")
-                        if moyen_controle_value:
-                            op.moyen_controle = moyen_controle_value
-                        
-                        op.save()
-
-                        # Update moyens de contrôle for the operation
-                        moyens_ids = request.POST.getlist(f'op_{op.id}_moyens_controle')
-                        if moyens_ids:
-                            op.moyenscontrole.set(moyens_ids)
-                        else:
-                            op.moyenscontrole.clear()
-                        
-                        # Handle photos for the operation
-                        self._handle_operation_photos(request, op)
-
-                    # Save selected moyens de contrôle for the new gamme
-                    moyen_controle_ids = [k.split('_')[-1] for k in request.POST.keys()
-                                       if k.startswith(f'gamme_{gamme.id}_moyen_controle_') and request.POST.get(k) == 'on']
-                    if moyen_controle_ids:
-                        selected_moyens = moyens_controle.objects.filter(id__in=moyen_controle_ids)
-                        gamme.moyens_controle.set(selected_moyens)
-                        
-                    # Skip the rest of the operation creation logic for existing gamme
-                    continue
-                
-                # Sort operations by their new order to ensure consistent ordering
-                operations_to_update.sort(key=lambda x: x['new_order'])
-                
-                # Now create the operations in the new gamme with their new order values
-                current_order = 1
-                for op_data in operations_to_update:
-                    # Ensure the order is unique and sequential
-                    while OperationControle.objects.filter(gamme=new_gamme, ordre=current_order).exists():
-                        current_order += 1
-                    
-                    # Create the new operation with all fields except many-to-many
-                    new_op = OperationControle.objects.create(
-                        gamme=new_gamme,
-                        titre=op_data['titre'],
-                        ordre=current_order,  # Use the sequential order
-                        description=op_data['description'],
-                        criteres=op_data['criteres'],
-                        frequence=op_data['frequence'],
-                        moyen_controle=op_data['moyen_controle'],
-                        created_by=request.user
-                    )
-                    
-                    # Set moyens de contrôle
-                    if op_data['moyenscontrole_ids']:
-                        new_op.moyenscontrole.set(op_data['moyenscontrole_ids'])
-
-                    current_order += 1
-                    
-                    # Get the original operation for copying photos
-                    op = op_data['op']
-
-                    # Photos existantes copiées sauf celles à supprimer
-                    for photo in op.photooperation_set.all():
-                        if request.POST.get(f"photo_{photo.id}_DELETE"):
-                            continue
-                            
-                        # Récupérer la description mise à jour ou utiliser l'ancienne
-                        photo_description = request.POST.get(f"photo_{photo.id}_description", photo.description)
-                        
-                        PhotoOperation.objects.create(
-                            operation=new_op,
-                            image=photo.image,
-                            description=photo_description
-                        )
-
-                    # Nouvelles photos dynamiques - Vérifier les deux formats
-                    # 1. Ancien format: photo_{op.id}_{i}_image
-                    i = 0
-                    while True:
-                        # Vérifier l'ancien format
-                        old_image_key = f'photo_{op.id}_{i}_image'
-                        old_desc_key = f'photo_{op.id}_{i}_description'
-                        
-                        # Vérifier le nouveau format: form-{op.id}-photo-{i}-image
-                        new_image_key = f'form-{op.id}-photo-{i}-image'
-                        new_desc_key = f'form-{op.id}-photo-{i}-description'
-                        
-                        image_key = None
-                        desc_key = None
-                        
-                        # Vérifier quel format est présent dans la requête
-                        if old_image_key in request.FILES:
-                            image_key = old_image_key
-                            desc_key = old_desc_key
-                        elif new_image_key in request.FILES:
-                            image_key = new_image_key
-                            desc_key = new_desc_key
-                        
-                        if image_key and image_key in request.FILES:
-                            image = request.FILES[image_key]
-                            description = request.POST.get(desc_key, '')
-                            
-                            # Journaliser pour le débogage
-                            print(f"Sauvegarde d'une nouvelle photo pour l'opération {new_op.id}")
-                            print(f"  - Nom du fichier: {image.name}")
-                            print(f"  - Taille: {image.size} octets")
-                            print(f"  - Description: {description}")
-                            
-                            PhotoOperation.objects.create(
-                                operation=new_op,
-                                image=image,
-                                description=description
-                            )
-                            i += 1
-                        else:
-                            # Aucune photo supplémentaire dans aucun format
-                            break
-
-                # Nouvelles opérations manuelles
-                i = 0
-                while True:
-                    # First check for the operation fields with the current index
-                    titre = request.POST.get(f'newop_{gamme.id}_{i}_titre')
-                    
-                   
-                    if not titre:
-                        # If no title, check if there are any files for this operation
-                        has_files = any(k.startswith(f'newop_{gamme.id}_{i}_photo_') for k in request.FILES.keys())
-                        print(f"Operation {i} - has_files: {has_files}")
-                        if not has_files:
-                            print(f"No files found for operation {i}, breaking")
-                            break
-                        # If there are files but no title, use a default title
-                        titre = f"Nouvelle opération {i+1}"
-                    
-                    # Get other operation fields
-                    description = request.POST.get(f'newop_{gamme.id}_{i}_description', '')
-                    criteres = request.POST.get(f'newop_{gamme.id}_{i}_criteres', '')
-                    frequence = request.POST.get(f'newop_{gamme.id}_{i}_frequence', '')
-                    moyen_controle = request.POST.get(f'newop_{gamme.id}_{i}_moyen_controle', '')
-                    
-                    # Get the next available order value for this gamme
-                    max_ordre = OperationControle.objects.filter(
-                        gamme=new_gamme
-                    ).aggregate(Max('ordre'))['ordre__max'] or 0
-                    next_ordre = max_ordre + 1
-                    
-                    print(f"Creating new operation with ordre: {next_ordre} for gamme {new_gamme.id}")
-                    
-                    # Create the new operation with all fields including moyen_controle
-                    new_op = OperationControle.objects.create(
-                        gamme=new_gamme,
-                        titre=titre,
-                        ordre=next_ordre,  # Use the calculated next order
-                        description=description,
-                        criteres=criteres,
-                        frequence=frequence,
-                        moyen_controle=moyen_controle,
-                        created_by=request.user
-                    )
-                    
-                    # Get and set moyens de contrôle for this new operation
-                    moyens_ids = request.POST.getlist(f'newop_{gamme.id}_{i}_moyens_controle')
-                    if moyens_ids:
-                        try:
-                            selected_moyens = moyens_controle.objects.filter(id__in=moyens_ids)
-                            if selected_moyens:
-                                new_op.moyenscontrole.set(selected_moyens)
-                        except (ValueError):
-                            pass
-
-                    # Process photos for this operation
-                    print(f"\nProcessing photos for operation {i} (gamme: {gamme.id}, new_op: {new_op.id})")
-                    print(f"All FILES keys: {list(request.FILES.keys())}")
-                    
-                    # Track processed photo indices to handle multiple file inputs
-                    processed_photos = set()
-                    
-                    # First, handle any file uploads with the expected naming pattern
-                    for file_key in request.FILES.keys():
-                        expected_prefix = f'newop_{gamme.id}_{i}_photo_'
-                        if file_key.startswith(expected_prefix) and file_key.endswith('_image'):
-                            print(f"Found matching file input: {file_key}")
-                            
-                            try:
-                                # Extract the photo index from the key (e.g., 'newop_1_0_photo_0_image' -> 0)
-                                parts = file_key.split('_')
-                                if len(parts) >= 6:  # Format: newop_<gamme>_<op>_photo_<index>_image
-                                    photo_idx = int(parts[-2])
-                                    
-                                    if photo_idx in processed_photos:
-                                        print(f"  - Photo index {photo_idx} already processed, skipping")
-                                        continue
-                                    
-                                    # Get the corresponding description
-                                    desc_key = f'newop_{gamme.id}_{i}_photo_{photo_idx}_description'
-                                    description = request.POST.get(desc_key, 'No description')
-                                    
-                                    print(f"  - Processing photo index {photo_idx}")
-                                    print(f"  - Description key: {desc_key}")
-                                    print(f"  - Description value: {description}")
-                                    
-                                    # Create the photo record
-                                    try:
-                                        print(f"  - Creating PhotoOperation for {file_key}")
-                                        photo = PhotoOperation.objects.create(
-                                            operation=new_op,
-                                            image=request.FILES[file_key],
-                                            description=description
-                                        )
-                                        print(f"  - Successfully created photo {photo.id} for operation {new_op.id}")
-                                        print(f"  - File path: {photo.image}")
-                                        print(f"  - Description: {description}")
-                                        processed_photos.add(photo_idx)
-                                    except Exception as e:
-                                        print(f"  - Error creating photo: {str(e)}")
-                                        import traceback
-                                        traceback.print_exc()
-                                else:
-                                    print(f"  - Unexpected file key format: {file_key}")
-                                    
-                            except (ValueError, IndexError) as e:
-                                print(f"  - Error parsing photo index from {file_key}: {str(e)}")
-                                import traceback
-                                traceback.print_exc()
-                                continue
-                    
-                    # Old photo processing code removed - using new method only
-                    
-                    i += 1
+                        apply_in_place(changes, request.user)
+                apply_epi_comments(payload)
 
+        except EditConflict as e:
+            return edit_conflict_response(e.changes, is_ajax)
         except Exception as e:
             
             
@@ -708,11 +139,6 @@ class MissionControleUpdateView(LoginRequiredMixin,View):
         gamme_statut = request.POST.get('gamme_statut')
         
         if gamme_intitule and gamme_statut is not None:
-            # Debug: Print all POST data
-            print("\n=== DEBUG: RAW POST DATA ===")
-            for key, value in request.POST.items():
-                print(f"{key}: {value}")
-                
             # Handle picto values
             picto_combined = request.POST.get('gamme_picto_combined', 'R')
             picto_s = 'S' in picto_combined
@@ -739,61 +165,11 @@ class MissionControleUpdateView(LoginRequiredMixin,View):
                 new_gamme.photo_traitement_non_conforme = request.FILES['gamme_photo_traitement_non_conforme']
                 new_gamme.save()
             
-            # Debug: Print all EPI and moyen checkboxes
-            print("\n=== DEBUG: EPI CHECKBOXES ===")
-            for k, v in request.POST.items():
-                if k.startswith('gamme_epi_') or k.startswith('gamme_moyen_controle_'):
-                    print(f"{k}: {v}")
-            
-            # Debug: Print all POST data for EPI and moyens de contrôle
-            print("\n=== DEBUG: RAW POST DATA FOR CHECKBOXES ===")
-            for k, v in request.POST.items():
-                if k.startswith('gamme_epi_') or k.startswith('gamme_moyen_controle_'):
-                    print(f"{k}: {v}")
-            
-            # Handle EPI selections - check for any EPI checkboxes that were checked
-            epi_ids = []
-            for k, v in request.POST.items():
-                if k.startswith('gamme_epi_'):
-                    try:
-                        # Get the EPI ID from the checkbox name (format: gamme_epi_<id>)
-                        epi_id = int(k.split('_')[-1])
-                        # The value is the EPI ID, not 'on' like in some forms
-                        epi_ids.append(epi_id)
-                    except (ValueError, IndexError) as e:
-                        print(f"Error parsing EPI ID from {k}: {e}")
-            
-            print(f"Found EPI IDs: {epi_ids}")
-            new_gamme.epis.set(epi_ids)
-            
-            # Handle moyens de contrôle selections - check for any moyen checkboxes that were checked
-            moyen_ids = []
-            for k, v in request.POST.items():
-                if k.startswith('gamme_moyen_controle_'):
-                    try:
-                        # Get the moyen ID from the checkbox name (format: gamme_moyen_controle_<id>)
-                        moyen_id = int(k.split('_')[-1])
-                        # The value is the moyen ID, not 'on' like in some forms
-                        moyen_ids.append(moyen_id)
-                    except (ValueError, IndexError) as e:
-                        print(f"Error parsing moyen ID from {k}: {e}")
-            
-            print(f"Found moyen IDs: {moyen_ids}")
-            new_gamme.moyens_controle.set(moyen_ids)
-            
-            # Debug: Print all form data with more details
-           
-            print("\n=== FORM DATA ===")
-            for key, value in request.POST.items():
-                print(f"{key}: {value}")
-            
-            print("\n=== FILES ===")
-            for key, file_obj in request.FILES.items():
-                print(f"{key}: {file_obj.name} (size: {file_obj.size} bytes, type: {file_obj.content_type})")
-            
-            # Print all request headers for debugging
-           
-                        # Process operation forms using Django formset
+            # EPI and moyen de contrôle checkboxes (gamme_epi_<id>, gamme_moyen_controle_<id>)
+            new_gamme.epis.set(payload.new_gamme_epi_ids)
+            new_gamme.moyens_controle.set(payload.new_gamme_moyen_ids)
+            
+            # Process operation forms using Django formset
             operation_formset = OperationControleFormSet(
                 request.POST, 
                 request.FILES,
@@ -801,118 +177,64 @@ class MissionControleUpdateView(LoginRequiredMixin,View):
                 queryset=OperationControle.objects.none()
             )
             
-           
-            
-            
             if operation_formset.is_valid():
                 operations = operation_formset.save(commit=False)
                 
-                
                 for i, operation in enumerate(operations):
                     operation.gamme = new_gamme
                     operation.created_by = request.user
                     operation.save()
-                    print(f"Saved operation {i}: {operation.titre} (ID: {operation.id})")
-                    
-                    # Process photo uploads for this operation
-                    photo_files = {}
-                    photo_descriptions = {}
-                    
-                    # Find all photo files and descriptions for this operation
-                    for key, file_obj in request.FILES.items():
-                        if key.startswith(f'form-{i}-photo-') and key.endswith('-image'):
-                            photo_index = key.split('-')[3]
-                            photo_files[photo_index] = file_obj
-                    
-                    for key, value in request.POST.items():
-                        if key.startswith(f'form-{i}-photo-') and key.endswith('-description'):
-                            photo_index = key.split('-')[3]
-                            photo_descriptions[photo_index] = value
                     
-                    # Save photos for this operation
-                    for photo_index, file_obj in photo_files.items():
-                        description = photo_descriptions.get(photo_index, '')
-                        photo = PhotoOperation(
+                    # Photos of this operation: form-<i>-photo-<n>-image / -description
+                    for file_obj, description in payload.form_photos(i):
+                        PhotoOperation.objects.create(
                             operation=operation,
                             image=file_obj,
                             description=description,
                             created_by=request.user
                         )
-                        photo.save()
-                        print(f"  - Saved photo: {file_obj.name} (ID: {photo.id})")
-                    
-                    # Process moyen de contrôle for this operation
-                    # Get the moyen_controle value from the form
-                    moyen_controle_value = request.POST.get(f'form-{i}-moyen_controle', '').strip()
-                    if moyen_controle_value:
-                        operation.moyen_controle = moyen_controle_value
-                        print(f"  - Set moyen de contrôle: {moyen_controle_value}")
-                    
-                    # Process the many-to-many relationship if it exists
-                    if hasattr(operation, 'moyens_controle'):
-                        # Clear existing moyens de contrôle first
-                        operation.moyens_controle.clear()
-                        
-                        # Find all selected moyens de contrôle for this operation
-                        for key, value in request.POST.items():
-                            if key.startswith(f'op_{operation.id}_moyen_') and value == 'on':
-                                try:
-                                    moyen_id = int(key.split('_')[-1])
-                                    moyen = moyens_controle.objects.get(id=moyen_id)
-                                    operation.moyens_controle.add(moyen)
-                                    print(f"  - Added moyen de contrôle: {moyen.nom} (ID: {moyen.id})")
-                                except (ValueError, moyens_controle.DoesNotExist) as e:
-                                    print(f"  - Error adding moyen de contrôle: {e}")
-                        
+                operation_formset.save_m2m()
             else:
-                print("Formset errors:", operation_formset.errors)
-                print("Non-form errors:", operation_formset.non_form_errors())
-
-        # Copy defect photos (PhotoDefaut) from old gamme to new gamme
-        if changement_detecte and new_gamme != gamme:
-            try:
-                # Get all defect photos from the old gamme
-                defect_photos = PhotoDefaut.objects.filter(gamme=gamme)
-                
-                # Copy each defect photo to the new gamme
-                for photo in defect_photos:
-                    # Create a new PhotoDefaut object with the same image and details
-                    # but linked to the new gamme
-                    
-                    # First, read the original image file
-                    original_image = photo.image
-                    
-                    # Create a new PhotoDefaut instance
-                    new_photo = PhotoDefaut(
-                        gamme=new_gamme,
-                        description=photo.description,
-                        created_by=photo.created_by,
-                        date_ajout=photo.date_ajout
-                    )
-                    
-                    # Generate a new filename to avoid conflicts
-                    file_extension = os.path.splitext(original_image.name)[1]
-                    new_filename = f'defaut_{new_gamme.id}_{int(timezone.now().timestamp())}{file_extension}'
-                    
-                    # Copy the file to a new location
-                    new_photo.image.save(
-                        new_filename,
-                        ContentFile(original_image.read()),
-                        save=True
-                    )
-                    
-                    # Save the new photo
-                    new_photo.save()
-                    
-                    print(f"Copied defect photo {photo.id} to new gamme {new_gamme.id} as {new_photo.id}")
-                    
-            except Exception as e:
-                logger.error(f"Error copying defect photos: {str(e)}", exc_info=True)
-                # Continue with the redirect even if there's an error with copying photos
+                logger.warning(f"Operation formset errors: {operation_formset.errors} {operation_formset.non_form_errors()}")
 
         return redirect(f'/gamme/missioncontrole/update/{missioncontrole.id}/#gammes')
 
 
+def edit_conflict_response(changes, is_ajax):
+    """409 for a mission save that lost the race against another save (see row_versions.py)."""
+    message = f"Enregistrement refusé : {' '.join(changes)} Rechargez la page pour reprendre ces modifications."
+    if is_ajax:
+        return JsonResponse({'success': False, 'conflict': True, 'message': message, 'changes': changes}, status=409)
+    return HttpResponse(message, status=409, content_type='text/plain; charset=utf-8')
+
+
+def missioncontrole_version_panel(request, pk, gamme_id):
+    """HTML fragment of an older gamme version, loaded when opened on the mission edit page."""
+    if not request.user.is_authenticated:
+        return HttpResponseForbidden("Vous devez être connecté.")
+    gamme = get_object_or_404(GammeControle, pk=gamme_id, mission_id=pk)
+    load_gamme_details([gamme])
+    return render(request, 'gamme/missioncontrole_version_panel.html', {
+        'gamme': gamme,
+        'image_derivatives': derivatives_for(gamme_image_names([gamme])),
+    })
+
+
+def gamme_photo_gallery(request, gamme_id, kind):
+    """HTML fragment of the defect or acceptable-limit photos of a gamme, for the photo modals."""
+    if not request.user.is_authenticated:
+        return HttpResponseForbidden("Vous devez être connecté.")
+    if kind not in GALLERY_MODELS:
+        raise Http404("Galerie introuvable")
+    gamme = get_object_or_404(GammeControle, pk=gamme_id)
+    photos = gallery_photos(gamme.id, kind)
+    return render(request, 'gamme/missioncontrole_photo_gallery.html', {
+        'photos': photos,
+        'kind': kind,
+        'image_derivatives': derivatives_for([photo.image.name for photo in photos]),
+    })
+
+
 class DashboardView(LoginRequiredMixin, View):
     template_name = 'gamme/dashboard.html'
 
@@ -2108,9 +1430,7 @@ class EpiDeleteView(LoginRequiredMixin, UserPassesTestMixin, DeleteView):
     success_url = reverse_lazy('Gamme:epi_list')
     
     def delete(self, request, *args, **kwargs):
-        self.object = self.get_object()
-        if self.object.photo:
-            self.object.photo.delete(save=False)
+        # The photo file is a shared blob, released when the row is deleted
         response = super().delete(request, *args, **kwargs)
         messages.success(request, "L'équipement de protection a été supprimé avec succès.")
         return response
@@ -2349,12 +1669,7 @@ def delete_photo_defaut(request, photo_id):
         photo = get_object_or_404(PhotoDefaut, id=photo_id)
         gamme_id = photo.gamme.id
         
-        # Delete the file from storage
-        if photo.image:
-            if default_storage.exists(photo.image.name):
-                default_storage.delete(photo.image.name)
-        
-        # Delete the database record
+        # Delete the database record; the image blob is released once no row references it
         photo.delete()
         
         return JsonResponse({
@@ -2367,351 +1682,83 @@ def delete_photo_defaut(request, photo_id):
         logger.error(f'Error deleting defect photo: {str(e)}', exc_info=True)
         return JsonResponse({'success': False, 'error': str(e)}, status=500)
 
-def view_gamme_pdf(request, mission_id):
-    """View to display the gamme PDF for a specific mission."""
+def _gamme_pdf_response(request, mission_id, download):
+    """
+    Serve the PDF of the active gamme of a mission.
+
+    Rendered PDFs are cached per gamme version and content fingerprint, and
+    served with a strong ETag so clients can revalidate with If-None-Match.
+    """
     mission = get_object_or_404(MissionControle, id=mission_id)
     
-    # Get the most recent gamme for this mission
-    gamme = mission.gammes.filter(statut=True).order_by('-version_num').first()
+    gamme = mission.active_gamme
     if not gamme:
         raise Http404("Aucune gamme active trouvée pour cette mission.")
-    
-    # Get the creator user and their role
-    creator = gamme.created_by
-    creator_name = creator.get_full_name() or creator.username
-    
-    # Determine creator's role based on their user type
-    if hasattr(creator, 'is_ro') and creator.is_ro:
-        creator_role = "Responsable Opérationnel"
-    elif hasattr(creator, 'is_rs') and creator.is_rs:
-        creator_role = "Responsable de Service"
-    elif hasattr(creator, 'is_admin') and creator.is_admin:
-        creator_role = "Administrateur"
-    else:
-        creator_role = "Responsable Qualité"  # Default role
-    
-    # Get validator info if exists
-    validator_name = ""
-    validator_role = "Responsable Qualité"
-    validation_date = None
-    
-    # Get the most recent validation for this gamme
-    if gamme:
-        latest_validation = gamme.validations.order_by('-date_validation_user_ro').first()
-        if latest_validation and latest_validation.user_ro:
-            validator = latest_validation.user_ro
-            validator_name = f"{validator.first_name} {validator.last_name}".strip() or validator.username
-            
-            # Determine role based on user type
-            if hasattr(validator, 'is_ro') and validator.is_ro:
-                validator_role = "Responsable Opérationnel"
-            elif hasattr(validator, 'is_rs') and validator.is_rs:
-                validator_role = "Responsable de Service"
-            elif hasattr(validator, 'is_admin') and validator.is_admin:
-                validator_role = "Administrateur"
-                
-            validation_date = latest_validation.date_validation_user_ro
-    
-    # Get operations for the most recent gamme, ordered by 'ordre'
-    operations_list = []
-    if gamme:
-        print(f"\n=== DEBUG: GAMME FOUND - ID: {gamme.id}, TITLE: {gamme.intitule} ===")
-        operations_list = list(gamme.operations.all().order_by('ordre').prefetch_related('moyenscontrole'))
-        print(f"Number of operations: {len(operations_list)}")
-    else:
-        print("\n=== DEBUG: NO GAMME FOUND FOR THIS MISSION ===")
-    
-    operations_dict = {}
-    # Get unique moyens_controle directly from the gamme
-    unique_moyens = set()
-    
-    if gamme:
-        # Get moyens_controle directly from the gamme
-        gamme_moyens = list(gamme.moyens_controle.all())  # Using the correct field name with underscore
-        print(f"\n=== DEBUG: MOYENS FROM GAMME ===")
-        print(f"Number of moyens in gamme: {len(gamme_moyens)}")
-        for m in gamme_moyens:
-            unique_moyens.add(m)
-            print(f"  Moyen: ID={m.id}, Nom='{m.nom}', Photo={bool(m.photo)}")
-    else:
-        print("\n=== DEBUG: NO GAMME FOUND TO GET MOYENS FROM ===")
-    
-    # Only include operations that have data
-    for i, op in enumerate(operations_list, 1):
-        op_moyens = list(op.moyenscontrole.all())
-        print(f"\nOperation {i} - ID: {op.id}, Description: {op.description}")
-        print(f"Number of moyens for operation {i}: {len(op_moyens)}")
-        
-        operations_dict[i] = {
-            'description': op.description,
-            'photos': op.photooperation_set.all(),
-            'moyenscontrole': op_moyens,
-            'frequence': op.frequence,
-            'moyen_controle': op.moyen_controle,
-            'criteres': op.criteres  # Add the criteres field
-        }
-    
-    # Get the RS user (Responsable de Service)
-    rs_user = User.objects.filter(is_rs=True).first()
-    if not rs_user:
-        rs_user = None
-    # Get the RO user (Responsable Opérationnel)
-    ro_user = User.objects.filter(is_ro=True).first()
-    if not ro_user:
-        ro_user = None
-    
-    # Ensure we have default values
-    if rs_user is None:
-        rs_user = request.user if request.user.is_authenticated else None
-    if ro_user is None:
-        ro_user = request.user if request.user.is_authenticated else None
-    
-    # Get PhotoDefaut objects for this gamme using the correct related_name
-    photo_defauts = []
-    photo_acceptables = []
-    if gamme:
-        try:
-            # Debug: Check if the gamme has the defaut_photos attribute
-            print(f"\n=== DEBUG: CHECKING PHOTOS FOR GAMME {gamme.id} ===")
-            print(f"Gamme ID: {gamme.id}, Title: {gamme.intitule}")
-            print(f"Has defaut_photos attribute: {hasattr(gamme, 'defaut_photos')}")
-            
-            # Get the defect photos
-            photo_defauts = gamme.defaut_photos.all().order_by('date_ajout')
-            print(f"Found {photo_defauts.count()} defect photos for gamme {gamme.id}")
-            
-            # Get the acceptable limit photos
-            photo_acceptables = gamme.limiteacceptable_photos.all().order_by('date_ajout')
-            print(f"Found {photo_acceptables.count()} acceptable limit photos for gamme {gamme.id}")
-            
-            # Debug each defect photo
-            for i, photo in enumerate(photo_defauts, 1):
-                print(f"\nDefect Photo {i}:")
-                print(f"  ID: {photo.id}")
-                print(f"  Description: {photo.description}")
-                print(f"  Image path: {photo.image.path if photo.image else 'No image'}")
-                print(f"  Image URL: {photo.image.url if photo.image else 'No URL'}")
-                print(f"  Date: {photo.date_ajout}")
-                
-                # Check if file exists
-                if photo and photo.image:
-                    try:
-                        file_exists = os.path.exists(photo.image.path)
-                        print(f"  File exists: {file_exists}")
-                        if not file_exists:
-                            print(f"  WARNING: File does not exist at {photo.image.path}")
-                    except Exception as e:
-                        print(f"  Error checking file existence: {str(e)}")
-                        file_exists = False
-                        
-            # Debug each acceptable limit photo
-            for i, photo in enumerate(photo_acceptables, 1):
-                print(f"\nAcceptable Limit Photo {i}:")
-                print(f"  ID: {photo.id}")
-                print(f"  Description: {photo.description}")
-                print(f"  Image path: {photo.image.path if photo.image else 'No image'}")
-                print(f"  Image URL: {photo.image.url if photo.image else 'No URL'}")
-                print(f"  Date: {photo.date_ajout}")
-                
-                # Check if file exists
-                if photo and photo.image:
-                    try:
-                        file_exists = os.path.exists(photo.image.path)
-                        print(f"  File exists: {file_exists}")
-                        if not file_exists:
-                            print(f"  WARNING: File does not exist at {photo.image.path}")
-                    except Exception as e:
-                        print(f"  Error checking file existence: {str(e)}")
-                        file_exists = False
-        except Exception as e:
-            print(f"Error getting photos: {str(e)}")
-            import traceback
-            traceback.print_exc()
-    
-    # Format the allocated time with a default value if not set
-    temps_alloue = ''
-    if gamme and hasattr(gamme, 'Temps_alloué') and gamme.Temps_alloué is not None:
-        temps_alloue = str(gamme.Temps_alloué)
-    
-    # Convert set to list and sort by ordre
-    unique_moyens_list = sorted(unique_moyens, key=lambda x: x.ordre if hasattr(x, 'ordre') else 0)
-    
-    # Debug: Print the unique moyens to console
-    print(f"Unique moyens to display: {[m.nom for m in unique_moyens_list]}")
-    
-    # Get EPIs for the gamme
-    epis = []
-    if gamme:
-        epis = list(gamme.epis.all())
-        print(f"EPIs to display: {[e.nom for e in epis]}")
-    
-    context = {
-        'mission': mission,
-        'gammecontrole': gamme,
-        'operations': operations_dict,
-        'unique_moyens': unique_moyens_list,  # Add unique moyens to context
-        'title': f'Gamme - {mission.intitule}',
-        'rs_user': rs_user,
-        'ro_user': ro_user,
-        'photo_defauts': photo_defauts,
-        'photo_acceptables': photo_acceptables,  # Add acceptable limit photos to the context
-        'temps_alloue': temps_alloue,
-        'static_defect_photos': [
-            {'image_path': '1.jpg', 'title': 'Défaut de surface'},
-            {'image_path': '2.jpg', 'title': 'Défaut d\'assemblage'},
-            {'image_path': 'logo.jpg', 'title': 'Défaut de marquage'},
-        ],
-        'epis': epis,  # Add EPIs to the context
-        'validator_name': validator_name,  # Add validator's name to the context
-        'validator_role': validator_role,  # Add validator's role to the context
-        'validation_date': validation_date,  # Add validation date to the context
-        'creator_name': creator_name,  # Add creator's name to the context
-        'creator_role': creator_role,  # Add creator's role to the context
-        'gamme_creation_date': gamme.date_creation  # Add gamme creation date to the context
-    }
-    
-    # Check if this is a modal or no_toolbar request
-    is_modal = request.GET.get('modal') == '1'
-    no_toolbar = request.GET.get('no_toolbar') == '1' or is_modal
-    
-    # Add flags to context
-    context.update({
-        'modal': is_modal,
-        'no_toolbar': no_toolbar
-    })
-    
+
+    with stage('fingerprint'):
+        etag = gamme_pdf_etag(gamme)
+    not_modified = get_conditional_response(request, etag=etag)
+    if not_modified is not None:
+        not_modified['ETag'] = etag
+        return not_modified
+
+    try:
+        with stage('cache'):
+            pdf_path = get_or_render(
+                gamme.id, etag,
+                lambda: render_gamme_pdf(build_gamme_pdf_context(mission, gamme, request.user))
+            )
+    except PdfRenderError as e:
+        return HttpResponse(str(e), status=500)
+
+    with stage('delivery'):
+        response = serve_file(
+            request, pdf_path,
+            content_type='application/pdf',
+            as_attachment=download,
+            filename=f'gamme_mission_{mission.code}.pdf',
+            etag=etag
+        )
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def serve_media(request, path):
+    """Serve an uploaded file (photos, stored PDFs), to authenticated users unless GAMME_MEDIA_REQUIRE_LOGIN is off."""
+    if getattr(settings, 'GAMME_MEDIA_REQUIRE_LOGIN', True) and not request.user.is_authenticated:
+        return HttpResponseForbidden("Vous devez être connecté pour accéder à ce fichier.")
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404("Fichier introuvable")
+    if not os.path.exists(full_path):
+        # Photos of old versions moved to cold storage
+        full_path = cold_path(path) or full_path
+    response = serve_file(request, full_path)
+    patch_cache_control(response, private=True, max_age=0)
+    return response
+
+
+def serve_static(request, path):
+    """Serve a static file through the file delivery layer."""
+    try:
+        full_path = safe_join(settings.STATICFILES_DIRS[0], path)
+    except SuspiciousFileOperation:
+        raise Http404("Fichier introuvable")
+    return serve_file(request, full_path)
+
+
+@profile_pdf('view_gamme_pdf')
+def view_gamme_pdf(request, mission_id):
+    """View to display the gamme PDF for a specific mission."""
     # Check if this is a download request
-    download = request.GET.get('download') == '1'
-    
-    # Generate and return the PDF
-    from django.http import HttpResponse
-    from xhtml2pdf import pisa
-    from io import BytesIO
-    from django.template.loader import get_template
-    from django.conf import settings
-    import os
-    
-    # Add the request to context for absolute URLs
-    context.update({
-        'STATIC_URL': request.build_absolute_uri(settings.STATIC_URL),
-        'MEDIA_URL': request.build_absolute_uri(settings.MEDIA_URL),
-    })
-    
-    # Use the gamme_pdf_template.html for PDF generation
-    template = get_template('gamme/gamme_pdf_template.html')
-    html = template.render(context)
-    
-    # Create a file-like buffer to receive PDF data
-    result = BytesIO()
-    
-    # Function to handle static files and images
-    def fetch_resources(uri, rel):
-        import os
-        from django.conf import settings
-        from urllib.parse import urlparse
-        
-        # Handle static files
-        if uri.startswith(settings.STATIC_URL):
-            path = os.path.join(settings.STATIC_ROOT, uri.replace(settings.STATIC_URL, ''))
-        # Handle media files
-        elif uri.startswith(settings.MEDIA_URL):
-            path = os.path.join(settings.MEDIA_ROOT, uri.replace(settings.MEDIA_URL, ''))
-        else:
-            # Handle absolute URLs (e.g., CDN)
-            parsed_uri = urlparse(uri)
-            if parsed_uri.netloc:
-                return uri
-            # Handle relative paths
-            path = os.path.join(settings.STATIC_ROOT, uri.lstrip('/'))
-        
-        # Ensure the path exists and return it
-        if os.path.exists(path):
-            return path
-        return uri
-    
-    # Convert HTML to PDF with proper resource handling
-    pdf = pisa.pisaDocument(
-        BytesIO(html.encode("UTF-8")), 
-        result,
-        encoding='UTF-8',
-        link_callback=fetch_resources
-    )
-    
-    if not pdf.err:
-        response = HttpResponse(result.getvalue(), content_type='application/pdf')
-        if download:
-            response['Content-Disposition'] = f'attachment; filename="gamme_mission_{mission.code}.pdf"'
-        else:
-            response['Content-Disposition'] = f'inline; filename="gamme_mission_{mission.code}.pdf"'
-        return response
-    
-    # If there was an error, return the error
-    return HttpResponse(f"Error generating PDF: {pdf.err}", status=500)
+    return _gamme_pdf_response(request, mission_id, download=request.GET.get('download') == '1')
+
 
+@profile_pdf('download_gamme_pdf')
 def download_gamme_pdf(request, mission_id):
     """View to download the gamme PDF for a specific mission."""
-    # Reuse the same context preparation as view_gamme_pdf
-    mission = get_object_or_404(MissionControle, id=mission_id)
-    
-    # Get the most recent gamme for this mission
-    gamme = mission.gammes.filter(statut=True).order_by('-version_num').first()
-    if not gamme:
-        raise Http404("Aucune gamme active trouvée pour cette mission.")
-    
-    # Get the creator user and their role
-    creator = gamme.created_by
-    creator_name = creator.get_full_name() or creator.username
-    
-    # Determine creator's role based on their user type
-    if hasattr(creator, 'is_ro') and creator.is_ro:
-        creator_role = "Responsable Opérationnel"
-    elif hasattr(creator, 'is_rs') and creator.is_rs:
-        creator_role = "Responsable de Service"
-    elif hasattr(creator, 'is_admin') and creator.is_admin:
-        creator_role = "Administrateur"
-    else:
-        creator_role = "Responsable Qualité"  # Default role
-    
-    # Get validator info if exists
-    validator_name = ""
-    validator_role = "Responsable Qualité"
-    validation_date = None
-    
-    # Get the most recent validation for this gamme
-    if gamme:
-        latest_validation = gamme.validations.order_by('-date_validation_user_ro').first()
-        if latest_validation and latest_validation.user_ro:
-            validator = latest_validation.user_ro
-            validator_name = f"{validator.first_name} {validator.last_name}".strip() or validator.username
-            
-            # Determine role based on user type
-            if hasattr(validator, 'is_ro') and validator.is_ro:
-                validator_role = "Responsable Opérationnel"
-            elif hasattr(validator, 'is_rs') and validator.is_rs:
-                validator_role = "Responsable de Service"
-            elif hasattr(validator, 'is_admin') and validator.is_admin:
-                validator_role = "Administrateur"
-                
-            validation_date = latest_validation.date_validation_user_ro
-    
-    # Get operations for the most recent gamme, ordered by 'ordre'
-    operations_list = []
-    if gamme:
-        operations_list = list(gamme.operations.all().order_by('ordre').prefetch_related('moyenscontrole'))
-    
-    operations_dict = {}
-    # Get unique moyens_controle directly from the gamme
-    unique_moyens = set()
-    
-    if gamme:
-        # Get moyens_controle directly from the gamme
-        gamme_moyens = list(gamme.moyens_controle.all())
-        for m in gamme_moyens:
-            unique_moyens.add(m)
-    
-    # Only include operations that have data
-    for i, op in enumerate(operations_list, 1):
-        pass  # Add proper indentation for the loop body
+    return _gamme_pdf_response(request, mission_id, download=True)
 
 @csrf_exempt
 @require_http_methods(['POST'])
@@ -2740,31 +1787,31 @@ def upload_photo_defaut(request):
         if not files:
             return JsonResponse({'success': False, 'error': 'No files provided'}, status=400)
         
+        # Decoded, rotated upright and written in parallel, then inserted in one query
+        items = [
+            (PhotoDefaut(gamme=gamme, description=description, created_by=request.user), file, file.name)
+            for file in files
+        ]
+        results = ingest_images(PhotoDefaut, 'image', items)
+
         saved_photos = []
-        for file in files:
-            # Create PhotoDefaut instance first to get the upload path
-            photo = PhotoDefaut(
-                gamme=gamme,
-                description=description,
-                created_by=request.user,
-                date_ajout=timezone.now()
-            )
-            
-            # Save the file using the model's save method which will handle the upload_to path
-            photo.image.save(file.name, file, save=True)
-            
-            saved_photos.append({
-                'id': photo.id,
-                'url': photo.image.url,
-                'description': photo.description,
-                'date_ajout': photo.date_ajout.strftime('%d/%m/%Y %H:%M')
-            })
-        
+        for result in results:
+            if result['error'] is None:
+                photo = result['instance']
+                saved_photos.append({
+                    'id': photo.id,
+                    'url': photo.image.url,
+                    'description': photo.description,
+                    'date_ajout': timezone.localtime(photo.date_ajout).strftime('%d/%m/%Y %H:%M')
+                })
+
         return JsonResponse({
-            'success': True,
+            'success': bool(saved_photos),
             'message': f'Successfully uploaded {len(saved_photos)} photos',
-            'photos': saved_photos
-        })
+            'photos': saved_photos,
+            'results': [upload_result(result, 'image') for result in results],
+            'error': None if saved_photos else 'No valid image provided'
+        }, status=200 if saved_photos else 400)
         
     except Exception as e:
         logger.error(f'Error uploading defect photos: {str(e)}', exc_info=True)
@@ -2787,11 +1834,7 @@ def delete_photo_defaut(request, photo_id):
         if not (request.user.is_admin or request.user.is_rs or request.user.is_ro or photo.created_by == request.user):
             return JsonResponse({'success': False, 'error': 'Permission denied'}, status=403)
         
-        # Delete the file from storage
-        if photo.image:
-            photo.image.delete(save=False)
-            
-        # Delete the database record
+        # Delete the database record; the image blob is released once no row references it
         photo.delete()
         
         return JsonResponse({
@@ -2836,34 +1879,37 @@ def upload_photo_acceptable(request):
         if not photos:
             return JsonResponse({'success': False, 'error': 'No photos provided'}, status=400)
         
-        saved_photos = []
+        # Decoded, rotated upright and written in parallel, then inserted in one query
+        timestamp = int(timezone.now().timestamp())
+        items = []
         for photo in photos:
-            # Create a new Photolimiteacceptable instance
-            photo_instance = Photolimiteacceptable(
-                gamme=gamme,
-                description=description,
-                created_by=request.user
-            )
-            
-            # Save the file with a unique name
             file_extension = os.path.splitext(photo.name)[1].lower()
-            filename = f'acceptable_{gamme.id}_{int(timezone.now().timestamp())}{file_extension}'
-            photo_instance.image.save(filename, photo, save=False)
-            photo_instance.save()
-            
-            saved_photos.append({
-                'id': photo_instance.id,
-                'url': photo_instance.image.url,
-                'description': photo_instance.description,
-                'uploaded_at': photo_instance.date_ajout.isoformat(),
-                'uploaded_by': request.user.get_full_name() or request.user.username
-            })
-        
+            filename = f'acceptable_{gamme.id}_{timestamp}{file_extension}'
+            items.append((
+                Photolimiteacceptable(gamme=gamme, description=description, created_by=request.user),
+                photo, filename
+            ))
+        results = ingest_images(Photolimiteacceptable, 'image', items)
+
+        saved_photos = []
+        for result in results:
+            if result['error'] is None:
+                photo_instance = result['instance']
+                saved_photos.append({
+                    'id': photo_instance.id,
+                    'url': photo_instance.image.url,
+                    'description': photo_instance.description,
+                    'uploaded_at': photo_instance.date_ajout.isoformat(),
+                    'uploaded_by': request.user.get_full_name() or request.user.username
+                })
+
         return JsonResponse({
-            'success': True,
+            'success': bool(saved_photos),
             'message': f'Successfully uploaded {len(saved_photos)} photo(s)',
-            'photos': saved_photos
-        })
+            'photos': saved_photos,
+            'results': [upload_result(result, 'image') for result in results],
+            'error': None if saved_photos else 'No valid image provided'
+        }, status=200 if saved_photos else 400)
         
     except Exception as e:
         logger.error(f'Error uploading acceptable photos: {str(e)}', exc_info=True)
@@ -2887,11 +1933,7 @@ def delete_photo_acceptable(request, photo_id):
         if not (request.user.is_admin or request.user.is_rs or request.user.is_ro or photo.created_by == request.user):
             return JsonResponse({'success': False, 'error': 'Permission denied'}, status=403)
         
-        # Delete the file from storage
-        if photo.image:
-            photo.image.delete(save=False)
-            
-        # Delete the database record
+        # Delete the database record; the image blob is released once no row references it
         photo.delete()
         
         return JsonResponse({
@@ -3073,92 +2115,280 @@ def check_mission_code(request):
 
 
 
+@require_http_methods(['POST'])
+@profile_pdf('generate_and_save_gamme_pdf')
 def generate_and_save_gamme_pdf(request, mission_id):
-    """Generate a PDF from the gamme template and save it to the mission."""
-    try:
-        from django.template.loader import render_to_string
-        from django.http import JsonResponse
-        from django.core.files.base import ContentFile
-        from io import BytesIO
-        from xhtml2pdf import pisa
-        from django.conf import settings
-        import os
-        
-        # Get the mission object
-        mission = get_object_or_404(MissionControle, id=mission_id)
-        
-        # Get the latest gamme for this mission
-        gamme = mission.latest_gamme
-        if not gamme:
-            return JsonResponse(
-                {'success': False, 'error': 'No gamme found for this mission'},
-                status=400
-            )
-        
-        # Get operations for the gamme
-        operations = {}
-        for i, op in enumerate(gamme.operations.all().order_by('ordre'), 1):
-            operations[i] = {
-                'description': op.description,
-                'photos': op.photooperation_set.all(),
-                'frequence': op.frequence,
-                'moyen_controle': op.moyen_controle
-            }
-        
-        # Get EPIs for the gamme
-        epis = gamme.epis.all() if hasattr(gamme, 'epis') else []
-        
-        # Context for the template
-        context = {
-            'mission': mission,
-            'gammecontrole': gamme,
-            'operations': operations,
-            'epis': epis,
-            'creator_name': gamme.created_by.get_full_name() or gamme.created_by.username,
-            'creator_role': 'Responsable Qualité',
-            'validator_name': '',
-            'validator_role': 'Responsable Qualité',
-            'gamme_creation_date': gamme.date_creation,
-            'no_toolbar': True,
-            'modal': True,
-        }
-        
-        # Render the template
-        html_string = render_to_string('gamme/gamme_pdf_template.html', context)
-        
-        # Create PDF
-        result = BytesIO()
-        pdf = pisa.pisaDocument(
-            BytesIO(html_string.encode("UTF-8")), 
-            dest=result,
-            encoding='UTF-8'
+    """
+    Queue the generation of the mission PDF.
+
+    The PDF is rendered by the `run_pdf_worker` command; poll the returned
+    status_url until the job is done to get the pdf_url.
+    """
+    if not request.user.is_authenticated:
+        return JsonResponse({'success': False, 'error': 'Authentication required'}, status=403)
+
+    mission = get_object_or_404(MissionControle, id=mission_id)
+    if mission.active_gamme is None:
+        return JsonResponse(
+            {'success': False, 'error': 'No active gamme found for this mission'},
+            status=400
         )
-        
-        if not pdf.err:
-            # Delete old file if exists
-            if mission.pdf_file:
-                try:
-                    mission.pdf_file.delete(save=False)
-                except Exception as e:
-                    logger.warning(f"Could not delete old file: {str(e)}")
-            
-            # Save the new file
-            file_name = f'mission_{mission.id}_gamme.pdf'
-            mission.pdf_file.save(file_name, ContentFile(result.getvalue()), save=True)
-            
-            return JsonResponse({
-                'success': True,
-                'message': 'PDF generated and saved successfully',
-                'pdf_url': request.build_absolute_uri(mission.pdf_file.url)
-            })
-        else:
-            raise Exception('Error generating PDF: ' + str(pdf.err))
-        
-    except Exception as e:
+
+    job = enqueue_mission_pdf(mission, request.user)
+    return JsonResponse({
+        'success': True,
+        'message': 'PDF generation queued',
+        'job_id': job.id,
+        'status': job.status,
+        'status_url': reverse('Gamme:pdf_job_status', args=[job.id])
+    }, status=202)
+
+
+@require_http_methods(['GET'])
+def print_pack(request):
+    """
+    Download the gammes of several missions as one merged PDF or a ZIP.
+
+    Query parameters: `mission` (repeatable), `client`, `section` and
+    `format` ('pdf' or 'zip'). Only stored PDFs that are up to date are packed: when
+    some are not, their renders are queued for `run_pdf_worker` and the
+    response is a 202 with one status_url per job; request the pack again
+    once they are done.
+    """
+    if not request.user.is_authenticated:
+        return JsonResponse({'success': False, 'error': 'Authentication required'}, status=403)
+
+    fmt = request.GET.get('format', 'pdf')
+    if fmt not in PACK_FORMATS:
+        return JsonResponse({'success': False, 'error': f'Unknown format: {fmt}'}, status=400)
+    try:
+        mission_ids = [int(value) for value in request.GET.getlist('mission')]
+    except ValueError:
+        return JsonResponse({'success': False, 'error': 'Invalid mission id'}, status=400)
+    client = request.GET.get('client')
+    section = request.GET.get('section')
+    if not (mission_ids or client or section):
+        return JsonResponse({'success': False, 'error': 'Select missions, a client or a section'}, status=400)
+
+    missions = list(pack_missions(mission_ids, client, section))
+    if not missions:
+        return JsonResponse({'success': False, 'error': 'No mission with an active gamme matches'}, status=404)
+
+    # Rendering stays out of the request cycle, as for generate_and_save_gamme_pdf
+    stale = stale_missions(missions)
+    if stale:
+        jobs = [enqueue_mission_pdf(mission, request.user) for mission in stale]
         return JsonResponse({
-            'success': False,
-            'error': str(e)
-        }, status=500)
+            'success': True,
+            'message': 'PDF generation queued',
+            'jobs': [{
+                'mission_id': job.mission_id,
+                'job_id': job.id,
+                'status': job.status,
+                'status_url': reverse('Gamme:pdf_job_status', args=[job.id])
+            } for job in jobs]
+        }, status=202)
+
+    # Deleted as soon as the response has been streamed and closed
+    pack = tempfile.TemporaryFile()
+    try:
+        packed, failures = build_print_pack(missions, pack, fmt, refresh=False)
+    except Exception as e:
+        pack.close()
+        logger.error(f'Error building print pack: {str(e)}', exc_info=True)
+        return JsonResponse({'success': False, 'error': 'Print pack generation failed'}, status=500)
+    if not packed:
+        pack.close()
+        return JsonResponse({'success': False, 'error': 'No PDF could be generated'}, status=500)
+
+    pack.seek(0)
+    filename = f'gammes_{timezone.localdate():%Y%m%d}.{fmt}'
+    response = FileResponse(
+        pack,
+        content_type='application/pdf' if fmt == 'pdf' else 'application/zip',
+        as_attachment=True,
+        filename=filename
+    )
+    if failures:
+        response['X-Print-Pack-Missing'] = ','.join(mission.code for mission, error in failures)
+    return response
+
+
+def _chunked_upload_data(upload):
+    return {
+        'success': True,
+        'token': str(upload.token),
+        'status': upload.status,
+        'offset': upload.offset,
+        'size': upload.size,
+        'photo_id': upload.photo_id,
+        'upload_url': reverse('Gamme:chunked_upload_detail', args=[upload.token]),
+        'complete_url': reverse('Gamme:chunked_upload_complete', args=[upload.token]),
+    }
+
+
+def _parse_content_range(header):
+    """Return (start, end, total) from 'bytes start-end/total', or None."""
+    match = re.match(r'^bytes (\d+)-(\d+)/(\d+)$', header.strip())
+    if not match:
+        return None
+    return tuple(int(value) for value in match.groups())
+
+
+@require_http_methods(['POST'])
+def chunked_upload_start(request):
+    """
+    Start a resumable photo upload.
+
+    Expected POST data: kind (defaut, acceptable or operation), filename,
+    size, gamme_id or operation_id, optional description and sha256.
+    """
+    if not request.user.is_authenticated:
+        return JsonResponse({'success': False, 'error': 'Authentication required'}, status=403)
+
+    kind = request.POST.get('kind')
+    filename = request.POST.get('filename', '')
+    if kind not in dict(ChunkedUpload.KIND_CHOICES):
+        return JsonResponse({'success': False, 'error': 'Invalid kind'}, status=400)
+    try:
+        size = int(request.POST.get('size', ''))
+    except ValueError:
+        return JsonResponse({'success': False, 'error': 'Invalid size'}, status=400)
+    max_bytes = getattr(settings, 'GAMME_UPLOAD_MAX_BYTES', 25 * 1024 * 1024)
+    if not 0 < size <= max_bytes:
+        return JsonResponse({'success': False, 'error': f'Size must be between 1 and {max_bytes} bytes'}, status=400)
+    try:
+        # Rejected before any byte is sent
+        validate_image_file_extension(ContentFile(b'', name=filename))
+    except ValidationError as e:
+        return JsonResponse({'success': False, 'error': ' '.join(e.messages)}, status=400)
+
+    gamme = operation = None
+    if kind == ChunkedUpload.KIND_OPERATION:
+        operation = get_object_or_404(OperationControle, id=request.POST.get('operation_id'))
+    else:
+        gamme = get_object_or_404(GammeControle, id=request.POST.get('gamme_id'))
+        # Same rule as upload_photo_acceptable
+        if kind == ChunkedUpload.KIND_ACCEPTABLE and not (
+                request.user.is_admin or request.user.is_rs or request.user.is_ro or gamme.created_by == request.user):
+            return JsonResponse({'success': False, 'error': 'Permission denied'}, status=403)
+
+    upload = start_upload(
+        request.user, kind, filename, size,
+        gamme=gamme, operation=operation,
+        description=request.POST.get('description', ''),
+        sha256=request.POST.get('sha256', ''),
+    )
+    data = _chunked_upload_data(upload)
+    data['chunk_size'] = getattr(settings, 'GAMME_UPLOAD_CHUNK_SIZE', 1024 * 1024)
+    return JsonResponse(data, status=201)
+
+
+@require_http_methods(['GET', 'PUT'])
+def chunked_upload_detail(request, token):
+    """
+    GET: where to resume the upload. PUT: write a chunk given as raw body,
+    positioned by its Content-Range header (or an `offset` query parameter).
+    """
+    if not request.user.is_authenticated:
+        return JsonResponse({'success': False, 'error': 'Authentication required'}, status=403)
+    upload = get_object_or_404(ChunkedUpload, token=token, created_by=request.user)
+    if request.method == 'GET':
+        return JsonResponse(_chunked_upload_data(upload))
+
+    try:
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        length = 0
+    max_chunk = getattr(settings, 'GAMME_UPLOAD_CHUNK_MAX', 8 * 1024 * 1024)
+    if not 0 < length <= max_chunk:
+        return JsonResponse({'success': False, 'error': f'Chunks must be between 1 and {max_chunk} bytes'}, status=400)
+
+    content_range = _parse_content_range(request.META.get('HTTP_CONTENT_RANGE', ''))
+    if content_range:
+        offset, end, total = content_range
+        if total != upload.size or end - offset + 1 != length:
+            return JsonResponse({'success': False, 'error': 'Content-Range does not match the upload'}, status=400)
+    else:
+        try:
+            offset = int(request.GET.get('offset', ''))
+        except ValueError:
+            return JsonResponse({'success': False, 'error': 'Content-Range header required'}, status=400)
+
+    try:
+        # Streamed from the request body: the chunk is never held in memory
+        write_chunk(upload, offset, request, length)
+    except UploadConflict as e:
+        return JsonResponse({'success': False, 'error': 'Wrong offset', 'offset': e.offset}, status=409)
+    except ValueError as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=400)
+    return JsonResponse(_chunked_upload_data(upload))
+
+
+@require_http_methods(['POST'])
+def chunked_upload_complete(request, token):
+    """Finish an upload once every byte is received and return the created photo."""
+    if not request.user.is_authenticated:
+        return JsonResponse({'success': False, 'error': 'Authentication required'}, status=403)
+    upload = get_object_or_404(ChunkedUpload, token=token, created_by=request.user)
+
+    try:
+        result = complete_upload(upload)
+    except UploadIncomplete as e:
+        data = _chunked_upload_data(upload)
+        data.update({'success': False, 'error': str(e)})
+        return JsonResponse(data, status=409)
+    except ValueError as e:
+        data = _chunked_upload_data(upload)
+        data.update({'success': False, 'error': str(e)})
+        return JsonResponse(data, status=400)
+    except Exception as e:
+        logger.error(f'Error completing chunked upload {upload.token}: {str(e)}', exc_info=True)
+        return JsonResponse({'success': False, 'error': str(e)}, status=500)
+
+    if result is not None and result['error'] is not None:
+        data = _chunked_upload_data(upload)
+        data.update({'success': False, 'error': result['error']})
+        return JsonResponse(data, status=400)
+    if upload.photo_id is None:
+        # Another request is completing it right now
+        return JsonResponse({'success': False, 'error': 'Completion in progress'}, status=409)
+
+    data = _chunked_upload_data(upload)
+    if result is not None:
+        data['photo'] = upload_result(result, 'image')
+    return JsonResponse(data)
+
+
+def pdf_profile_stats(request):
+    """Rolling per-stage timings of the PDF endpoints in this process (staff only)."""
+    if not request.user.is_authenticated or not request.user.is_staff:
+        return JsonResponse({'success': False, 'error': 'Staff access required'}, status=403)
+    return JsonResponse({
+        'success': True,
+        'pid': os.getpid(),
+        'endpoints': profiling_summary(),
+    })
+
+
+def pdf_job_status(request, job_id):
+    """Return the status of a PDF render job, with pdf_url once the file is written."""
+    if not request.user.is_authenticated:
+        return JsonResponse({'success': False, 'error': 'Authentication required'}, status=403)
+
+    job = get_object_or_404(PdfRenderJob.objects.select_related('mission'), id=job_id)
+    data = {
+        'success': job.status != PdfRenderJob.STATUS_FAILED,
+        'job_id': job.id,
+        'mission_id': job.mission_id,
+        'status': job.status,
+        'attempts': job.attempts,
+    }
+    if job.status == PdfRenderJob.STATUS_DONE and job.mission.pdf_file:
+        data['pdf_url'] = request.build_absolute_uri(job.mission.pdf_file.url)
+    elif job.status == PdfRenderJob.STATUS_FAILED:
+        data['error'] = job.error.strip().splitlines()[-1] if job.error else 'PDF generation failed'
+    return JsonResponse(data)
 
 
 def save_mission_pdf(request, mission_id):
@@ -3214,17 +2444,10 @@ def save_mission_pdf(request, mission_id):
                 status=400
             )
         
-        # Delete old file if exists
-        if mission.pdf_file:
-            try:
-                mission.pdf_file.delete(save=False)
-                logger.info("Deleted old PDF file")
-            except Exception as e:
-                logger.warning(f"Could not delete old file: {str(e)}")
-        
-        # Save the new file
-        file_name = f'mission_{mission.id}_gamme.pdf'
-        mission.pdf_file.save(file_name, pdf_file, save=True)
+        # Stored by content hash; the previous blob is left to gc_gamme_pdfs
+        # since other missions may point at it
+        mission.pdf_file.name = store_pdf(pdf_file)
+        mission.save()
         
         logger.info(f"Successfully saved PDF to {mission.pdf_file.path}")
         
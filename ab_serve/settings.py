@@ -54,6 +54,86 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 # Create media directory if it doesn't exist
 os.makedirs(MEDIA_ROOT, exist_ok=True)
 
+# Rendered gamme PDFs, keyed by gamme id and content fingerprint
+GAMME_PDF_CACHE_DIR = os.path.join(BASE_DIR, 'cache', 'gamme_pdf')
+# Bump to invalidate every cached gamme PDF (e.g. after a logo change)
+GAMME_PDF_CACHE_VERSION = 1
+# Downscaled copies of the photos embedded in gamme PDFs
+GAMME_PDF_IMAGES_DIR = os.path.join(BASE_DIR, 'cache', 'pdf_images')
+# Derivative resolution relative to the CSS box of each PDF image slot
+GAMME_PDF_IMAGE_SCALE = 2
+
+# Per-stage profiling of the PDF endpoints (Server-Timing header, logs, /gamme/pdf-stats/).
+# Memory tracing (tracemalloc) slows rendering down noticeably: keep it for debugging.
+GAMME_PDF_PROFILING = True
+GAMME_PDF_PROFILE_MEMORY = DEBUG
+GAMME_PDF_PROFILE_WINDOW = 200
+
+# Threads decoding and writing the files of a multi-photo upload, and the per-file size limit
+GAMME_INGEST_WORKERS = 8
+GAMME_UPLOAD_MAX_BYTES = 25 * 1024 * 1024
+
+# Ingest-time normalization of photos (upright, longest side capped, metadata stripped,
+# re-encoded). Originals are discarded unless GAMME_IMAGE_KEEP_ORIGINAL is on. HEIC uploads
+# need the optional pillow-heif package.
+GAMME_IMAGE_NORMALIZE = True
+GAMME_IMAGE_MAX_SIDE = 2560
+GAMME_IMAGE_QUALITY = 85
+GAMME_IMAGE_KEEP_ORIGINAL = False
+
+# Resumable chunked uploads (Gamme/chunked_upload.py): temporary files, advertised and maximum chunk size
+GAMME_CHUNKED_UPLOAD_DIR = os.path.join(BASE_DIR, 'cache', 'uploads')
+GAMME_UPLOAD_CHUNK_SIZE = 1024 * 1024
+GAMME_UPLOAD_CHUNK_MAX = 8 * 1024 * 1024
+# Idle uploads older than this (seconds) are removed by expire_chunked_uploads
+GAMME_CHUNKED_UPLOAD_MAX_AGE = 24 * 3600
+
+# Where reclaim_orphan_media --apply moves unreferenced media files (outside MEDIA_ROOT, so never served)
+GAMME_MEDIA_QUARANTINE_DIR = os.path.join(BASE_DIR, 'media_quarantine')
+
+# Cold storage of the photos of inactive gamme versions (Gamme/cold_storage.py): tier_cold_media
+# packs them into zip archives after this many days, reads extract them into a bounded cache
+GAMME_MEDIA_COLD_AFTER_DAYS = 180
+GAMME_MEDIA_ARCHIVE_DIR = os.path.join(BASE_DIR, 'media_archive')
+GAMME_MEDIA_COLD_CACHE_DIR = os.path.join(BASE_DIR, 'cache', 'media_cold')
+GAMME_MEDIA_COLD_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# Worker processes used to refresh mission PDFs when building a print pack
+GAMME_PRINT_PACK_PROCESSES = min(4, os.cpu_count() or 1)
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Rendered HTML blocks of gamme_pdf_template.html ({% cache %} fragments),
+    # on disk so that web and PDF worker processes share them
+    'gamme_fragments': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache', 'gamme_fragments'),
+        'OPTIONS': {
+            'MAX_ENTRIES': 20000,
+        },
+    },
+}
+
+# How media files and cached PDFs are handed to the client (see Gamme/delivery.py):
+# 'django' streams them, 'nginx' uses X-Accel-Redirect, 'sendfile' uses X-Sendfile.
+# With nginx, each root below needs an internal location, e.g.
+#   location /protected/media/ { internal; alias /srv/ab_serve/media/; }
+#   location /protected/media_cold/ { internal; alias /srv/ab_serve/cache/media_cold/; }
+# (the second one serves the archived photos extracted to the cold cache)
+FILE_DELIVERY_BACKEND = os.environ.get('FILE_DELIVERY_BACKEND', 'django')
+FILE_DELIVERY_ROOTS = {
+    MEDIA_ROOT: '/protected/media/',
+    GAMME_MEDIA_COLD_CACHE_DIR: '/protected/media_cold/',
+    GAMME_PDF_CACHE_DIR: '/protected/gamme_pdf/',
+    os.path.join(BASE_DIR, 'static'): '/protected/static/',
+}
+
+# /media/ (photos, stored gamme PDFs) is only served to logged-in users. Set
+# to False to serve it to anyone, as before file delivery went through Django.
+GAMME_MEDIA_REQUIRE_LOGIN = True
+
 # Application definition
 AUTH_USER_MODEL = 'Gamme.User'
 
@@ -18,28 +18,24 @@ from django.contrib import admin
 from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
-from django.views.static import serve
 from django.urls import re_path
+from Gamme.views import serve_media, serve_static
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('', include('Gamme.urls')),
 ]
 
-# Serve media files in development
+# Media files are checked by Django (login, see GAMME_MEDIA_REQUIRE_LOGIN) and
+# delivered through Gamme.delivery (X-Accel-Redirect / X-Sendfile when
+# FILE_DELIVERY_BACKEND is set), with or without DEBUG
+urlpatterns += [
+    re_path(r'^media/(?P<path>.*)$', serve_media),
+]
+
 if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
-    # Add URL pattern for serving media files in development
-    urlpatterns += [
-        re_path(r'^media/(?P<path>.*)$', serve, {
-            'document_root': settings.MEDIA_ROOT,
-        }),
-    ]
     urlpatterns += static(settings.STATIC_URL, document_root=settings.STATICFILES_DIRS[0])
 else:
-    # In production, serve media files through Django (not recommended for production)
-    # In a real production environment, you should configure your web server to serve these files
     urlpatterns += [
-        re_path(r'^media/(?P<path>.*)$', serve, {'document_root': settings.MEDIA_ROOT, }),
-        re_path(r'^static/(?P<path>.*)$', serve, {'document_root': settings.STATICFILES_DIRS[0], }),
+        re_path(r'^static/(?P<path>.*)$', serve_static),
     ]